@@ -1,7 +1,12 @@
+import signal
+
+import gevent
 from jumpscale import j
 from zerorobot.template.base import TemplateBase
 
 NODE_CLIENT = 'local'
+CACHE_CAPACITY = 9984  # default capacity of the coredns cache plugin
+RELOAD_CHECK_DELAY = 2  # time given to coredns to reload its configuration before checking it is still running
 
 
 class Coredns(TemplateBase):
@@ -12,6 +17,8 @@ class Coredns(TemplateBase):
         super().__init__(name=name, guid=guid, data=data)
         self.add_delete_callback(self.uninstall)
         self.recurring_action('_monitor', 30)  # every 30 seconds
+        # the configuration of a coredns that was just started could not be reloaded yet, see _apply_config
+        self._reload_pending = False
 
     def validate(self):
         self.state.delete('status', 'running')
@@ -35,12 +42,16 @@ class Coredns(TemplateBase):
 
         if not self._coredns_sal.is_running():
             self.state.set('status', 'running', 'error')
-            self._coredns_sal.deploy()
-            self._coredns_sal.start()
-            if self._coredns_sal.is_running():
+            coredns_sal = self._coredns_sal
+            coredns_sal.deploy()
+            coredns_sal.start()
+            self._apply_config(coredns_sal)
+            if coredns_sal.is_running():
                 self.state.set('status', 'running', 'ok')
         else:
             self.state.set('status', 'running', 'ok')
+            if self._reload_pending:
+                self._apply_config(self._coredns_sal)
 
     @property
     def _node_sal(self):
@@ -86,8 +97,10 @@ class Coredns(TemplateBase):
         """
         self.state.check('actions', 'install', 'ok')
         self.logger.info('Starting CoreDns  %s' % self.name)
-        self._coredns_sal.deploy()
-        self._coredns_sal.start()
+        coredns_sal = self._coredns_sal
+        coredns_sal.deploy()
+        coredns_sal.start()
+        self._apply_config(coredns_sal)
         self.state.set('actions', 'start', 'ok')
         self.state.set('status', 'running', 'ok')
 
@@ -99,7 +112,132 @@ class Coredns(TemplateBase):
         self.state.delete('status', 'running')
 
     def update_endpoint(self, etcd_endpoint):
+        """
+        Point coredns to new etcd endpoints. The new configuration is reloaded by the running
+        coredns so it keeps answering, coredns is only restarted if the reload fails
+        :param etcd_endpoint: space separated list of etcd endpoints
+        """
+        if etcd_endpoint == self.data['etcdEndpoint']:
+            return
         self.data['etcdEndpoint'] = etcd_endpoint
         self.state.check('actions', 'start', 'ok')
-        self._coredns_sal.stop()
-        self._coredns_sal.start()
+        coredns_sal = self._coredns_sal
+        try:
+            self._reload_config(coredns_sal)
+        except Exception:
+            self.logger.exception('Failed to reload coredns %s configuration, restart it', self.name)
+            coredns_sal.stop()
+            coredns_sal.start()
+            self._apply_config(coredns_sal)
+
+    def _apply_config(self, coredns_sal):
+        """
+        Reload the configuration of a coredns that was just started. Right after its start the coredns process
+        can be missing from the process list or its command line incomplete, the reload is then left to _monitor
+        """
+        try:
+            self._reload_config(coredns_sal)
+        except Exception as err:
+            self.logger.warning('Failed to reload coredns %s configuration, retry on the next monitor: %s', self.name, err)
+            self._reload_pending = True
+        else:
+            self._reload_pending = False
+
+    def _reload_config(self, coredns_sal):
+        """
+        Point the Corefile of the running coredns to the etcd endpoints, enable the cache plugin
+        and tell coredns to reload it. Nothing is reloaded if the Corefile didn't change
+        :raises RuntimeError: if coredns is not running, or stopped after the reload
+        """
+        container = coredns_sal.container
+        process = coredns_process(container)
+        if process is None:
+            raise RuntimeError('coredns {} is not running'.format(self.name))
+        path = corefile_path(process['cmdline'])
+        current = container.download_content(path)
+        corefile = set_endpoint(current, self.data['etcdEndpoint'])
+        corefile = add_cache(corefile, self.data['cacheTtl'], self.data['cacheNegativeTtl'])
+        if corefile == current:
+            return
+        container.upload_content(path, corefile)
+        # coredns reloads its configuration without dropping queries on SIGUSR1
+        container.client.process.kill(process['pid'], signal.SIGUSR1)
+        gevent.sleep(RELOAD_CHECK_DELAY)
+        reloaded = coredns_process(container)
+        if reloaded is None or reloaded['pid'] != process['pid']:
+            raise RuntimeError('coredns {} stopped while reloading its configuration'.format(self.name))
+
+
+def coredns_process(container):
+    """
+    :return: the coredns process running in the container, None if it isn't running
+    """
+    for process in container.client.process.list():
+        if 'coredns' in process['cmdline']:
+            return process
+    return None
+
+
+def corefile_path(cmdline):
+    """
+    :param cmdline: command line of the coredns process
+    :return: path of the Corefile coredns was started with
+    """
+    args = cmdline.split()
+    if '-conf' not in args or args.index('-conf') == len(args) - 1:
+        raise RuntimeError('coredns was started without -conf, its Corefile is unknown')
+    return args[args.index('-conf') + 1]
+
+
+def set_endpoint(corefile, etcd_endpoint):
+    """
+    Point the etcd plugin of a Corefile to other etcd endpoints
+    :param corefile: content of the Corefile
+    :param etcd_endpoint: space separated list of etcd endpoints
+    :return: content of the Corefile with the endpoints
+    """
+    lines = []
+    for line in corefile.splitlines():
+        if line.split()[:1] == ['endpoint']:
+            line = '{}endpoint {}'.format(line[:len(line) - len(line.lstrip())], etcd_endpoint)
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def add_cache(corefile, ttl, negative_ttl):
+    """
+    Enable the cache plugin in every server block of a Corefile that doesn't use it yet.
+    coredns refuses a server block with the cache plugin twice
+    :param corefile: content of the Corefile
+    :param ttl: maximum time in seconds the positive answers are cached
+    :param negative_ttl: maximum time in seconds the negative answers are cached
+    :return: content of the Corefile with the cache plugin
+    """
+    cache = [
+        '    cache {} {{'.format(ttl),
+        '        success {} {}'.format(CACHE_CAPACITY, ttl),
+        '        denial {} {}'.format(CACHE_CAPACITY, negative_ttl),
+        '    }',
+    ]
+    lines = []
+    block = []
+    has_cache = False
+    depth = 0
+    for line in corefile.splitlines():
+        if depth == 0:
+            lines.append(line)
+            if line.rstrip().endswith('{'):
+                block = []
+                has_cache = False
+        else:
+            if depth == 1 and line.split()[:1] == ['cache']:
+                has_cache = True
+            block.append(line)
+        depth += line.count('{') - line.count('}')
+        if depth == 0 and block:
+            if not has_cache:
+                lines.extend(cache)
+            lines.extend(block)
+            block = []
+    lines.extend(block)
+    return '\n'.join(lines)
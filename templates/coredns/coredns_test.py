@@ -0,0 +1,142 @@
+import os
+import signal
+from unittest.mock import MagicMock, patch
+
+import pytest
+from JumpscaleZrobot.test.utils import ZrobotBaseTest
+from coredns import CACHE_CAPACITY, Coredns, add_cache, corefile_path, set_endpoint
+
+COREFILE = """. {
+    etcd grid.tf {
+        path /hosts
+        endpoint http://172.22.0.1:2379
+    }
+    loadbalance
+}"""
+
+
+class TestCorednsTemplate(ZrobotBaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        super().preTest(os.path.dirname(__file__), Coredns)
+
+    def setUp(self):
+        patch('jumpscale.j.clients', MagicMock()).start()
+        patch('gevent.sleep', MagicMock()).start()
+        self.valid_data = {
+            'etcdEndpoint': 'http://172.22.0.1:2379',
+            'etcdPassword': 'password',
+            'nics': [{'name': 'zt', 'type': 'zerotier', 'id': '1d719394044ed153', 'ztClient': 'zt'}],
+            'backplane': 'backplane',
+            'domain': 'grid.tf',
+            'cacheTtl': 300,
+            'cacheNegativeTtl': 30,
+        }
+
+    def tearDown(self):
+        patch.stopall()
+
+    def _coredns(self, processes):
+        coredns = Coredns(name='coredns', data=self.valid_data)
+        coredns.state.set('actions', 'start', 'ok')
+        coredns_sal = MagicMock()
+        coredns_sal.container.download_content.return_value = COREFILE
+        coredns_sal.container.client.process.list.side_effect = processes
+        patch('jumpscale.j.sal_zos.coredns.get', MagicMock(return_value=coredns_sal)).start()
+        return coredns, coredns_sal
+
+    def test_add_cache(self):
+        corefile = add_cache(COREFILE, 300, 30)
+        lines = corefile.splitlines()
+        assert lines[:5] == [
+            '. {',
+            '    cache 300 {',
+            '        success {} 300'.format(CACHE_CAPACITY),
+            '        denial {} 30'.format(CACHE_CAPACITY),
+            '    }',
+        ]
+        assert lines[5:] == COREFILE.splitlines()[1:]
+
+    def test_add_cache_existing(self):
+        corefile = add_cache(COREFILE, 300, 30)
+        assert add_cache(corefile, 300, 30) == corefile
+
+        # blocks that already use the cache plugin are left as they are
+        corefile = '. {\n    cache 10\n    forward . 8.8.8.8\n}\nother:53 {\n    forward . 1.1.1.1\n}'
+        lines = add_cache(corefile, 300, 30).splitlines()
+        assert lines[:4] == ['. {', '    cache 10', '    forward . 8.8.8.8', '}']
+        assert lines[5] == '    cache 300 {'
+        assert len([line for line in lines if line.split()[:1] == ['cache']]) == 2
+
+    def test_set_endpoint(self):
+        corefile = set_endpoint(COREFILE, 'http://172.22.0.1:2379 http://172.22.0.2:2379')
+        assert '        endpoint http://172.22.0.1:2379 http://172.22.0.2:2379' in corefile.splitlines()
+        assert len(corefile.splitlines()) == len(COREFILE.splitlines())
+
+    def test_corefile_path(self):
+        assert corefile_path('/bin/coredns -conf /etc/coredns/Corefile -pidfile /run/coredns.pid') == '/etc/coredns/Corefile'
+        with pytest.raises(RuntimeError):
+            corefile_path('/bin/coredns')
+
+    def test_update_endpoint(self):
+        process = {'pid': 10, 'cmdline': '/bin/coredns -conf /etc/coredns/Corefile'}
+        coredns, coredns_sal = self._coredns([[process], [process]])
+        coredns.update_endpoint('http://172.22.0.2:2379')
+
+        container = coredns_sal.container
+        path, corefile = container.upload_content.call_args[0]
+        assert path == '/etc/coredns/Corefile'
+        assert 'endpoint http://172.22.0.2:2379' in corefile
+        assert 'cache 300 {' in corefile
+        container.client.process.kill.assert_called_once_with(10, signal.SIGUSR1)
+        coredns_sal.stop.assert_not_called()
+
+    def test_update_endpoint_unchanged(self):
+        coredns, coredns_sal = self._coredns([])
+        coredns.update_endpoint(self.valid_data['etcdEndpoint'])
+        coredns_sal.container.upload_content.assert_not_called()
+
+    def test_update_endpoint_reload_failure(self):
+        process = {'pid': 10, 'cmdline': '/bin/coredns -conf /etc/coredns/Corefile'}
+        restarted = {'pid': 11, 'cmdline': '/bin/coredns -conf /etc/coredns/Corefile'}
+        # coredns stops on the reload, it is restarted
+        coredns, coredns_sal = self._coredns([[process], [], [restarted], [restarted]])
+        coredns_sal.container.download_content.side_effect = [COREFILE, add_cache(COREFILE, 300, 30)]
+        coredns.update_endpoint('http://172.22.0.2:2379')
+
+        coredns_sal.stop.assert_called_once_with()
+        coredns_sal.start.assert_called_once_with()
+        assert coredns_sal.container.client.process.kill.call_count == 2
+
+    def test_reload_not_running(self):
+        coredns, coredns_sal = self._coredns([[{'pid': 1, 'cmdline': 'sh'}]])
+        with pytest.raises(RuntimeError):
+            coredns._reload_config(coredns_sal)
+        coredns_sal.container.upload_content.assert_not_called()
+
+    def test_start_not_listed(self):
+        """
+        Test start succeeds when coredns is not listed yet, the configuration is reloaded by the monitor
+        """
+        process = {'pid': 10, 'cmdline': '/bin/coredns -conf /etc/coredns/Corefile'}
+        coredns, coredns_sal = self._coredns([[], [process], [process]])
+        coredns.state.set('actions', 'install', 'ok')
+        coredns.start()
+        coredns.state.check('status', 'running', 'ok')
+        coredns_sal.container.upload_content.assert_not_called()
+
+        coredns_sal.is_running.return_value = True
+        coredns._monitor()
+        coredns_sal.container.upload_content.assert_called_once()
+        coredns_sal.deploy.assert_called_once_with()
+
+        coredns._monitor()
+        assert coredns_sal.container.client.process.list.call_count == 3
+
+    def test_start_without_conf(self):
+        coredns, coredns_sal = self._coredns([[{'pid': 10, 'cmdline': '/bin/coredns'}]])
+        coredns.state.set('actions', 'install', 'ok')
+        coredns.start()
+        coredns.state.check('actions', 'start', 'ok')
+        coredns_sal.container.download_content.assert_not_called()
@@ -2,6 +2,7 @@ import copy
 import random
 from urllib.parse import urlparse
 
+from gevent.pool import Pool
 from requests import HTTPError
 
 from jumpscale import j
@@ -16,6 +17,8 @@ DM_VM_UID = 'github.com/threefoldtech/0-templates/dm_vm/0.0.1'
 
 
 BASEPORT = 10000
+MAX_PORT = 65535
+VM_IP_CONCURRENCY = 10
 
 
 class DmGateway(TemplateBase):
@@ -26,6 +29,8 @@ class DmGateway(TemplateBase):
         super().__init__(name=name, guid=guid, data=data)
         self.add_delete_callback(self.uninstall)
         self._robot_url = None
+        # last info received from the gateway services, by service guid
+        self._gwinfos = {}
 
     def validate(self):
         if not self.data['nodeId']:
@@ -83,8 +88,7 @@ class DmGateway(TemplateBase):
 
         gwservice = self._robot_api.services.find_or_create(GW_UID, self.guid, gwdata)
         gwservice.schedule_action('install').wait(die=True)
-        self._update_portforwards(gwservice, pgwservice)
-        self._update_proxies(gwservice, pgwservice)
+        self._reconcile(gwservice, pgwservice)
 
     def _lookup_by_name(self, collection, name, data=None):
         data = data or self.data
@@ -95,7 +99,7 @@ class DmGateway(TemplateBase):
     def _get_info(self, gwservice, pgwservice):
         gwservice = gwservice or self._get_gw_service()
         pgwservice = pgwservice or self._get_pgw_service()
-        gwinfo = gwservice.schedule_action('info').wait(die=True).result
+        gwinfo = self._gateway_info(gwservice)
 
         for network in gwinfo['networks']:
             if network['public']:
@@ -106,128 +110,138 @@ class DmGateway(TemplateBase):
         return {'gwservice': gwservice, 'pgwservice': pgwservice,
                 'ztip': ztip, 'gwinfo': gwinfo}
 
-    def _update_portforwards(self, gwservice=None, pgwservice=None):
+    def _gateway_info(self, gwservice):
+        """
+        Get the info of the gateway service. The generation of the last info received is sent
+        along so the gateway only returns its full info when it changed since
+        """
+        cached = self._gwinfos.get(gwservice.guid)
+        if cached:
+            args = {'generation': cached['generation']}
+            gwinfo = gwservice.schedule_action('info', args=args).wait(die=True).result
+        else:
+            gwinfo = gwservice.schedule_action('info').wait(die=True).result
+        if cached and gwinfo.get('unchanged'):
+            return cached
+        if 'generation' in gwinfo:
+            self._gwinfos[gwservice.guid] = gwinfo
+        return gwinfo
+
+    def _reconcile(self, gwservice=None, pgwservice=None):
+        """
+        Bring the portforwards and http proxies of the node gateway and the public gateway in line
+        with self.data. The desired configuration is diffed against the actual one and the changes
+        are pushed as a single batch to each gateway
+        """
         info = self._get_info(gwservice, pgwservice)
         gwservice = info['gwservice']
         pgwservice = info['pgwservice']
         ztip = info['ztip']
         gwinfo = info['gwinfo']
-        tobeconfigured = self.data['portforwards'][:]
+        pgwinfo = pgwservice.schedule_action('info').wait(die=True).result
+
+        vms = [forward['vm'] for forward in self.data['portforwards']]
+        vms.extend(destination['vm'] for proxy in self.data['httpproxies'] for destination in proxy['destinations'])
+        vmips = self._get_vm_ips(vms)
+
+        # node gateway: forwards from the public gateway network to the vms
+        desired = {}
+        for forward in self.data['portforwards']:
+            desired['forward_{}'.format(forward['name'])] = {
+                'dstip': vmips[forward['vm']],
+                'dstport': forward['dstport'],
+                'protocols': forward['protocols'],
+            }
+        for proxy in self.data['httpproxies']:
+            for destination in proxy['destinations']:
+                desired['proxy_{}_{}'.format(proxy['name'], destination['vm'])] = {
+                    'dstip': vmips[destination['vm']],
+                    'dstport': destination['port'],
+                    'protocols': ['tcp'],
+                }
 
-        # remove forwards we don't want anymore
         usedports = set()
+        gw_remove = []
+        ports = {}
         for actualforward in gwinfo['portforwards']:
-            type_, _, fwdname = actualforward['name'].partition('_')
-            if type_ != 'forward':
+            usedports.add(actualforward.get('srcport'))
+            name = actualforward['name']
+            if name.partition('_')[0] not in ('forward', 'proxy'):
                 continue
-            configuredforward = self._lookup_by_name('portforwards', fwdname)
-            if not configuredforward:
-                gwservice.schedule_action('remove_portforward', args={'name': actualforward['name']}).wait(die=True)
-                pgwservice.schedule_action('remove_portforward', args={'name': fwdname}).wait(die=True)
+            if name in desired and not differs(actualforward, desired[name]):
+                ports[name] = actualforward['srcport']
             else:
-                usedports.add(actualforward['srcport'])
-                tobeconfigured.remove(configuredforward)
-        # add forwards
-        vmips = {}
-        for forward in tobeconfigured:
-            vmname = forward['vm']
-            if vmname not in vmips:
-                vmips[vmname] = self._get_vm_ip(vmname)
-            port = BASEPORT
-            while port in usedports:
-                port += 1
-            usedports.add(port)
-            pgwforward = {
+                gw_remove.append(actualforward)
+
+        # the ports of the removed forwards are not reused in the same batch so the public gateway
+        # never points to another vm while it is being updated
+        allocator = PortAllocator(usedports)
+        gw_add = []
+        for name, forward in desired.items():
+            if name not in ports:
+                ports[name] = allocator.allocate()
+                gw_add.append(dict(forward, name=name, srcnetwork='publicgw', srcport=ports[name]))
+
+        # public gateway: forwards and proxies to the ports of the node gateway
+        pgw_forwards = {}
+        for forward in self.data['portforwards']:
+            pgw_forwards[forward['name']] = {
                 'name': forward['name'],
                 'srcport': forward['srcport'],
-                'dstport': port,
+                'dstport': ports['forward_{}'.format(forward['name'])],
                 'dstip': ztip,
                 'protocols': forward['protocols'],
             }
-            pgwservice.schedule_action('add_portforward', args={'forward': pgwforward}).wait(die=True)
-            gwforward = {
-                'name': 'forward_{}'.format(forward['name']),
-                'srcnetwork': 'publicgw',
-                'srcport': port,
-                'dstport': forward['dstport'],
-                'dstip': vmips[vmname],
-                'protocols': forward['protocols'],
-            }
-            try:
-                gwservice.schedule_action('add_portforward', args={'forward': gwforward}).wait(die=True)
-            except:
-                pgwservice.schedule_action('remove_portforward', args={'name': pgwforward['name']}).wait(die=True)
-                raise
-
-    def _update_proxies(self, gwservice=None, pgwservice=None):
-        info = self._get_info(gwservice, pgwservice)
-        gwservice = info['gwservice']
-        pgwservice = info['pgwservice']
-        ztip = info['ztip']
-        pgwinfo = pgwservice.schedule_action('info').wait(die=True).result
-
-        tobeconfigured = self.data['httpproxies'][:]
-
-        # remove proxies
-        toremoveforwards = []
-        for actualproxy in pgwinfo['httpproxies']:
-            name = actualproxy['name']
-            configuredproxy = self._lookup_by_name('httpproxies', name)
-            if not configuredproxy:
-                pgwservice.schedule_action('remove_http_proxy', args={'name': name}).wait(die=True)
-                toremoveforwards.append(name)
-            else:
-                tobeconfigured.remove(configuredproxy)
-
-        gwinfo = gwservice.schedule_action('info').wait(die=True).result
-        usedports = set()
-        for actualforward in gwinfo['portforwards']:
-            removed = False
-            for fwdname in toremoveforwards:
-                if actualforward['name'].startswith('proxy_{}'.format(fwdname)):
-                    gwservice.schedule_action('remove_portforward', args={'name': actualforward['name']}).wait(die=True)
-                    removed = True
-                    break
-            if not removed:
-                usedports.add(actualforward['srcport'])
-
-        # Add proxies
-        vmips = {}
-        for proxy in tobeconfigured:
-            pproxy = {
+        pgw_proxies = {}
+        for proxy in self.data['httpproxies']:
+            destinations = []
+            for destination in proxy['destinations']:
+                port = ports['proxy_{}_{}'.format(proxy['name'], destination['vm'])]
+                destinations.append('http://{}:{}'.format(ztip, port))
+            pgw_proxies[proxy['name']] = {
                 'host': proxy['host'],
                 'types': proxy['types'],
                 'name': proxy['name'],
-                'destinations': [],
+                'destinations': destinations,
+            }
+        remove_forwards, add_forwards = diff(pgwinfo.get('portforwards', []), pgw_forwards)
+        remove_proxies, add_proxies = diff(pgwinfo.get('httpproxies', []), pgw_proxies)
+
+        gw_changed = bool(gw_add or gw_remove)
+        if gw_changed:
+            args = {'add': gw_add, 'remove': [forward['name'] for forward in gw_remove]}
+            gwservice.schedule_action('apply_portforwards', args=args).wait(die=True)
+
+        if remove_forwards or add_forwards or remove_proxies or add_proxies:
+            args = {
+                'add_portforwards': add_forwards,
+                'remove_portforwards': remove_forwards,
+                'add_httpproxies': add_proxies,
+                'remove_httpproxies': remove_proxies,
             }
-            fwdnames = []
-            for destination in proxy['destinations']:
-                vmname = destination['vm']
-                if vmname not in vmips:
-                    vmips[vmname] = self._get_vm_ip(vmname)
-                port = BASEPORT
-                while port in usedports:
-                    port += 1
-                usedports.add(port)
-                fwdname = 'proxy_{}_{}'.format(proxy['name'], vmname)
-                forward = {
-                    'name': fwdname,
-                    'srcport': port,
-                    'srcnetwork': 'publicgw',
-                    'dstip': vmips[vmname],
-                    'dstport': destination['port'],
-                    'protocols': ['tcp'],
-                }
-                gwservice.schedule_action('add_portforward', args={'forward': forward}).wait(die=True)
-                fwdnames.append(fwdname)
-                pproxy['destinations'].append('http://{}:{}'.format(ztip, port))
             try:
-                pgwservice.schedule_action('add_http_proxy', args={'proxy': pproxy}).wait(die=True)
+                pgwservice.schedule_action('apply_changes', args=args).wait(die=True)
             except:
-                for fwd in fwdnames:
-                    gwservice.schedule_action('remove_portforward', args={'name': fwd}).wait(die=True)
+                if gw_changed:
+                    self.logger.error('Failed to update the public gateway, restoring the gateway portforwards')
+                    args = {'add': gw_remove, 'remove': [forward['name'] for forward in gw_add]}
+                    gwservice.schedule_action('apply_portforwards', args=args).wait(die=True)
                 raise
 
+    def _get_vm_ips(self, vms):
+        """
+        Resolve the ips of the vms concurrently
+        :param vms: names of the vms
+        :return: dict with the ip of each vm
+        """
+        pool = Pool(VM_IP_CONCURRENCY)
+        greenlets = {vm: pool.spawn(self._get_vm_ip, vm) for vm in set(vms)}
+        pool.join()
+        for greenlet in greenlets.values():
+            if greenlet.exception:
+                raise greenlet.exception
+        return {vm: greenlet.value for vm, greenlet in greenlets.items()}
+
     def _get_vm_ip(self, vm):
         vmservice = self.api.services.get(name=vm, template_uid=DM_VM_UID)
         info = vmservice.schedule_action('info').wait(die=True).result
@@ -255,7 +269,7 @@ class DmGateway(TemplateBase):
         forward['protocols'] = forward.get('protocols', ['tcp'])
         self.data.setdefault('portforwards', []).append(forward)
         try:
-            self._update_portforwards()
+            self._reconcile()
         except:
             self.data['portforwards'].remove(forward)
             raise
@@ -264,12 +278,12 @@ class DmGateway(TemplateBase):
         forward = self._lookup_by_name('portforwards', name)
         if forward:
             self.data['portforwards'].remove(forward)
-            self._update_portforwards()
+            self._reconcile()
 
     def add_http_proxy(self, proxy):
         self.data.setdefault('httpproxies', []).append(proxy)
         try:
-            self._update_proxies()
+            self._reconcile()
         except:
             self.data['httpproxies'].remove(proxy)
             raise
@@ -278,7 +292,7 @@ class DmGateway(TemplateBase):
         proxy = self._lookup_by_name('httpproxies', name)
         if proxy:
             self.data['httpproxies'].remove(proxy)
-            self._update_proxies()
+            self._reconcile()
 
     def add_network(self, network):
         if network.get('public'):
@@ -299,6 +313,7 @@ class DmGateway(TemplateBase):
         except:
             pass
         else:
+            self._gwinfos.pop(gwservice.guid, None)
             gwservice.delete()
         try:
             pgwservice = self._get_pgw_service()
@@ -311,3 +326,60 @@ class DmGateway(TemplateBase):
                 zerotierservice = self.api.services.get(name=network['ztClient'])
                 data = {'url': self._robot_url, 'name': self.guid}
                 zerotierservice.schedule_action('remove_from_robot', args=data).wait(die=True)
+
+
+class PortAllocator:
+    """
+    Hand out the free ports of the gateway from BASEPORT upwards
+    """
+
+    def __init__(self, used, start=BASEPORT, end=MAX_PORT):
+        self._used = set(used)
+        self._next = start
+        self._end = end
+
+    def allocate(self):
+        port = self._next
+        while port in self._used:
+            port += 1
+        if port > self._end:
+            raise RuntimeError('No free port left on the gateway')
+        self._used.add(port)
+        self._next = port + 1
+        return port
+
+
+def differs(actual, desired):
+    """
+    Check if an item differs from the desired one on the keys of the desired item,
+    lists are compared regardless of their order
+    """
+    for key, value in desired.items():
+        current = actual.get(key)
+        if isinstance(value, list):
+            if sorted(current or []) != sorted(value):
+                return True
+        elif current != value:
+            return True
+    return False
+
+
+def diff(actual, desired):
+    """
+    Compute the changes needed to go from the actual items to the desired ones
+    :param actual: list of the actual items
+    :param desired: dict of the desired items by name
+    :return: tuple with the list of names to remove and the list of items to add
+    """
+    remove = []
+    add = []
+    kept = set()
+    for item in actual:
+        if item['name'] not in desired or differs(item, desired[item['name']]):
+            remove.append(item['name'])
+        else:
+            kept.add(item['name'])
+    for name, item in desired.items():
+        if name not in kept:
+            add.append(item)
+    return remove, add
@@ -6,7 +6,7 @@ from urllib.parse import urlparse
 import pytest
 from requests import HTTPError
 
-from dm_gateway import PUBLIC_GW_ROBOTS, DmGateway
+from dm_gateway import PUBLIC_GW_ROBOTS, DmGateway, PortAllocator
 from jumpscale import j
 from JumpscaleZrobot.test.utils import ZrobotBaseTest
 
@@ -132,8 +132,8 @@ class TestGatewayTemplate(ZrobotBaseTest):
         portforward = {'name': 'pf', 'vm': 'myvm', 'dstport': 22, 'srcport': 22, 'protocols': ['tcp']}
         self.service.add_portforward(portforward)
         assert self.service.data['portforwards'] == [portforward]
-        self.gateway.schedule_action.assert_any_call('add_portforward', args=AlwaysTrue())
-        self.public_gateway.schedule_action.assert_any_call('add_portforward', args=AlwaysTrue())
+        self.gateway.schedule_action.assert_any_call('apply_portforwards', args=AlwaysTrue())
+        self.public_gateway.schedule_action.assert_any_call('apply_changes', args=AlwaysTrue())
 
     def list_name_contains(self, datalist, name):
         for item in datalist:
@@ -143,11 +143,17 @@ class TestGatewayTemplate(ZrobotBaseTest):
 
     def test_remove_portforward(self):
         self.test_add_portforward()
-        self.gateway_info['portforwards'].append({'name': 'forward_pf'})
+        self.gateway_info['portforwards'].append({'name': 'forward_pf', 'srcport': 10000})
+        self.public_gateway_info['portforwards'] = [{'name': 'pf'}]
         self.service.remove_portforward('pf')
         assert not self.list_name_contains(self.service.data['portforwards'], 'pf')
-        self.gateway.schedule_action.assert_any_call('remove_portforward', args={'name': 'forward_pf'})
-        self.public_gateway.schedule_action.assert_any_call('remove_portforward', args={'name': 'pf'})
+        self.gateway.schedule_action.assert_any_call('apply_portforwards', args={'add': [], 'remove': ['forward_pf']})
+        self.public_gateway.schedule_action.assert_any_call('apply_changes', args={
+            'add_portforwards': [],
+            'remove_portforwards': ['pf'],
+            'add_httpproxies': [],
+            'remove_httpproxies': [],
+        })
 
     def test_add_proxy(self):
         data = copy.deepcopy(self.valid_data)
@@ -157,8 +163,8 @@ class TestGatewayTemplate(ZrobotBaseTest):
         proxy = {'name': 'myproxy', 'destinations': [{'vm': 'myvm', 'port': 8282}], 'host': '172.19.0.1', 'types': ['http']}
         self.service.add_http_proxy(proxy)
         assert self.service.data['httpproxies'] == [proxy]
-        self.public_gateway.schedule_action.assert_any_call('add_http_proxy', args=AlwaysTrue())
-        self.gateway.schedule_action.assert_any_call('add_portforward', args=AlwaysTrue())
+        self.public_gateway.schedule_action.assert_any_call('apply_changes', args=AlwaysTrue())
+        self.gateway.schedule_action.assert_any_call('apply_portforwards', args=AlwaysTrue())
 
     def test_remove_proxy(self):
         self.test_add_proxy()
@@ -166,5 +172,31 @@ class TestGatewayTemplate(ZrobotBaseTest):
         self.gateway_info['portforwards'].append({'name': 'proxy_myproxy_myvm'})
         self.service.remove_http_proxy('myproxy')
         assert not self.list_name_contains(self.service.data['httpproxies'], 'myproxy')
-        self.public_gateway.schedule_action.assert_any_call('remove_http_proxy', args={'name': 'myproxy'})
-        self.gateway.schedule_action.assert_any_call('remove_portforward', args=AlwaysTrue())
+        self.public_gateway.schedule_action.assert_any_call('apply_changes', args={
+            'add_portforwards': [],
+            'remove_portforwards': [],
+            'add_httpproxies': [],
+            'remove_httpproxies': ['myproxy'],
+        })
+        self.gateway.schedule_action.assert_any_call('apply_portforwards', args={'add': [], 'remove': ['proxy_myproxy_myvm']})
+
+    def test_reconcile_no_changes(self):
+        data = copy.deepcopy(self.valid_data)
+        data['networks'] = [{'name': 'network', 'type': 'zerotier', 'id': PRIVATEZT}]
+        data['portforwards'] = [{'name': 'pf', 'vm': 'myvm', 'dstport': 22, 'srcport': 22, 'protocols': ['tcp']}]
+        self._mock_service(data)
+        self.service.validate()
+        member = j.clients.zerotier.get.return_value.network_get.return_value.member_get.return_value
+        member.private_ip = '10.0.0.2'
+        self.gateway_info['portforwards'].append(
+            {'name': 'forward_pf', 'srcport': 10000, 'dstip': '10.0.0.2', 'dstport': 22, 'protocols': ['tcp']})
+        self.public_gateway_info['portforwards'] = [
+            {'name': 'pf', 'srcport': 22, 'dstport': 10000, 'dstip': '172.18.0.1', 'protocols': ['tcp']}]
+        self.service._reconcile()
+        actions = [c[0][0] for c in self.gateway.schedule_action.call_args_list + self.public_gateway.schedule_action.call_args_list]
+        assert 'apply_portforwards' not in actions
+        assert 'apply_changes' not in actions
+
+    def test_port_allocator(self):
+        allocator = PortAllocator([10000, 10001, 10003])
+        assert [allocator.allocate() for _ in range(3)] == [10002, 10004, 10005]
@@ -1,4 +1,5 @@
 from copy import deepcopy
+from functools import partial
 
 import gevent
 from jumpscale import j
@@ -9,6 +10,9 @@ from zerorobot.template.state import StateCheckError
 
 ETCD_TEMPLATE_UID = 'github.com/threefoldtech/0-templates/etcd/0.0.1'
 ZT_TEMPLATE_UID = 'github.com/threefoldtech/0-templates/zerotier_client/0.0.1'
+CHECK_TIMEOUT = 10  # deadline of the health check and of the connection info of each etcd
+ACTION_TIMEOUT = 120  # deadline of the actions run on each etcd
+HEALTH_LEVELS = ('healthy', 'degraded', 'lost_quorum')
 
 
 class EtcdCluster(TemplateBase):
@@ -52,15 +56,60 @@ class EtcdCluster(TemplateBase):
         except StateCheckError:
             return
 
+        results = self._gather(lambda etcd: etcd.state.check('status', 'running', 'ok'), CHECK_TIMEOUT)
+        failed = []
+        for name, (_, err) in results.items():
+            if err is not None:
+                self.logger.error('etcd %s is not running: %s', name, err)
+                failed.append(name)
+            self.state.set('members', name, 'error' if name in failed else 'ok')
+
+        # the cluster keeps working as long as a majority of the etcds are running
+        if not failed:
+            health = 'healthy'
+        elif len(results) - len(failed) > len(results) // 2:
+            health = 'degraded'
+        else:
+            health = 'lost_quorum'
+        for level in HEALTH_LEVELS:
+            if level == health:
+                self.state.set('health', level, 'ok')
+            else:
+                self.state.delete('health', level)
+        self.state.set('status', 'running', 'error' if health == 'lost_quorum' else 'ok')
+
+    def _etcd_service(self, etcd):
+        robot = self.api.robots.get(etcd['node'], etcd['url'])
+        return robot.services.get(template_uid=ETCD_TEMPLATE_UID, name=etcd['name'])
+
+    def _gather(self, func, timeout=ACTION_TIMEOUT):
+        """
+        Call func on all the etcds of the cluster concurrently, each call with its own deadline
+        :param func: function called with the etcd service
+        :param timeout: deadline of each call in seconds
+        :return: dict with for each etcd name a tuple (result, exception), exception is None if the call succeeded
+        """
+        def call(etcd):
+            return func(self._etcd_service(etcd))
+
+        return gather({etcd['name']: partial(call, etcd) for etcd in self.data['etcds']}, timeout)
+
+    def _gather_action(self, action, args=None):
+        """
+        Run an action on all the etcds of the cluster concurrently
+        :return: dict with the result of the action for each etcd name
+        :raises RuntimeError: if the action failed on any etcd, after it ran on all of them
+        """
+        results = self._gather(lambda etcd: etcd.schedule_action(action, args=args).wait(die=True).result)
+        failed = []
         for etcd in self.data['etcds']:
-            robot = self.api.robots.get(etcd['node'], etcd['url'])
-            service = robot.services.get(template_uid=ETCD_TEMPLATE_UID, name=etcd['name'])
-            try:
-                service.state.check('status', 'running', 'ok')
-            except StateCheckError:
-                self.state.set('status', 'running', 'error')
-                return
-        self.state.set('status', 'running', 'ok')
+            err = results[etcd['name']][1]
+            if err is not None:
+                self.logger.error('%s failed on etcd %s: %s', action, etcd['name'], err)
+                failed.append(etcd['name'])
+        if failed:
+            raise RuntimeError('{} failed on etcds {}'.format(action, ', '.join(failed)))
+        return {name: result for name, (result, _) in results.items()}
 
     def _ensure_etcds_connections(self):
         try:
@@ -70,19 +119,13 @@ class EtcdCluster(TemplateBase):
 
         self.logger.info("verify etcds connections")
 
-        # gather all the etcd services
-        etcds = []
-        for etcd in self.data['etcds']:
-            robot = self.api.robots.get(etcd['node'], etcd['url'])
-            etcds.append(robot.services.get(template_uid=ETCD_TEMPLATE_UID, name=etcd['name']))
-
-        connection = cluster_connection(etcds)
+        connections = self._gather_action('connection_info').values()
+        connection = ','.join(sorted([connection['cluster_entry'] for connection in connections]))
         if not self.data.get('clusterConnections'):
             self.data['clusterConnections'] = connection
 
         if connection != self.data['clusterConnections']:
-            for etcd in etcds:
-                etcd.schedule_action('update_cluster', args={'cluster': connection}).wait(die=True)
+            self._gather_action('update_cluster', args={'cluster': connection})
         self.data['clusterConnections'] = connection
 
     def _deploy_etcd_cluster(self):
@@ -113,38 +156,35 @@ class EtcdCluster(TemplateBase):
         return deployed_etcds
 
     def _deploy_etcds(self, required_etcds):
-        nodes = list(self._nodes())
+        """
+        Deploy required_etcds etcds in parallel, each one on a different node.
+        The candidates are the online nodes of the farm that don't host an etcd of the cluster yet,
+        the least used ones first. When a deployment fails, its node is dropped and the next candidate is used.
+
+        This function yields (etcd, node) as the etcds are deployed.
+        It returns once required_etcds etcds have been deployed or if there is no candidate node left.
+        """
+        used_nodes = {etcd['node'] for etcd in self.data['etcds']}
+        nodes = sort_etcd_node_candidates([node for node in self._nodes() if node['node_id'] not in used_nodes])
+        self.logger.info('number of possible nodes to use for etcd deployments %s', len(nodes))
+
         nr_deployed_etcds = 0
-        etcds = []
+        gls = set()
         while nr_deployed_etcds < required_etcds:
-            for i in range(required_etcds - nr_deployed_etcds):
-                self.logger.info('number of possible nodes to use for namespace deployments %s', len(nodes))
-                if len(nodes) <= 0:
-                    return etcds
-                node = nodes[i % len(nodes)]
+            while nodes and nr_deployed_etcds + len(gls) < required_etcds:
+                node = nodes.pop(0)
                 self.logger.info("try to install etcd on node %s" % node['node_id'])
-                try:
-                    etcds.append(self._install_etcd(node))
+                gls.add(gevent.spawn(self._install_etcd, node))
+            if not gls:
+                return
+
+            for g in gevent.wait(gls, count=1):
+                gls.remove(g)
+                if g.exception:
+                    self.logger.error('Installing etcd failed: %s', g.exception)
+                else:
                     nr_deployed_etcds += 1
-                except BaseException as err:
-                    self.logger.error('Installing etcd on node %s failed: %s' % (node['node_id'], err))
-                    nodes.remove(node)
-        return etcds
-
-        # gls = set()
-        # for i in range(required_etcds - nr_deployed_etcds):
-        #     node = nodes[i % len(nodes)]
-        #     self.logger.info("try to install etcd on node %s" % node['node_id'])
-        #     gls.add(gevent.spawn(self._install_etcd, node=node))
-
-        # for g in gevent.iwait(gls):
-        #     if g.exception and g.exception.node in nodes:
-        #         self.logger.error("we could not deploy on node %s, remove it from the possible node to use", node['node_id'])
-        #         nodes.remove(g.exception.node)
-        #     else:
-        #         etcd, node = g.value
-        #         nr_deployed_etcds += 1
-        #         yield (etcd, node)
+                    yield g.value
 
     def _create_zt_clients(self, nics, node_url):
         result = deepcopy(nics)
@@ -213,7 +253,12 @@ class EtcdCluster(TemplateBase):
         self.state.set('status', 'running', 'ok')
 
     def uninstall(self):
-        # uninstall and delete all the created etcds
+        """
+        Uninstall and delete all the etcds of the cluster concurrently.
+        Every etcd is removed from self.data['etcds'] once it is deleted,
+        so calling uninstall again after a failure only deletes the remaining ones
+        """
+        @retry(Exception, tries=3, delay=5, backoff=2)
         def delete_etcd(etcd):
             self.logger.info("deleting etcd %s on node %s", etcd['node'], etcd['url'])
             robot = self.api.robots.get(etcd['node'], etcd['url'])
@@ -227,65 +272,92 @@ class EtcdCluster(TemplateBase):
 
             if etcd in self.data['etcds']:
                 self.data['etcds'].remove(etcd)
+            self.save()
 
-        for etcd in list(self.data['etcds']):
-            delete_etcd(etcd)
-        # group = gevent.pool.Group()
-        # group.imap_unordered(delete_etcd, self.data['etcds'])
-        # group.join()
+        gls = [gevent.spawn(delete_etcd, etcd) for etcd in list(self.data['etcds'])]
+        gevent.joinall(gls)
+        if self.data['etcds']:
+            names = ', '.join(etcd['name'] for etcd in self.data['etcds'])
+            raise RuntimeError('Failed to delete etcds {}'.format(names))
         self.data['clusterConnections'] = None
 
         self.state.delete('actions', 'install')
         self.state.delete('status', 'running')
 
     def start(self):
-        tasks = []
-        for etcd in self.data['etcds']:
-            robot = self.api.robots.get(etcd['node'], etcd['url'])
-            etcd = robot.services.get(template_uid=ETCD_TEMPLATE_UID, name=etcd['name'])
-            tasks.append(etcd.schedule_action('start'))
-
-        for task in tasks:
-            task.wait(die=True)
-
+        self._gather_action('start')
         self.state.set('actions', 'start', 'ok')
         self.state.set('status', 'running', 'ok')
 
     def stop(self):
-        tasks = []
-        for etcd in self.data['etcds']:
-            robot = self.api.robots.get(etcd['node'], etcd['url'])
-            etcd = robot.services.get(template_uid=ETCD_TEMPLATE_UID, name=etcd['name'])
-            tasks.append(etcd.schedule_action('stop'))
-
-        for task in tasks:
-            task.wait(die=True)
-
+        self._gather_action('stop')
         self.state.delete('actions', 'start')
         self.state.delete('status', 'running')
 
     def connection_info(self):
+        """
+        Connection info of the etcds of the cluster. The etcds that don't answer within CHECK_TIMEOUT
+        are left out of 'etcds' and their names listed in 'missing', so they don't hide the others
+        :raises RuntimeError: if none of the etcds answered
+        """
+        results = self._gather(lambda etcd: etcd.schedule_action('connection_info').wait(die=True).result,
+                               CHECK_TIMEOUT)
         etcds = []
+        missing = []
         for etcd in self.data['etcds']:
-            robot = self.api.robots.get(etcd['node'], etcd['url'])
-            etcds.append(robot.services.get(template_uid=ETCD_TEMPLATE_UID, name=etcd['name']))
-        connections = etcds_connection(etcds)
+            connection, err = results[etcd['name']]
+            if err is not None:
+                self.logger.error('failed to get the connection info of etcd %s: %s', etcd['name'], err)
+                missing.append(etcd['name'])
+            else:
+                etcds.append(connection)
+        if self.data['etcds'] and not etcds:
+            raise RuntimeError('Failed to get the connection info of all the etcds')
         return {
             'user': 'root',
             'password': self.data['password'],
-            'etcds': connections,
+            'etcds': etcds,
+            'missing': missing,
         }
 
 
+def sort_etcd_node_candidates(nodes):
+    """
+    to select candidate nodes for the etcds
+    we sort by the least used nodes in cpu and memory
+    """
+    def key(node):
+        return (node['used_resources']['cru'],
+                node['used_resources']['mru'],
+                -node['total_resources']['mru'])
+    return sorted(nodes, key=key)
+
+
 def cluster_connection(etcds):
     connections = etcds_connection(etcds)
     return ','.join(sorted([connection['cluster_entry'] for connection in connections]))
 
 
 def etcds_connection(etcds):
-    tasks = map(lambda etcd: etcd.schedule_action('connection_info'), etcds)
-    result = map(lambda task: task.wait(die=True).result, tasks)
-    return list(result)
+    # schedule all the actions before waiting so they run concurrently
+    tasks = [etcd.schedule_action('connection_info') for etcd in etcds]
+    return [task.wait(die=True).result for task in tasks]
+
+
+def gather(calls, timeout):
+    """
+    Run calls concurrently, each one with its own deadline
+    :param calls: dict of functions without arguments
+    :param timeout: deadline of each call in seconds
+    :return: dict with for each key of calls a tuple (result, exception), exception is None if the call succeeded
+    """
+    def run(call):
+        with gevent.Timeout(timeout):
+            return call()
+
+    greenlets = {key: gevent.spawn(run, call) for key, call in calls.items()}
+    gevent.joinall(list(greenlets.values()))
+    return {key: (greenlet.value, greenlet.exception) for key, greenlet in greenlets.items()}
 
 
 class EtcdDeployError(RuntimeError):
@@ -0,0 +1,275 @@
+from unittest.mock import MagicMock, patch
+import os
+import pytest
+
+import etcd_cluster
+from etcd_cluster import EtcdCluster
+from zerorobot.service_collection import ServiceNotFoundError
+from zerorobot.template.state import StateCheckError
+
+from JumpscaleZrobot.test.utils import ZrobotBaseTest, task_mock
+
+
+class TestEtcdClusterTemplate(ZrobotBaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        super().preTest(os.path.dirname(__file__), EtcdCluster)
+
+    def setUp(self):
+        self.valid_data = {
+            'farmerIyoOrg': 'farmer',
+            'nrEtcds': 3,
+            'password': 'password',
+            'token': 'token',
+            'nics': [{'name': 'zt', 'type': 'zerotier', 'ztClient': 'zt', 'id': 'id'}],
+            'etcds': [
+                {'name': 'etcd1', 'url': 'http://node1:6600', 'node': 'node1'},
+                {'name': 'etcd2', 'url': 'http://node2:6600', 'node': 'node2'},
+                {'name': 'etcd3', 'url': 'http://node3:6600', 'node': 'node3'},
+            ],
+            'clusterConnections': '',
+            'hostNetwork': False,
+        }
+        patch('jumpscale.j.sal_zos', MagicMock()).start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def _cluster(self):
+        """
+        etcd cluster whose etcd services are kept in self.etcds by name
+        """
+        cluster = EtcdCluster('cluster', data=self.valid_data)
+        self.etcds = {}
+        for etcd in self.valid_data['etcds']:
+            service = MagicMock()
+            service.schedule_action.return_value = task_mock({'cluster_entry': etcd['name']})
+            self.etcds[etcd['name']] = service
+        cluster._etcd_service = lambda etcd: self.etcds[etcd['name']]
+        return cluster
+
+    def test_connection_info(self):
+        cluster = self._cluster()
+        assert cluster.connection_info() == {
+            'user': 'root',
+            'password': 'password',
+            'etcds': [{'cluster_entry': 'etcd1'}, {'cluster_entry': 'etcd2'}, {'cluster_entry': 'etcd3'}],
+            'missing': [],
+        }
+
+    def test_connection_info_partial(self):
+        """
+        Test connection_info returns the etcds that answered and the names of the others
+        """
+        cluster = self._cluster()
+        self.etcds['etcd2'].schedule_action.side_effect = RuntimeError('etcd2 is unreachable')
+        info = cluster.connection_info()
+        assert info['etcds'] == [{'cluster_entry': 'etcd1'}, {'cluster_entry': 'etcd3'}]
+        assert info['missing'] == ['etcd2']
+
+    def test_connection_info_timeout(self):
+        cluster = self._cluster()
+        self.etcds['etcd1'].schedule_action.side_effect = lambda *args, **kwargs: etcd_cluster.gevent.sleep(1)
+        with patch.object(etcd_cluster, 'CHECK_TIMEOUT', 0.1):
+            info = cluster.connection_info()
+        assert info['missing'] == ['etcd1']
+
+    def test_connection_info_all_missing(self):
+        cluster = self._cluster()
+        for service in self.etcds.values():
+            service.schedule_action.side_effect = RuntimeError('unreachable')
+        with pytest.raises(RuntimeError, message='connection_info should fail if no etcd answered'):
+            cluster.connection_info()
+
+    def _monitored_cluster(self, down):
+        """
+        started etcd cluster whose etcds in down are not running
+        """
+        cluster = self._cluster()
+        cluster.state.set('actions', 'start', 'ok')
+        for name in down:
+            self.etcds[name].state.check.side_effect = StateCheckError('etcd is not running')
+        cluster._monitor()
+        return cluster
+
+    def _check_health(self, cluster, health):
+        cluster.state.check('health', health, 'ok')
+        for level in etcd_cluster.HEALTH_LEVELS:
+            if level != health:
+                with pytest.raises(StateCheckError):
+                    cluster.state.check('health', level, 'ok')
+
+    def test_monitor_healthy(self):
+        cluster = self._monitored_cluster([])
+        self._check_health(cluster, 'healthy')
+        for name in self.etcds:
+            cluster.state.check('members', name, 'ok')
+        cluster.state.check('status', 'running', 'ok')
+
+    def test_monitor_degraded(self):
+        """
+        Test the cluster is still running while a majority of its etcds are running
+        """
+        cluster = self._monitored_cluster(['etcd2'])
+        self._check_health(cluster, 'degraded')
+        cluster.state.check('members', 'etcd1', 'ok')
+        cluster.state.check('members', 'etcd2', 'error')
+        cluster.state.check('status', 'running', 'ok')
+
+    def test_monitor_lost_quorum(self):
+        cluster = self._monitored_cluster(['etcd1', 'etcd3'])
+        self._check_health(cluster, 'lost_quorum')
+        cluster.state.check('members', 'etcd2', 'ok')
+        cluster.state.check('status', 'running', 'error')
+
+    def test_monitor_recovered(self):
+        """
+        Test the previous health level is dropped when the cluster recovers
+        """
+        cluster = self._monitored_cluster(['etcd1', 'etcd3'])
+        for service in self.etcds.values():
+            service.state.check.side_effect = None
+        cluster._monitor()
+        self._check_health(cluster, 'healthy')
+        cluster.state.check('status', 'running', 'ok')
+
+    def test_monitor_timeout(self):
+        """
+        Test an etcd that doesn't answer within CHECK_TIMEOUT is counted as down
+        """
+        cluster = self._cluster()
+        cluster.state.set('actions', 'start', 'ok')
+        self.etcds['etcd3'].state.check.side_effect = lambda *args: etcd_cluster.gevent.sleep(1)
+        with patch.object(etcd_cluster, 'CHECK_TIMEOUT', 0.1):
+            cluster._monitor()
+        self._check_health(cluster, 'degraded')
+        cluster.state.check('members', 'etcd3', 'error')
+
+    def test_monitor_not_started(self):
+        cluster = self._cluster()
+        cluster._monitor()
+        for service in self.etcds.values():
+            service.state.check.assert_not_called()
+
+    def _node(self, node_id, cru=0, mru=0, total_mru=8):
+        return {'node_id': node_id, 'robot_address': 'http://%s:6600' % node_id,
+                'used_resources': {'cru': cru, 'mru': mru}, 'total_resources': {'mru': total_mru}}
+
+    def test_sort_etcd_node_candidates(self):
+        nodes = [self._node('busy', cru=4), self._node('small', mru=2, total_mru=4),
+                 self._node('big', mru=2, total_mru=16), self._node('idle')]
+        assert [node['node_id'] for node in etcd_cluster.sort_etcd_node_candidates(nodes)] == ['idle', 'big', 'small', 'busy']
+
+    def _deploying_cluster(self, nodes, failing=()):
+        """
+        etcd cluster deploying on nodes, the installation fails on the nodes in failing
+        """
+        self.valid_data['etcds'] = [{'name': 'etcd1', 'url': 'http://node1:6600', 'node': 'node1'}]
+        cluster = EtcdCluster('cluster', data=self.valid_data)
+        cluster._nodes = MagicMock(return_value=nodes)
+        self.installed = []
+
+        def install(node):
+            self.installed.append(node['node_id'])
+            if node['node_id'] in failing:
+                raise etcd_cluster.EtcdDeployError('install failed', node)
+            etcd = MagicMock()
+            etcd.name = 'etcd_%s' % node['node_id']
+            return etcd, node
+        cluster._install_etcd = install
+        return cluster
+
+    def test_deploy_etcds(self):
+        """
+        Test _deploy_etcds skips the nodes already used by the cluster and tries the least used nodes first
+        """
+        nodes = [self._node('node1'), self._node('node2', cru=2), self._node('node3', cru=1), self._node('node4', cru=3)]
+        cluster = self._deploying_cluster(nodes)
+        deployed = list(cluster._deploy_etcds(2))
+        assert sorted(etcd.name for etcd, _ in deployed) == ['etcd_node2', 'etcd_node3']
+        assert self.installed == ['node3', 'node2']
+
+    def test_deploy_etcds_failover(self):
+        """
+        Test a failed deployment is replaced by one on the next candidate node
+        """
+        nodes = [self._node('node2'), self._node('node3', cru=1), self._node('node4', cru=2)]
+        cluster = self._deploying_cluster(nodes, failing=['node2'])
+        deployed = list(cluster._deploy_etcds(2))
+        assert sorted(node['node_id'] for _, node in deployed) == ['node3', 'node4']
+        assert sorted(self.installed) == ['node2', 'node3', 'node4']
+
+    def test_deploy_etcds_no_candidate(self):
+        """
+        Test _deploy_etcds stops when there is no candidate node left
+        """
+        nodes = [self._node('node1'), self._node('node2'), self._node('node3')]
+        cluster = self._deploying_cluster(nodes, failing=['node3'])
+        deployed = list(cluster._deploy_etcds(2))
+        assert [node['node_id'] for _, node in deployed] == ['node2']
+
+    def test_deploy_etcd_cluster_not_enough(self):
+        cluster = self._deploying_cluster([self._node('node2')])
+        cluster.api.robots.get = MagicMock()
+        cluster.save = MagicMock()
+        with pytest.raises(RuntimeError, message='deployment should fail without enough nodes'):
+            cluster._deploy_etcd_cluster()
+        assert [etcd['node'] for etcd in cluster.data['etcds']] == ['node1', 'node2']
+        cluster.save.assert_called_once_with()
+
+    def _uninstalling_cluster(self):
+        """
+        installed etcd cluster whose etcd services are found through the robots of their nodes
+        """
+        cluster = self._cluster()
+        cluster.state.set('actions', 'install', 'ok')
+        cluster.save = MagicMock()
+        cluster._remove_zt_clients = MagicMock()
+
+        def robot(node, url):
+            robot = MagicMock()
+            robot.services.get.side_effect = lambda template_uid, name: self.etcds[name]
+            return robot
+        cluster.api.robots.get = robot
+        # don't wait between the attempts
+        patch.object(etcd_cluster, 'retry', lambda *args, **kwargs: lambda func: func).start()
+        return cluster
+
+    def test_uninstall(self):
+        cluster = self._uninstalling_cluster()
+        cluster.uninstall()
+        for service in self.etcds.values():
+            service.schedule_action.assert_called_once_with('uninstall')
+            service.delete.assert_called_once_with()
+        assert cluster.data['etcds'] == []
+        assert cluster.save.call_count == 3
+        with pytest.raises(StateCheckError):
+            cluster.state.check('actions', 'install', 'ok')
+
+    def test_uninstall_resume(self):
+        """
+        Test the etcds deleted before a failure are saved and not deleted again by the next uninstall
+        """
+        cluster = self._uninstalling_cluster()
+        self.etcds['etcd2'].schedule_action.side_effect = RuntimeError('node2 is unreachable')
+        with pytest.raises(RuntimeError, message='uninstall should fail if an etcd could not be deleted'):
+            cluster.uninstall()
+        assert [etcd['name'] for etcd in cluster.data['etcds']] == ['etcd2']
+        assert cluster.save.call_count == 2
+        cluster.state.check('actions', 'install', 'ok')
+
+        self.etcds['etcd2'].schedule_action.side_effect = None
+        cluster.uninstall()
+        assert cluster.data['etcds'] == []
+        self.etcds['etcd1'].delete.assert_called_once_with()
+        self.etcds['etcd2'].delete.assert_called_once_with()
+
+    def test_uninstall_deleted_service(self):
+        """
+        Test an etcd whose service doesn't exist anymore is removed from the cluster
+        """
+        cluster = self._uninstalling_cluster()
+        self.etcds['etcd3'].schedule_action.side_effect = ServiceNotFoundError()
+        cluster.uninstall()
+        assert cluster.data['etcds'] == []
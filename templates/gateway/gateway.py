@@ -1,8 +1,27 @@
+import re
+import time
+from collections import Counter
+
 from jumpscale import j
+from zerorobot.service_collection import ServiceNotFoundError
 from zerorobot.template.base import TemplateBase
 from zerorobot.template.state import StateCheckError
 
+CAPACITY_TEMPLATE_UID = 'github.com/threefoldtech/0-templates/node_capacity/0.0.1'
 NODE_CLIENT = 'local'
+SOURCEPORT_START = 2000
+SOURCEPORT_END = 10000
+INFO_TTL = 30  # seconds the live view of the gateway is cached
+CONTAINERS_TTL = 20  # seconds the list of running containers of the node is shared between the gateways
+PROCESSES_TTL = 300  # seconds the servers found running are trusted while the containers of the node don't change
+GATEWAY_PROCESSES = {'dhcp': 'dnsmasq', 'http': 'caddy'}  # processes of the servers running in the gateway container
+NFT_NAT_CHAIN = 'ip nat pre'  # chain of the gateway firewall holding the portforwards
+# dnat rule of a portforward as listed by nft, see nft_forward_handles
+NFT_FORWARD_RULE = re.compile(r'\bip daddr (?P<address>[\d.]+)(?:/\d+)? .*?\b(?P<protocol>tcp|udp) dport (?:\{ )?(?P<srcport>\d+)\b'
+                              r'.*\bdnat (?:ip )?to (?P<dstip>[\d.]+):(?P<dstport>\d+)')
+
+# containers running on the node, shared by all the gateway services of the robot
+_containers = {'time': 0, 'names': frozenset()}
 
 
 class Gateway(TemplateBase):
@@ -11,6 +30,22 @@ class Gateway(TemplateBase):
 
     def __init__(self, name, guid=None, data=None):
         super().__init__(name=name, guid=guid, data=data)
+        # firewall rules currently applied on the gateway, None when unknown
+        self._fw_rules = None
+        # indexes of the portforwards and of the dhcp hosts per network, see _reset_indexes
+        self._portforwards = None
+        self._dhcp_hosts = {}
+        # cached live view of the gateway, see info
+        self._info = None
+        self._info_time = 0
+        # changed by every action that modifies the gateway, start from the current time
+        # so a generation held by a caller is never reused after a restart of the robot
+        self._generation = int(time.time() * 1000)
+        # gateway sal used by the monitor, rebuilt when the generation or the containers of the node change
+        self._monitor_sal = None
+        self._monitor_sal_generation = None
+        # last time the servers were all found running in the gateway container, see _stopped_servers
+        self._servers_time = 0
         self.recurring_action('_monitor', 30)
         self.add_delete_callback(self.uninstall)
 
@@ -18,22 +53,135 @@ class Gateway(TemplateBase):
         if not self.data['hostname']:
             raise ValueError('Must supply a valid hostname')
 
+    def update_data(self, data):
+        # the lists can have been edited in any way
+        self._reset_indexes()
+
+    def _reset_indexes(self):
+        """
+        Drop the indexes of the portforwards and of the dhcp hosts, they are rebuilt from self.data on their next use.
+        Must be called whenever these lists are replaced or edited other than through the indexes
+        """
+        self._portforwards = None
+        self._dhcp_hosts = {}
+
     def _monitor(self):
         try:
             self.state.check('actions', 'start', 'ok')
-            if not self._gateway_sal.is_running():
-                try:
-                    self.install()
-                    if self._gateway_sal.is_running():
-                        self.state.set('state', 'running', 'ok')
-                    else:
-                        self.state.delete('state', 'running')
-                except:
-                    self.state.delete('state', 'running')
-                    raise
         except StateCheckError:
             # gateway is not supposed to be running
-            pass
+            return
+
+        try:
+            stopped = self._stopped_servers()
+        except:
+            # don't act on a check that failed, the next run rebuilds the sal and its container
+            self.logger.exception('Failed to check gateway {}'.format(self.name))
+            self._monitor_sal = None
+            return
+        if stopped == []:
+            return
+        if stopped is None:
+            # nothing to restart or reconfigure without the container
+            reason = 'container'
+            steps = [('redeploy', self._recover_redeploy)]
+        else:
+            reason = ', '.join(stopped)
+            steps = [
+                ('restart', lambda: self._recover_restart(stopped)),
+                ('reconfigure', self._recover_reconfigure),
+                ('redeploy', self._recover_redeploy),
+            ]
+        for step, recover in steps:
+            self.logger.info('Gateway {} is not running ({}), recover it: {}'.format(self.name, reason, step))
+            try:
+                recover()
+            except:
+                self.logger.exception('Failed to {} gateway {}'.format(step, self.name))
+                continue
+            try:
+                stopped = self._stopped_servers(force=True)
+            except:
+                self.logger.exception('Failed to check gateway {}'.format(self.name))
+                self._monitor_sal = None
+                continue
+            if stopped == []:
+                self.state.set('state', 'running', 'ok')
+                return
+        self.state.delete('state', 'running')
+
+    def _stopped_servers(self, force=False):
+        """
+        Check the gateway container and the servers running in it. The shared list of the containers
+        of the node is checked first, the gateway itself is only queried if its container is not in the list.
+        The processes of the container are only listed when the containers of the node or the gateway changed
+        since the servers were last found running, or after PROCESSES_TTL seconds
+        :param force: list the processes of the container even if nothing changed
+        :return: None if the container is not running, else the list of the servers that are not running (dhcp, http)
+        """
+        names = running_containers(self._node_sal)
+        monitor_sal = self._monitor_sal
+        gateway_sal = self._cached_gateway_sal
+        unchanged = gateway_sal is monitor_sal and time.time() - self._servers_time < PROCESSES_TTL
+        try:
+            container = gateway_sal.container
+        except LookupError:
+            return None
+        if container.name not in names and not gateway_sal.is_running():
+            return None
+        if unchanged and not force:
+            return []
+
+        expected = []
+        if any(network.get('dhcpserver') for network in self.data['networks']):
+            expected.append('dhcp')
+        if self.data['httpproxies']:
+            expected.append('http')
+        if not expected:
+            return []
+        cmdlines = [str(process.get('cmdline', '')) for process in container.client.process.list()]
+        stopped = [server for server in expected
+                   if not any(GATEWAY_PROCESSES[server] in cmdline for cmdline in cmdlines)]
+        self._servers_time = 0 if stopped else time.time()
+        return stopped
+
+    def _recover_restart(self, servers):
+        """
+        restart the dhcp and http servers of the gateway that are not running
+        :param servers: list of the servers to restart (dhcp, http)
+        """
+        gateway_sal = self._gateway_sal
+        if 'dhcp' in servers:
+            gateway_sal.configure_dhcp()
+        if 'http' in servers:
+            gateway_sal.configure_http()
+
+    def _recover_reconfigure(self):
+        """
+        reapply the whole configuration of the gateway
+        """
+        gateway_sal = self._gateway_sal
+        gateway_sal.configure_fw()
+        self._fw_rules = firewall_rules(self.data['portforwards'])
+        gateway_sal.configure_dhcp()
+        gateway_sal.configure_cloudinit()
+        gateway_sal.configure_http()
+
+    def _recover_redeploy(self):
+        self.install()
+
+    @property
+    def _cached_gateway_sal(self):
+        """
+        gateway sal kept between the monitor runs to check the gateway is running, along with its container.
+        Rebuilt when the gateway has been modified or when the containers of the node changed,
+        as the container held by the sal can then be stale
+        """
+        generation = (self._generation, running_containers(self._node_sal))
+        if self._monitor_sal is None or self._monitor_sal_generation != generation:
+            self._monitor_sal = self._gateway_sal
+            self._monitor_sal_generation = generation
+        return self._monitor_sal
 
     @property
     def _node_sal(self):
@@ -48,162 +196,284 @@ class Gateway(TemplateBase):
     def install(self):
         self.logger.info('Install gateway {}'.format(self.name))
         gateway_sal = self._gateway_sal
+        self._invalidate_info()
         gateway_sal.deploy()
+        self._fw_rules = firewall_rules(self.data['portforwards'])
         self.data['ztIdentity'] = gateway_sal.zt_identity
+        self._update_reserved_capacity('reservation_add')
         self.state.set('actions', 'install', 'ok')
         self.state.set('actions', 'start', 'ok')
         self.state.set('state', 'running', 'ok')
 
     def add_portforward(self, forward):
         self.logger.info('Add portforward {}'.format(forward['name']))
-        self.state.check('actions', 'start', 'ok')
+        return self.apply_portforwards(add=[forward])[0]
 
-        for network in self.data['networks']:
-            if network['name'] == forward['srcnetwork']:
-                break
-        else:
-            raise LookupError('Network with name {} doesn\'t exist'.format(forward['srcnetwork']))
+    def remove_portforward(self, name):
+        self.logger.info('Remove portforward {}'.format(name))
+        self.apply_portforwards(remove=[name])
 
-        used_sourceports = set()
-        for fw in self.data['portforwards']:
-            used_sourceports.add(fw['srcport'])
-            name, combination = self._compare_objects(fw, forward, 'srcnetwork', 'srcport')
-            if name:
+    def apply_portforwards(self, add=None, remove=None):
+        """
+        Add and remove a batch of portforwards with a single reconfiguration of the firewall.
+        All the forwards are validated before anything is applied, and if the firewall
+        configuration fails the gateway is restored to its previous state.
+        :param add: list of portforwards to add
+        :param remove: list of names of the portforwards to remove, unknown names are ignored
+        :return: list of the added portforwards, with their srcport filled in
+        """
+        add = add or []
+        remove = set(remove or [])
+        self.logger.info('Apply portforwards: add {} remove {}'.format(len(add), len(remove)))
+        self.state.check('actions', 'start', 'ok')
+
+        networks = {network['name'] for network in self.data['networks']}
+        for forward in add:
+            if forward['srcnetwork'] not in networks:
+                raise LookupError('Network with name {} doesn\'t exist'.format(forward['srcnetwork']))
+
+        index = self._portforwards_index
+        removed = [index.names[name] for name in remove if name in index.names]
+        if not removed and not add:
+            return []
+        removed_names = {fw['name'] for fw in removed}
+
+        names = set()
+        rules = set()
+        sourceports = set()
+        for forward in add:
+            if forward['name'] in names or (forward['name'] in index.names and forward['name'] not in removed_names):
                 raise ValueError('A forward with the same name exists')
-            if combination:
-                if set(fw['protocols']).intersection(set(forward['protocols'])):
+            names.add(forward['name'])
+            if not forward['srcport']:
+                continue
+            for protocol in forward['protocols']:
+                rule = (forward['srcnetwork'], forward['srcport'], protocol)
+                owner = index.rules.get(rule)
+                if rule in rules or (owner is not None and owner not in removed_names):
                     raise ValueError('Forward conflicts with existing forward')
-        if not forward['srcport']:
-            for suggested_port in range(2000, 10000):
-                if suggested_port not in used_sourceports:
-                    forward['srcport'] = suggested_port
-                    break
-            else:
-                raise RuntimeError('Could not find free sourceport to use')
-    
-        self.data['portforwards'].append(forward)
+                rules.add(rule)
+            sourceports.add(forward['srcport'])
 
-        try:
-            self._gateway_sal.configure_fw()
-        except:
-            self.logger.error('Failed to add portforward, restoring gateway to previous state')
-            self.data['portforwards'].remove(forward)
-            self._gateway_sal.configure_fw()
-            raise
-        return forward
-
-    def remove_portforward(self, name):
-        self.logger.info('Remove portforward {}'.format(name))
-        self.state.check('actions', 'start', 'ok')
+        for forward in add:
+            if not forward['srcport']:
+                forward['srcport'] = index.free_sourceport(exclude=sourceports)
+                sourceports.add(forward['srcport'])
 
-        for fw in self.data['portforwards']:
-            if fw['name'] == name:
-                self.data['portforwards'].remove(fw)
-                break
+        previous = self.data['portforwards']
+        if removed:
+            self.data['portforwards'] = [fw for fw in previous if fw['name'] not in removed_names] + add
         else:
+            self.data['portforwards'] = previous + add
+        for forward in removed:
+            index.remove(forward)
+        for forward in add:
+            index.add(forward)
+        self._invalidate_info()
+
+        self._configure_fw(previous)
+        return add
+
+    @property
+    def _portforwards_index(self):
+        """
+        Index of self.data['portforwards'] by name, by firewall rule and by source port.
+        Kept in sync by apply_portforwards, see _reset_indexes
+        """
+        if self._portforwards is None:
+            self._portforwards = PortForwardIndex(self.data['portforwards'])
+        return self._portforwards
+
+    def _configure_fw(self, previous):
+        """
+        Reconfigure the firewall if the rules generated from self.data['portforwards'] differ from
+        the ones currently applied. Only the difference is applied when the applied rules are known,
+        the whole firewall is rebuilt otherwise. Restore the previous portforwards if it fails
+        :param previous: portforwards to restore on failure
+        """
+        rules = firewall_rules(self.data['portforwards'])
+        if rules == self._fw_rules:
+            self.logger.info('Firewall rules did not change, skip firewall configuration')
             return
 
         try:
-            self._gateway_sal.configure_fw()
+            if self._fw_rules is None or not self._apply_fw_diff(self._fw_rules, rules):
+                self._gateway_sal.configure_fw()
+            self._fw_rules = rules
         except:
-            self.logger.error('Failed to remove portforward, restoring gateway to previous state')
-            self.data['portforwards'].append(fw)
+            self.logger.error('Failed to apply portforwards, restoring gateway to previous state')
+            self._fw_rules = None
+            self.data['portforwards'] = previous
+            self._reset_indexes()
             self._gateway_sal.configure_fw()
+            self._fw_rules = firewall_rules(previous)
             raise
 
+    def _apply_fw_diff(self, applied, rules):
+        """
+        Apply the difference between the applied firewall rules and the new ones with a single
+        atomic nft transaction in the gateway container, instead of rebuilding the whole firewall
+        :param applied: rules currently applied, as returned by firewall_rules
+        :param rules: rules to apply
+        :return: False if the difference can't be applied incrementally, nothing is changed in that case
+        """
+        addresses = {}
+        for network in self.data['networks']:
+            cidr = (network.get('config') or {}).get('cidr')
+            if cidr:
+                addresses[network['name']] = cidr.split('/')[0]
+
+        removed = {rule: target for rule, target in applied.items() if rules.get(rule) != target}
+        added = {rule: target for rule, target in rules.items() if applied.get(rule) != target}
+        if any(rule[0] not in addresses for rule in list(removed) + list(added)):
+            return False
+
+        container = self._gateway_sal.container
+        commands = []
+        if removed:
+            result = container.client.system('nft -a list chain {}'.format(NFT_NAT_CHAIN)).get()
+            if result.state != 'SUCCESS':
+                return False
+            handles = nft_forward_handles(result.stdout)
+            for rule, target in removed.items():
+                handle = handles.get(forward_key(addresses[rule[0]], rule, target))
+                if handle is None:
+                    self.logger.warning('Firewall rule for {} not found, rebuild the firewall'.format(rule))
+                    return False
+                commands.append('delete rule {} handle {}'.format(NFT_NAT_CHAIN, handle))
+        for rule, target in added.items():
+            commands.append('add rule {} {}'.format(NFT_NAT_CHAIN, nft_forward_rule(addresses[rule[0]], rule, target)))
+
+        self.logger.info('Apply firewall diff: remove {} add {} rules'.format(len(removed), len(added)))
+        result = container.client.bash("nft -f - <<'EOF'\n{}\nEOF".format('\n'.join(commands))).get()
+        if result.state != 'SUCCESS':
+            self.logger.warning('Failed to apply firewall diff, rebuild the firewall: {}'.format(result.stderr))
+            return False
+        return True
+
     def add_http_proxy(self, proxy):
         self.logger.info('Add http proxy {}'.format(proxy['name']))
-        self.state.check('actions', 'start', 'ok')
-
-        for existing_proxy in self.data['httpproxies']:
-            name, combination = self._compare_objects(existing_proxy, proxy, 'host')
-            if name:
-                raise ValueError('A proxy with the same name exists')
-            if combination:
-                raise ValueError("Proxy with host {} already exists".format(proxy['host']))
-        self.data['httpproxies'].append(proxy)
-
-        try:
-            self._gateway_sal.configure_http()
-        except:
-            self.logger.error('Failed to add http proxy, restoring gateway to previous state')
-            self.data['httpproxies'].remove(proxy)
-            self._gateway_sal.configure_http()
-            raise
+        self.apply_http_proxies(add=[proxy])
 
     def remove_http_proxy(self, name):
         self.logger.info('Remove http proxy {}'.format(name))
+        self.apply_http_proxies(remove=[name])
+
+    def apply_http_proxies(self, add=None, remove=None):
+        """
+        Add and remove a batch of http proxies with a single reconfiguration of the http server.
+        All the proxies are validated before anything is applied, and if the http server
+        configuration fails the gateway is restored to its previous state.
+        :param add: list of http proxies to add
+        :param remove: list of names of the http proxies to remove, unknown names are ignored
+        """
+        add = add or []
+        remove = set(remove or [])
+        self.logger.info('Apply http proxies: add {} remove {}'.format(len(add), len(remove)))
         self.state.check('actions', 'start', 'ok')
 
-        for existing_proxy in self.data['httpproxies']:
-            if existing_proxy['name'] == name:
-                self.data['httpproxies'].remove(existing_proxy)
-                break
-        else:
+        previous = self.data['httpproxies']
+        kept = [proxy for proxy in previous if proxy['name'] not in remove]
+        if len(kept) == len(previous) and not add:
             return
+
+        names = {proxy['name'] for proxy in kept}
+        hosts = {proxy['host'] for proxy in kept}
+        for proxy in add:
+            if proxy['name'] in names:
+                raise ValueError('A proxy with the same name exists')
+            if proxy['host'] in hosts:
+                raise ValueError("Proxy with host {} already exists".format(proxy['host']))
+            names.add(proxy['name'])
+            hosts.add(proxy['host'])
+
+        self.data['httpproxies'] = kept + add
+        self._invalidate_info()
         try:
             self._gateway_sal.configure_http()
         except:
-            self.logger.error('Failed to remove http proxy, restoring gateway to previous state')
-            self.data['httpproxies'].append(existing_proxy)
+            self.logger.error('Failed to apply http proxies, restoring gateway to previous state')
+            self.data['httpproxies'] = previous
             self._gateway_sal.configure_http()
             raise
 
     def add_dhcp_host(self, network_name, host):
         self.logger.info('Add dhcp to network {}'.format(network_name))
+        return self.add_dhcp_hosts(network_name, [host])[0]
+
+    def add_dhcp_hosts(self, network_name, hosts):
+        """
+        Add a batch of hosts to the dhcp server of a network.
+        All the hosts are validated before anything is applied, and the dhcp and
+        cloud-init configurations are applied once for the whole batch
+        :param network_name: name of the network
+        :param hosts: list of hosts
+        :return: list of the added hosts, with their ipaddress and macaddress filled in
+        """
+        self.logger.info('Add {} dhcp hosts to network {}'.format(len(hosts), network_name))
         self.state.check('actions', 'start', 'ok')
 
-        for network in self.data['networks']:
-            if network['name'] == network_name:
-                break
-        else:
-            raise LookupError('Network with name {} doesn\'t exist'.format(network_name))
+        network = self._network(network_name)
         dhcpserver = network.setdefault('dhcpserver', {})
-        for existing_host in dhcpserver.setdefault('hosts', []):
-            if host.get('macaddress') and existing_host['macaddress'] == host['macaddress']:
-                raise ValueError('Host with macaddress {} already exists'.format(host['macaddress']))
-            if host.get('ipaddress') and existing_host['ipaddress'] == host['ipaddress']:
-                raise ValueError('Host with ipaddress {} already exists'.format(host['ipaddress']))
-            if existing_host['hostname'] == host['hostname']:
-                raise ValueError('Host with hostname {} already exists'.format(host['hostname']))
-
+        dhcpserver.setdefault('hosts', [])
+        index = self._dhcp_hosts_index(network_name, dhcpserver)
+        batch = DhcpHostIndex([])
+        for host in hosts:
+            index.check(host)
+            batch.check(host)
+            batch.add(host)
+
+        # resolve all the hosts before recording any of them, so a host the sal refuses
+        # doesn't leave the previous hosts of the batch half added
         gateway_sal = self._gateway_sal
-        host_sal = gateway_sal.networks[network_name].hosts.add(host['hostname'], host.get('ipaddress'), host.get('macaddress'))
-        host['ipaddress'] = host_sal.ipaddress
-        host['macaddress'] = host_sal.macaddress
+        hosts_sal = gateway_sal.networks[network_name].hosts
+        resolved = []
+        try:
+            for host in hosts:
+                resolved.append(hosts_sal.add(host['hostname'], host.get('ipaddress'), host.get('macaddress')))
+        except:
+            self.logger.error('Failed to add dhcp hosts, removing the hosts of the batch')
+            for host in hosts[:len(resolved)]:
+                hosts_sal.remove(host['hostname'])
+            raise
 
-        dhcpserver['hosts'].append(host)
+        for host, host_sal in zip(hosts, resolved):
+            host['ipaddress'] = host_sal.ipaddress
+            host['macaddress'] = host_sal.macaddress
+            dhcpserver['hosts'].append(host)
+            index.add(host)
+        self._invalidate_info()
 
         try:
             gateway_sal.configure_dhcp()
             gateway_sal.configure_cloudinit()
         except:
-            self.logger.error('Failed to add dhcp host, restoring gateway to previous state')
-            dhcpserver['hosts'].remove(host)
-            gateway_sal.networks[network_name].hosts.remove(host['hostname'])
+            self.logger.error('Failed to add dhcp hosts, restoring gateway to previous state')
+            added = {id(host) for host in hosts}
+            dhcpserver['hosts'] = [host for host in dhcpserver['hosts'] if id(host) not in added]
+            self._reset_indexes()
+            for host in hosts:
+                hosts_sal.remove(host['hostname'])
             gateway_sal.configure_dhcp()
             gateway_sal.configure_cloudinit()
             raise
-    
-        return host
+
+        return hosts
 
     def remove_dhcp_host(self, network_name, host):
         self.logger.info('Add dhcp to network {}'.format(network_name))
 
         self.state.check('actions', 'start', 'ok')
 
-        for network in self.data['networks']:
-            if network['name'] == network_name:
-                break
-        else:
-            raise LookupError('Network with name {} doesn\'t exist'.format(network_name))
+        network = self._network(network_name)
         dhcpserver = network['dhcpserver']
-        for existing_host in dhcpserver['hosts']:
-            if existing_host['macaddress'] == host['macaddress']:
-                dhcpserver['hosts'].remove(existing_host)
-                break
-        else:
+        index = self._dhcp_hosts_index(network_name, dhcpserver)
+        existing_host = index.macaddresses.get(host['macaddress'])
+        if existing_host is None:
             raise LookupError('Host with macaddress {} doesn\'t exist'.format(host['macaddress']))
+        dhcpserver['hosts'].remove(existing_host)
+        index.remove(existing_host)
+        self._invalidate_info()
 
         try:
             self._gateway_sal.configure_dhcp()
@@ -211,10 +481,28 @@ class Gateway(TemplateBase):
         except:
             self.logger.error('Failed to remove dhcp, restoring gateway to previous state')
             dhcpserver['hosts'].append(existing_host)
+            index.add(existing_host)
             self._gateway_sal.configure_dhcp()
             self._gateway_sal.configure_cloudinit()
             raise
 
+    def _network(self, name):
+        for network in self.data['networks']:
+            if network['name'] == name:
+                return network
+        raise LookupError('Network with name {} doesn\'t exist'.format(name))
+
+    def _dhcp_hosts_index(self, network_name, dhcpserver):
+        """
+        Index of the dhcp hosts of a network by macaddress, ipaddress and hostname.
+        Kept in sync by the dhcp actions, see _reset_indexes
+        """
+        index = self._dhcp_hosts.get(network_name)
+        if index is None:
+            index = DhcpHostIndex(dhcpserver['hosts'])
+            self._dhcp_hosts[network_name] = index
+        return index
+
     def _compare_objects(self, obj1, obj2, *keys):
         """
         Checks that obj1 and obj2 have different names, and that the combination of values from keys are unique
@@ -241,12 +529,15 @@ class Gateway(TemplateBase):
             if combination:
                 raise ValueError('network with same type/id combination already exists')
         self.data['networks'].append(network)
+        self._invalidate_info()
 
         try:
             self._gateway_sal.deploy()
+            self._fw_rules = firewall_rules(self.data['portforwards'])
         except:
             self.logger.error('Failed to add network, restoring gateway to previous state')
             self.data['networks'].remove(network)
+            self._reset_indexes()
             self._gateway_sal.deploy()
             raise
 
@@ -260,11 +551,14 @@ class Gateway(TemplateBase):
                 break
         else:
             return
+        self._reset_indexes()
+        self._invalidate_info()
         try:
             self._gateway_sal.deploy()
         except:
             self.logger.error('Failed to remove network, restoring gateway to previous state')
             self.data['networks'].append(network)
+            self._reset_indexes()
             self._gateway_sal.deploy()
             raise
 
@@ -280,6 +574,7 @@ class Gateway(TemplateBase):
                 raise ValueError('route with same dev/dest combination already exists')
 
         self.data['routes'].append(route)
+        self._invalidate_info()
 
         try:
             self._gateway_sal.deploy()
@@ -299,6 +594,7 @@ class Gateway(TemplateBase):
                 break
         else:
             return
+        self._invalidate_info()
         try:
             self._gateway_sal.deploy()
         except:
@@ -307,25 +603,53 @@ class Gateway(TemplateBase):
             self._gateway_sal.deploy()
             raise
 
-    def info(self):
-        data = self._gateway_sal.to_dict(live=True)
-        return {
-            'name': self.name,
-            'portforwards': data['portforwards'],
-            'httpproxies': data['httpproxies'],
-            'networks': data['networks'],
-            'routes': data['routes']
-        }
+    def info(self, generation=None):
+        """
+        Return the live view of the gateway. It is cached for INFO_TTL seconds
+        and invalidated by every action that modifies the gateway.
+        :param generation: generation of the info already known by the caller. If the gateway
+                           didn't change since, only the name and generation are returned with unchanged set to True
+        :return: dict with the live configuration of the gateway and its generation
+        """
+        if generation is not None and generation == self._generation:
+            return {'name': self.name, 'generation': self._generation, 'unchanged': True}
+
+        if self._info is None or time.time() - self._info_time > INFO_TTL:
+            data = self._gateway_sal.to_dict(live=True)
+            self._info = {
+                'name': self.name,
+                'portforwards': data['portforwards'],
+                'httpproxies': data['httpproxies'],
+                'networks': data['networks'],
+                'routes': data['routes']
+            }
+            self._info_time = time.time()
+        info = dict(self._info)
+        info['generation'] = self._generation
+        info['unchanged'] = False
+        return info
+
+    def _invalidate_info(self):
+        """
+        drop the cached live view and start a new generation
+        """
+        self._info = None
+        self._generation += 1
 
     def uninstall(self):
         self.logger.info('Uninstall gateway {}'.format(self.name))
+        self._invalidate_info()
         self._gateway_sal.stop()
+        self._fw_rules = None
+        self._update_reserved_capacity('reservation_remove')
         self.state.delete('actions', 'install')
         self.state.delete('actions', 'start')
 
     def stop(self):
         self.logger.info('Stop gateway {}'.format(self.name))
+        self._invalidate_info()
         self._gateway_sal.stop()
+        self._fw_rules = None
         self.state.delete('actions', 'start')
         self.state.delete('state', 'running')
 
@@ -333,3 +657,175 @@ class Gateway(TemplateBase):
         self.logger.info('Start gateway {}'.format(self.name))
         self.state.check('actions', 'install', 'ok')
         self.install()
+
+    def _update_reserved_capacity(self, action):
+        """
+        notify the node capacity service that this service reserves or releases capacity
+        :param action: reservation_add or reservation_remove
+        """
+        try:
+            capacity = self.api.services.get(template_uid=CAPACITY_TEMPLATE_UID, name='_node_capacity')
+        except ServiceNotFoundError:
+            return
+        capacity.schedule_action(action, args={'service_guid': self.guid})
+
+
+def running_containers(node_sal):
+    """
+    Names of the containers running on the node, listed at most once every CONTAINERS_TTL seconds
+    for all the gateways of the robot
+    :param node_sal: node sal
+    """
+    if time.time() - _containers['time'] > CONTAINERS_TTL:
+        _containers['names'] = frozenset(container.name for container in node_sal.containers.list())
+        _containers['time'] = time.time()
+    return _containers['names']
+
+
+def firewall_rules(portforwards):
+    """
+    Compute the firewall rules generated by a list of portforwards.
+    Forwards with different names but the same effect generate the same rules
+    :param portforwards: list of portforwards
+    :return: dict mapping (srcnetwork, srcport, protocol) to (dstip, dstport)
+    """
+    return {
+        (fw['srcnetwork'], fw['srcport'], protocol): (fw['dstip'], fw['dstport'])
+        for fw in portforwards for protocol in fw['protocols']
+    }
+
+
+def nft_forward_rule(address, rule, target):
+    """
+    nat rule of a portforward, as added by _apply_fw_diff
+    :param address: address of the source network
+    :param rule: (srcnetwork, srcport, protocol)
+    :param target: (dstip, dstport)
+    """
+    _, srcport, protocol = rule
+    dstip, dstport = target
+    return 'ip daddr {} {} dport {} dnat to {}:{}'.format(address, protocol, srcport, dstip, dstport)
+
+
+def forward_key(address, rule, target):
+    """
+    What a nat rule of a portforward does, independently of how the rule is written
+    :param address: address of the source network
+    :param rule: (srcnetwork, srcport, protocol)
+    :param target: (dstip, dstport)
+    :return: (address, protocol, srcport, dstip, dstport)
+    """
+    _, srcport, protocol = rule
+    dstip, dstport = target
+    return (address, protocol, int(srcport), dstip, int(dstport))
+
+
+def nft_forward_handles(listing):
+    """
+    Parse the output of nft -a list chain. The dnat rules are matched on what they do rather than on
+    their text, so the rules written by the firewall template of the gateway sal are found whatever
+    the form it uses (prefix on the address, 'ip' in the dnat, extra matches or counters)
+    :param listing: output of the command
+    :return: dict mapping forward_key of the rules to their handle, rules listed more than once are left out
+    """
+    handles = {}
+    duplicates = set()
+    for line in listing.splitlines():
+        rule, sep, handle = line.strip().rpartition(' # handle ')
+        match = NFT_FORWARD_RULE.search(rule)
+        if not sep or not match:
+            continue
+        key = (match.group('address'), match.group('protocol'), int(match.group('srcport')),
+               match.group('dstip'), int(match.group('dstport')))
+        if key in handles:
+            duplicates.add(key)
+        handles[key] = int(handle)
+    for key in duplicates:
+        del handles[key]
+    return handles
+
+
+class PortForwardIndex:
+    """
+    Index of the portforwards of a gateway, used to detect conflicts and
+    find free source ports without going over all the forwards
+    """
+
+    def __init__(self, portforwards):
+        self.names = {}
+        self.rules = {}
+        self.sourceports = Counter()
+        # all the source ports lower than _free_hint are in use
+        self._free_hint = SOURCEPORT_START
+        for forward in portforwards:
+            self.add(forward)
+
+    def add(self, forward):
+        self.names[forward['name']] = forward
+        for protocol in forward['protocols']:
+            self.rules[(forward['srcnetwork'], forward['srcport'], protocol)] = forward['name']
+        self.sourceports[forward['srcport']] += 1
+
+    def remove(self, forward):
+        del self.names[forward['name']]
+        for protocol in forward['protocols']:
+            rule = (forward['srcnetwork'], forward['srcport'], protocol)
+            if self.rules.get(rule) == forward['name']:
+                del self.rules[rule]
+        port = forward['srcport']
+        self.sourceports[port] -= 1
+        if self.sourceports[port] <= 0:
+            del self.sourceports[port]
+            self._free_hint = min(self._free_hint, port)
+
+    def free_sourceport(self, exclude=()):
+        """
+        Find a source port not used by any forward
+        :param exclude: extra ports to consider as used
+        """
+        port = self._free_hint
+        while port < SOURCEPORT_END and port in self.sourceports:
+            port += 1
+        self._free_hint = port
+        while port < SOURCEPORT_END and (port in self.sourceports or port in exclude):
+            port += 1
+        if port >= SOURCEPORT_END:
+            raise RuntimeError('Could not find free sourceport to use')
+        return port
+
+
+class DhcpHostIndex:
+    """
+    Index of the dhcp hosts of a network by macaddress, ipaddress and hostname
+    """
+
+    def __init__(self, hosts):
+        self.macaddresses = {}
+        self.ipaddresses = {}
+        self.hostnames = {}
+        for host in hosts:
+            self.add(host)
+
+    def add(self, host):
+        if host.get('macaddress'):
+            self.macaddresses[host['macaddress']] = host
+        if host.get('ipaddress'):
+            self.ipaddresses[host['ipaddress']] = host
+        if host.get('hostname'):
+            self.hostnames[host['hostname']] = host
+
+    def remove(self, host):
+        for key, table in (('macaddress', self.macaddresses), ('ipaddress', self.ipaddresses), ('hostname', self.hostnames)):
+            if table.get(host.get(key)) is host:
+                del table[host[key]]
+
+    def check(self, host):
+        """
+        Raise ValueError if host conflicts with one of the indexed hosts
+        """
+        if host.get('macaddress') and host['macaddress'] in self.macaddresses:
+            raise ValueError('Host with macaddress {} already exists'.format(host['macaddress']))
+        if host.get('ipaddress') and host['ipaddress'] in self.ipaddresses:
+            raise ValueError('Host with ipaddress {} already exists'.format(host['ipaddress']))
+        if host.get('hostname') and host['hostname'] in self.hostnames:
+            raise ValueError('Host with hostname {} already exists'.format(host['hostname']))
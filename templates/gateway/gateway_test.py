@@ -4,6 +4,7 @@ import os
 import pytest
 
 
+import gateway
 from gateway import Gateway, NODE_CLIENT
 from zerorobot.template.state import StateCheckError
 
@@ -203,6 +204,203 @@ class TestGatewayTemplate(ZrobotBaseTest):
         gw.state.set('actions', 'start', 'ok')
         gw.remove_portforward('pf')
 
+    def test_apply_portforwards(self):
+        """
+        Test apply_portforwards action adds and removes forwards with a single firewall configuration
+        """
+        existing = {'name': 'pf1', 'dstip': '196.23.12.42', 'dstport': 21, 'srcnetwork': 'network', 'srcport': 21, 'protocols': ['tcp']}
+        self.valid_data['portforwards'] = [existing]
+        self.valid_data['networks'] = [{'name': 'network'}]
+        gw = Gateway('gw', data=self.valid_data)
+        gw.state.set('actions', 'start', 'ok')
+        forward_one = {'name': 'pf2', 'dstip': '196.23.12.42', 'dstport': 22, 'srcnetwork': 'network', 'srcport': 21, 'protocols': ['tcp']}
+        forward_two = {'name': 'pf3', 'dstip': '196.23.12.42', 'dstport': 23, 'srcnetwork': 'network', 'srcport': None, 'protocols': ['tcp']}
+        added = gw.apply_portforwards(add=[forward_one, forward_two], remove=['pf1'])
+
+        gw._gateway_sal.configure_fw.assert_called_once_with()
+        assert forward_two['srcport'] == 2000
+        assert added == [forward_one, forward_two]
+        assert gw.data['portforwards'] == [forward_one, forward_two]
+
+    def test_apply_portforwards_conflict_in_batch(self):
+        """
+        Test apply_portforwards action raises if forwards of the batch conflict with each other
+        """
+        with pytest.raises(ValueError, message='action should raise an error if two forwards of the batch conflict'):
+            self.valid_data['networks'] = [{'name': 'network'}]
+            gw = Gateway('gw', data=self.valid_data)
+            gw.state.set('actions', 'start', 'ok')
+            forward_one = {'name': 'pf1', 'dstip': '196.23.12.42', 'dstport': 22, 'srcnetwork': 'network', 'srcport': 22, 'protocols': ['tcp']}
+            forward_two = {'name': 'pf2', 'dstip': '196.23.12.42', 'dstport': 22, 'srcnetwork': 'network', 'srcport': 22, 'protocols': ['tcp']}
+            gw.apply_portforwards(add=[forward_one, forward_two])
+        gw._gateway_sal.configure_fw.assert_not_called()
+        assert gw.data['portforwards'] == []
+
+    def test_apply_portforwards_exception(self):
+        """
+        Test apply_portforwards action restores the previous forwards if the firewall configuration fails
+        """
+        forwards = [{'name': 'pf1', 'dstip': '196.23.12.42', 'dstport': 21, 'srcnetwork': 'network', 'srcport': 21, 'protocols': ['tcp']}]
+        self.valid_data['portforwards'] = forwards
+        self.valid_data['networks'] = [{'name': 'network'}]
+        gw = Gateway('gw', data=self.valid_data)
+        gw.state.set('actions', 'start', 'ok')
+        gw._gateway_sal.configure_fw.side_effect = [RuntimeError, None]
+        forward = {'name': 'pf2', 'dstip': '196.23.12.42', 'dstport': 22, 'srcnetwork': 'network', 'srcport': 22, 'protocols': ['tcp']}
+        with pytest.raises(RuntimeError):
+            gw.apply_portforwards(add=[forward], remove=['pf1'])
+        assert gw._gateway_sal.configure_fw.call_count == 2
+        assert gw.data['portforwards'] == forwards
+
+    def test_apply_portforwards_same_rules(self):
+        """
+        Test apply_portforwards action doesn't reconfigure the firewall if the rules don't change
+        """
+        forward = {'name': 'pf1', 'dstip': '196.23.12.42', 'dstport': 21, 'srcnetwork': 'network', 'srcport': 21, 'protocols': ['tcp']}
+        self.valid_data['portforwards'] = [forward]
+        self.valid_data['networks'] = [{'name': 'network'}]
+        gw = Gateway('gw', data=self.valid_data)
+        gw.install()
+        gw._gateway_sal.configure_fw.reset_mock()
+
+        renamed = dict(forward, name='pf2')
+        gw.apply_portforwards(add=[renamed], remove=['pf1'])
+        gw._gateway_sal.configure_fw.assert_not_called()
+        assert gw.data['portforwards'] == [renamed]
+
+    def _fw_gateway(self, forwards):
+        self.valid_data['portforwards'] = forwards
+        self.valid_data['networks'] = [{'name': 'network', 'config': {'cidr': '10.1.0.1/24'}}]
+        gw = Gateway('gw', data=self.valid_data)
+        gw.install()
+        gw._gateway_sal.configure_fw.reset_mock()
+        client = gw._gateway_sal.container.client
+        client.system.return_value.get.return_value = MagicMock(state='SUCCESS', stdout="""table ip nat {
+    chain pre {
+        type nat hook prerouting priority 0; policy accept;
+        ip daddr 10.1.0.1 tcp dport 21 dnat to 196.23.12.42:21 # handle 7
+        ip daddr 10.1.0.1 udp dport 21 dnat to 196.23.12.42:21 # handle 8
+    }
+}""")
+        client.bash.return_value.get.return_value = MagicMock(state='SUCCESS')
+        return gw, client
+
+    def test_apply_portforwards_diff(self):
+        """
+        Test apply_portforwards action only applies the changed firewall rules
+        """
+        forward = {'name': 'pf1', 'dstip': '196.23.12.42', 'dstport': 21, 'srcnetwork': 'network', 'srcport': 21, 'protocols': ['tcp', 'udp']}
+        gw, client = self._fw_gateway([forward])
+
+        added = {'name': 'pf2', 'dstip': '196.23.12.43', 'dstport': 22, 'srcnetwork': 'network', 'srcport': 22, 'protocols': ['tcp']}
+        gw.apply_portforwards(add=[added], remove=['pf1'])
+        gw._gateway_sal.configure_fw.assert_not_called()
+        client.system.assert_called_once_with('nft -a list chain ip nat pre')
+        script = client.bash.call_args[0][0]
+        assert 'delete rule ip nat pre handle 7\n' in script
+        assert 'delete rule ip nat pre handle 8\n' in script
+        assert 'add rule ip nat pre ip daddr 10.1.0.1 tcp dport 22 dnat to 196.23.12.43:22\n' in script
+        assert gw.data['portforwards'] == [added]
+
+    def test_apply_portforwards_diff_add_only(self):
+        """
+        Test apply_portforwards action doesn't list the firewall when only adding rules
+        """
+        gw, client = self._fw_gateway([])
+
+        added = {'name': 'pf2', 'dstip': '196.23.12.43', 'dstport': 22, 'srcnetwork': 'network', 'srcport': 22, 'protocols': ['tcp']}
+        gw.apply_portforwards(add=[added])
+        gw._gateway_sal.configure_fw.assert_not_called()
+        client.system.assert_not_called()
+        assert client.bash.call_count == 1
+
+    def test_apply_portforwards_diff_rule_not_found(self):
+        """
+        Test apply_portforwards action rebuilds the firewall if a removed rule is not found
+        """
+        forward = {'name': 'pf1', 'dstip': '196.23.12.42', 'dstport': 23, 'srcnetwork': 'network', 'srcport': 23, 'protocols': ['tcp']}
+        gw, client = self._fw_gateway([forward])
+
+        gw.apply_portforwards(remove=['pf1'])
+        client.bash.assert_not_called()
+        gw._gateway_sal.configure_fw.assert_called_once_with()
+
+    def test_apply_portforwards_diff_failure(self):
+        """
+        Test apply_portforwards action rebuilds the firewall if the nft transaction fails
+        """
+        gw, client = self._fw_gateway([])
+        client.bash.return_value.get.return_value = MagicMock(state='ERROR', stderr='error')
+
+        added = {'name': 'pf2', 'dstip': '196.23.12.43', 'dstport': 22, 'srcnetwork': 'network', 'srcport': 22, 'protocols': ['tcp']}
+        gw.apply_portforwards(add=[added])
+        gw._gateway_sal.configure_fw.assert_called_once_with()
+        assert gw.data['portforwards'] == [added]
+
+    def test_nft_forward_handles(self):
+        listing = """table ip nat {
+    chain pre {
+        type nat hook prerouting priority 0; policy accept;
+        ip daddr 10.1.0.1 tcp dport 21 dnat to 10.0.0.2:21 # handle 7
+        ip daddr 10.1.0.1 tcp dport 22 dnat to 10.0.0.2:22 # handle 8
+        ip daddr 10.1.0.1 tcp dport 22 dnat to 10.0.0.2:22 # handle 9
+        iifname "eth0" ip daddr 10.1.0.1/32 udp dport { 53 } counter packets 0 bytes 0 dnat ip to 10.0.0.3:5353 # handle 10
+        ip saddr 10.2.0.0/24 masquerade # handle 11
+    }
+}"""
+        assert gateway.nft_forward_handles(listing) == {
+            ('10.1.0.1', 'tcp', 21, '10.0.0.2', 21): 7,
+            ('10.1.0.1', 'udp', 53, '10.0.0.3', 5353): 10,
+        }
+
+    def test_nft_forward_rule_listed(self):
+        """
+        Test the rules added by _apply_fw_diff are found again in the nft listing
+        """
+        rule, target = ('network', 22, 'tcp'), ('10.0.0.2', '22')
+        listing = '        {} # handle 4'.format(gateway.nft_forward_rule('10.1.0.1', rule, target))
+        assert gateway.nft_forward_handles(listing) == {gateway.forward_key('10.1.0.1', rule, target): 4}
+
+    def test_portforwards_index(self):
+        """
+        Test the portforwards index is kept in sync by apply_portforwards
+        """
+        self.valid_data['networks'] = [{'name': 'network'}]
+        gw = Gateway('gw', data=self.valid_data)
+        gw.state.set('actions', 'start', 'ok')
+        forward_one = {'name': 'pf1', 'dstip': '196.23.12.42', 'dstport': 21, 'srcnetwork': 'network', 'srcport': None, 'protocols': ['tcp']}
+        forward_two = {'name': 'pf2', 'dstip': '196.23.12.42', 'dstport': 22, 'srcnetwork': 'network', 'srcport': None, 'protocols': ['tcp']}
+        gw.apply_portforwards(add=[forward_one, forward_two])
+        assert (forward_one['srcport'], forward_two['srcport']) == (2000, 2001)
+
+        gw.remove_portforward('pf1')
+        index = gw._portforwards_index
+        assert list(index.names.keys()) == ['pf2']
+        assert ('network', 2000, 'tcp') not in index.rules
+
+        # the freed source port is used again
+        forward_three = {'name': 'pf3', 'dstip': '196.23.12.42', 'dstport': 23, 'srcnetwork': 'network', 'srcport': None, 'protocols': ['tcp']}
+        gw.add_portforward(forward_three)
+        assert forward_three['srcport'] == 2000
+
+    def test_portforwards_index_update_data(self):
+        """
+        Test the portforwards index is rebuilt after the forwards are edited by a data update
+        """
+        self.valid_data['networks'] = [{'name': 'network'}]
+        gw = Gateway('gw', data=self.valid_data)
+        gw.state.set('actions', 'start', 'ok')
+        forward = {'name': 'pf1', 'dstip': '196.23.12.42', 'dstport': 21, 'srcnetwork': 'network', 'srcport': 21, 'protocols': ['tcp']}
+        gw.apply_portforwards(add=[forward])
+
+        # same number of forwards, different rules
+        replaced = dict(forward, name='pf2', srcport=22)
+        gw.data['portforwards'][0] = replaced
+        gw.update_data(gw.data)
+        gw.apply_portforwards(add=[dict(forward, name='pf3')])
+        with pytest.raises(ValueError):
+            gw.apply_portforwards(add=[dict(replaced, name='pf4')])
+
     def test_add_http_proxy(self):
         """
         Test add_http_proxy action
@@ -319,6 +517,67 @@ class TestGatewayTemplate(ZrobotBaseTest):
         gw._gateway_sal.configure_dhcp.assert_called_once_with()
         gw._gateway_sal.configure_cloudinit.assert_called_once_with()
 
+    def test_add_dhcp_hosts(self):
+        """
+        Test add_dhcp_hosts action configures dhcp once for the whole batch
+        """
+        self.valid_data['networks'] = [{'name': 'network', 'dhcpserver': {'hosts': [{'macaddress': 'address1', 'hostname': 'one', 'ipaddress': 'ip'}]}}]
+        gw = Gateway('gw', data=self.valid_data)
+        gw.state.set('actions', 'start', 'ok')
+        hosts_sal = gw._gateway_sal.networks['network'].hosts
+        hosts_sal.add.side_effect = lambda hostname, ipaddress, macaddress: MagicMock(ipaddress=ipaddress, macaddress=macaddress)
+        hosts = [
+            {'macaddress': 'address2', 'hostname': 'two', 'ipaddress': 'ip2'},
+            {'macaddress': 'address3', 'hostname': 'three', 'ipaddress': 'ip3'},
+        ]
+        gw.add_dhcp_hosts('network', hosts)
+        assert gw.data['networks'][0]['dhcpserver']['hosts'][1:] == hosts
+        gw._gateway_sal.configure_dhcp.assert_called_once_with()
+        gw._gateway_sal.configure_cloudinit.assert_called_once_with()
+
+    def test_add_dhcp_hosts_sal_failure(self):
+        """
+        Test add_dhcp_hosts action doesn't add any host of the batch if the sal refuses one of them
+        """
+        existing = {'macaddress': 'address1', 'hostname': 'one', 'ipaddress': 'ip'}
+        self.valid_data['networks'] = [{'name': 'network', 'dhcpserver': {'hosts': [existing]}}]
+        gw = Gateway('gw', data=self.valid_data)
+        gw.state.set('actions', 'start', 'ok')
+        hosts_sal = gw._gateway_sal.networks['network'].hosts
+        hosts_sal.add.side_effect = [MagicMock(ipaddress='ip2', macaddress='address2'), RuntimeError('no ip left')]
+        hosts = [
+            {'macaddress': 'address2', 'hostname': 'two'},
+            {'macaddress': 'address3', 'hostname': 'three'},
+        ]
+        with pytest.raises(RuntimeError):
+            gw.add_dhcp_hosts('network', hosts)
+        assert gw.data['networks'][0]['dhcpserver']['hosts'] == [existing]
+        hosts_sal.remove.assert_called_once_with('two')
+        gw._gateway_sal.configure_dhcp.assert_not_called()
+        gw._gateway_sal.configure_cloudinit.assert_not_called()
+
+        # the hosts of the failed batch can be added again
+        hosts_sal.add.side_effect = lambda hostname, ipaddress, macaddress: MagicMock(ipaddress=hostname, macaddress=macaddress)
+        gw.add_dhcp_hosts('network', hosts)
+        assert len(gw.data['networks'][0]['dhcpserver']['hosts']) == 3
+        gw._gateway_sal.configure_dhcp.assert_called_once_with()
+
+    def test_add_dhcp_hosts_conflict_in_batch(self):
+        """
+        Test add_dhcp_hosts action raises if hosts of the batch conflict with each other
+        """
+        self.valid_data['networks'] = [{'name': 'network', 'dhcpserver': {'hosts': []}}]
+        gw = Gateway('gw', data=self.valid_data)
+        gw.state.set('actions', 'start', 'ok')
+        hosts = [
+            {'macaddress': 'address2', 'hostname': 'two'},
+            {'macaddress': 'address3', 'hostname': 'two'},
+        ]
+        with pytest.raises(ValueError):
+            gw.add_dhcp_hosts('network', hosts)
+        assert gw.data['networks'][0]['dhcpserver']['hosts'] == []
+        gw._gateway_sal.configure_dhcp.assert_not_called()
+
     def test_add_dhcp_host_exception(self):
         """
         Test add_dhcp_host action raises exception
@@ -559,3 +818,121 @@ class TestGatewayTemplate(ZrobotBaseTest):
         gw.state.set('actions', 'start', 'ok')
         gw.stop()
         gw._gateway_sal.stop.called_once_with()
+
+    def test_info_cached(self):
+        """
+        Test info action caches the live view until the gateway is modified
+        """
+        gw = Gateway('gw', data=self.valid_data)
+        gw.state.set('actions', 'start', 'ok')
+        gw_sal = MagicMock()
+        gw_sal.to_dict.return_value = {'portforwards': [], 'httpproxies': [], 'networks': [], 'routes': []}
+        gw._node_sal.primitives.from_dict.return_value = gw_sal
+
+        info = gw.info()
+        assert gw.info() == info
+        gw_sal.to_dict.assert_called_once_with(live=True)
+        assert gw.info(generation=info['generation']) == {'name': 'gw', 'generation': info['generation'], 'unchanged': True}
+
+        gw.add_http_proxy({'name': 'proxy', 'host': 'host', 'destinations': [], 'types': ['http']})
+        new_info = gw.info(generation=info['generation'])
+        assert new_info['generation'] != info['generation']
+        assert not new_info['unchanged']
+        assert gw_sal.to_dict.call_count == 2
+
+    def _monitor_gateway(self, processes):
+        self.valid_data['networks'] = [{'name': 'network', 'dhcpserver': {'hosts': []}}]
+        self.valid_data['httpproxies'] = [{'name': 'proxy', 'host': 'host', 'destinations': [], 'types': ['http']}]
+        gw = Gateway('gw', data=self.valid_data)
+        gw.state.set('actions', 'start', 'ok')
+        gw_sal = MagicMock()
+        gw_sal.container.name = 'gateway_container'
+        gw_sal.container.client.process.list.side_effect = processes
+        gw._node_sal.primitives.from_dict.return_value = gw_sal
+        gw._node_sal.containers.list.return_value = [gw_sal.container]
+        gateway._containers['time'] = 0
+        return gw, gw_sal
+
+    def test_monitor_running(self):
+        """
+        Test _monitor doesn't query the gateway if its container and servers are running
+        """
+        gw, gw_sal = self._monitor_gateway([[{'cmdline': 'dnsmasq --conf-file=/etc/dnsmasq.conf'}, {'cmdline': 'caddy -conf /etc/caddy.conf'}]])
+        gw._monitor()
+        gw_sal.is_running.assert_not_called()
+        gw_sal.configure_dhcp.assert_not_called()
+        gw_sal.configure_http.assert_not_called()
+
+    def test_monitor_restart(self):
+        """
+        Test _monitor restarts only the server that stopped when that is enough
+        """
+        running = [{'cmdline': 'dnsmasq'}, {'cmdline': 'caddy'}]
+        gw, gw_sal = self._monitor_gateway([[{'cmdline': 'caddy'}], running])
+        gw._monitor()
+        gw_sal.configure_dhcp.assert_called_once_with()
+        gw_sal.configure_http.assert_not_called()
+        gw_sal.configure_fw.assert_not_called()
+        gw_sal.deploy.assert_not_called()
+        gw.state.check('state', 'running', 'ok')
+
+    def test_monitor_reconfigure(self):
+        """
+        Test _monitor reconfigures the gateway when restarting the server is not enough
+        """
+        running = [{'cmdline': 'dnsmasq'}, {'cmdline': 'caddy'}]
+        gw, gw_sal = self._monitor_gateway([[{'cmdline': 'dnsmasq'}], [{'cmdline': 'dnsmasq'}], running])
+        gw._monitor()
+        gw_sal.configure_fw.assert_called_once_with()
+        gw_sal.deploy.assert_not_called()
+        gw.state.check('state', 'running', 'ok')
+
+    def test_monitor_container_down(self):
+        """
+        Test _monitor redeploys the gateway right away when its container is not running
+        """
+        gw, gw_sal = self._monitor_gateway([[{'cmdline': 'dnsmasq'}, {'cmdline': 'caddy'}]])
+        gw._node_sal.containers.list.return_value = []
+        gw_sal.is_running.return_value = False
+        gw_sal.deploy.side_effect = lambda: setattr(gw_sal.is_running, 'return_value', True)
+        gw._monitor()
+        gw_sal.configure_dhcp.assert_not_called()
+        gw_sal.deploy.assert_called_once_with()
+        gw.state.check('state', 'running', 'ok')
+
+    def test_monitor_processes_unchanged(self):
+        """
+        Test _monitor only lists the processes of the gateway again when the containers of the node change
+        """
+        running = [{'cmdline': 'dnsmasq'}, {'cmdline': 'caddy'}]
+        gw, gw_sal = self._monitor_gateway([running, running])
+        gw._monitor()
+        gw._monitor()
+        assert gw_sal.container.client.process.list.call_count == 1
+
+        gateway._containers['names'] = frozenset(['gateway_container', 'other'])
+        gw._monitor()
+        assert gw_sal.container.client.process.list.call_count == 2
+        assert gw._node_sal.primitives.from_dict.call_count == 2
+        gw_sal.configure_dhcp.assert_not_called()
+
+    def test_monitor_processes_ttl(self):
+        """
+        Test _monitor lists the processes of the gateway again after PROCESSES_TTL
+        """
+        running = [{'cmdline': 'dnsmasq'}, {'cmdline': 'caddy'}]
+        gw, gw_sal = self._monitor_gateway([running, running])
+        gw._monitor()
+        gw._servers_time -= gateway.PROCESSES_TTL
+        gw._monitor()
+        assert gw_sal.container.client.process.list.call_count == 2
+
+    def test_monitor_check_failure(self):
+        """
+        Test _monitor doesn't raise nor recover the gateway when checking it fails
+        """
+        gw, gw_sal = self._monitor_gateway(RuntimeError('connection reset'))
+        gw._monitor()
+        gw_sal.configure_dhcp.assert_not_called()
+        gw_sal.deploy.assert_not_called()
+        assert gw._monitor_sal is None
@@ -281,7 +281,7 @@ class Minio(TemplateBase):
         if not self.data['nodePort']:
             return
         port_mgr = self.api.services.get(template_uid=PORT_MANAGER_TEMPLATE_UID, name='_port_manager')
-        port_mgr.schedule_action("release", {"service_guid": self.guid, 'ports': [self.data['nodePort']]})
+        port_mgr.schedule_action("release_service", {"service_guid": self.guid})
         self.data['nodePort'] = 0
 
 
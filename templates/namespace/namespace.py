@@ -16,7 +16,9 @@ class Namespace(TemplateBase):
         self.add_delete_callback(self.uninstall)
         if not self.data.get('password'):
             self.data['password'] = j.data.idgenerator.generateXCharID(32)
-        self.recurring_action('_monitor', 30)  # every 30 seconds
+        # status changes are pushed by the zerodb, see zerodb_status_update.
+        # the monitor is only a safety net
+        self.recurring_action('_monitor', 300)  # every 5 minutes
 
     def validate(self):
         self.state.delete('status', 'running')
@@ -38,11 +40,25 @@ class Namespace(TemplateBase):
         except StateCheckError:
             return
 
+        zerodb = self._zerodb
+        zerodb.schedule_action('subscribe', args={'guid': self.guid})
         try:
-            self._zerodb.state.check('status', 'running', 'ok')
-            self.state.set('status', 'running', 'ok')
+            zerodb.state.check('status', 'running', 'ok')
+            self.zerodb_status_update(True)
         except StateCheckError:
-            self.state.set('status', 'running', 'error')
+            self.zerodb_status_update(False)
+
+    def zerodb_status_update(self, running):
+        """
+        Called by the zerodb this namespace lives on when its running status changes
+        :param running: boolean indicating if the zerodb is running
+        """
+        try:
+            self.state.check('actions', 'install', 'ok')
+        except StateCheckError:
+            return
+
+        self.state.set('status', 'running', 'ok' if running else 'error')
 
     @property
     def _zerodb(self):
@@ -69,6 +85,7 @@ class Namespace(TemplateBase):
         # this action hold the logic of the capacity planning for the zdb and namespaces
         self.data['zerodb'], self.data['nsName'] = node.schedule_action(
             'create_zdb_namespace', kwargs).wait(die=True).result
+        self._zerodb.schedule_action('subscribe', args={'guid': self.guid})
         self.state.set('actions', 'install', 'ok')
 
     def info(self):
@@ -77,16 +94,17 @@ class Namespace(TemplateBase):
 
     def url(self):
         self.state.check('actions', 'install', 'ok')
-        return self._zerodb.schedule_action('namespace_url', args={'name': self.data['nsName']}).wait(die=True).result
+        return self._zerodb.cached_action('namespace_url', args={'name': self.data['nsName']})
 
     def private_url(self):
         self.state.check('actions', 'install', 'ok')
-        return self._zerodb.schedule_action('namespace_private_url', args={'name': self.data['nsName']}).wait(die=True).result
+        return self._zerodb.cached_action('namespace_private_url', args={'name': self.data['nsName']})
 
     def uninstall(self):
         self._zerodb.schedule_action('namespace_delete', args={'name': self.data['nsName']}).wait(die=True)
+        self._zerodb.schedule_action('unsubscribe', args={'guid': self.guid})
         self.state.delete('actions', 'install')
 
     def connection_info(self):
         self.state.check('actions', 'install', 'ok')
-        return self._zerodb.schedule_action('connection_info').wait(die=True).result
+        return self._zerodb.cached_action('connection_info')
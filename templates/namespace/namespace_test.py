@@ -74,7 +74,7 @@ class TestNamespaceTemplate(ZrobotBaseTest):
         }
         ns.install()
 
-        node.schedule_action.assert_called_once_with('create_zdb_namespace', args)
+        node.schedule_action.assert_any_call('create_zdb_namespace', args)
         ns.state.check('actions', 'install', 'ok')
         assert ns.data['nsName'] == 'nsName'
         assert ns.data['zerodb'] == 'instance'
@@ -106,7 +106,7 @@ class TestNamespaceTemplate(ZrobotBaseTest):
         ns.state.set('actions', 'install', 'ok')
         ns.api = MagicMock()
         ns.uninstall()
-        ns._zerodb.schedule_action.assert_called_once_with('namespace_delete', args={'name': 'nsName'})
+        ns._zerodb.schedule_action.assert_any_call('namespace_delete', args={'name': 'nsName'})
 
     def test_connection_info_without_install(self):
         with pytest.raises(StateCheckError, message='Executing connection_info action without install should raise an error'):
@@ -119,10 +119,9 @@ class TestNamespaceTemplate(ZrobotBaseTest):
         ns.state.set('status', 'running', 'ok')
         ns.api = MagicMock()
         result = {'ip': '127.0.0.1', 'port': 9900}
-        task = task_mock(result)
-        ns._zerodb.schedule_action = MagicMock(return_value=task)
+        ns._zerodb.cached_action.return_value = result
         assert ns.connection_info() == result
-        ns._zerodb.schedule_action.assert_called_once_with('connection_info')
+        ns._zerodb.cached_action.assert_called_once_with('connection_info')
 
     def test_url_without_install(self):
         with pytest.raises(StateCheckError, message='Executing info action without install should raise an error'):
@@ -134,10 +133,10 @@ class TestNamespaceTemplate(ZrobotBaseTest):
         ns.data['nsName'] = 'nsName'
         ns.state.set('actions', 'install', 'ok')
         ns.api = MagicMock()
-        ns._zerodb.schedule_action = MagicMock(return_value=task_mock('url'))
+        ns._zerodb.cached_action.return_value = 'url'
 
         assert ns.url() == 'url'
-        ns._zerodb.schedule_action.assert_called_once_with('namespace_url', args={'name': 'nsName'})
+        ns._zerodb.cached_action.assert_called_once_with('namespace_url', args={'name': 'nsName'})
 
     def test_private_url_without_install(self):
         with pytest.raises(StateCheckError, message='Executing info action without install should raise an error'):
@@ -149,7 +148,15 @@ class TestNamespaceTemplate(ZrobotBaseTest):
         ns.data['nsName'] = 'nsName'
         ns.state.set('actions', 'install', 'ok')
         ns.api = MagicMock()
-        ns._zerodb.schedule_action = MagicMock(return_value=task_mock('url'))
+        ns._zerodb.cached_action.return_value = 'url'
 
         assert ns.private_url() == 'url'
-        ns._zerodb.schedule_action.assert_called_once_with('namespace_private_url', args={'name': 'nsName'})
+        ns._zerodb.cached_action.assert_called_once_with('namespace_private_url', args={'name': 'nsName'})
+
+    def test_zerodb_status_update(self):
+        ns = Namespace(name='namespace', data=self.valid_data)
+        ns.state.set('actions', 'install', 'ok')
+        ns.zerodb_status_update(True)
+        ns.state.check('status', 'running', 'ok')
+        ns.zerodb_status_update(False)
+        ns.state.check('status', 'running', 'error')
@@ -1,3 +1,8 @@
+import hashlib
+import json
+import random
+import time
+from functools import partial
 
 from jumpscale import j
 from zerorobot.template.base import TemplateBase
@@ -6,6 +11,15 @@ from zerorobot.template.state import StateCheckError
 
 
 NODE_CLIENT = 'local'
+RESERVED_TEMPLATES = ('vm', 'vdisk', 'gateway')
+RECONCILE_INTERVAL = 6 * 60 * 60  # full reconciliation of the reserved capacity every 6 hours
+REPORT_INTERVAL = 10 * 60  # every 10 minutes
+RETRY_DELAY = 60  # first retry after a directory error, doubled on every consecutive error
+MAX_BACKOFF = 60 * 60
+GATEWAY_CRU = 1  # estimate of the capacity reserved by a gateway, see resource_units
+GATEWAY_MRU = 1
+REPORT_FIELDS = ('CRU', 'MRU', 'HRU', 'SRU')  # resource units exposed by the reports of the capacity SAL
+SLOW_REPORT = 30  # directory calls taking longer than this many seconds put the report in warning state
 
 
 class NodeCapacity(TemplateBase):
@@ -15,9 +29,16 @@ class NodeCapacity(TemplateBase):
 
     def __init__(self, name, guid=None, data=None):
         super().__init__(name=name, guid=guid, data=data)
-        self.recurring_action('_total', 10 * 60)   # every 10 minutes
-        self.recurring_action('_reality', 10 * 60)      # every 10 minutes
-        self.recurring_action('_reserved', 10 * 60)  # every 10 minutes
+        # ledger of the services that reserve capacity on the node, per template name
+        self._ledger = None
+        self._last_reconcile = 0
+        self._reported_units = None
+        # time of the next report and number of consecutive errors, per report
+        self._next_report = {}
+        self._failures = {}
+        # statistics of the directory calls per report, see report_stats
+        self._stats = {}
+        self.recurring_action('_report', 60)  # every minute, the reports themselves are scheduled by _report
 
     @property
     def _node_sal(self):
@@ -26,6 +47,34 @@ class NodeCapacity(TemplateBase):
         """
         return j.clients.zos.get(NODE_CLIENT)
 
+    def _report(self):
+        """
+        send the capacity reports that are due to the directory
+
+        the first report of each kind is delayed by a per node offset so nodes that booted
+        at the same time don't all hit the directory at once
+        """
+        for name, report in (('total', self._total), ('reality', self._reality), ('reserved', self._reserved)):
+            now = time.time()
+            if name not in self._next_report:
+                self._next_report[name] = now + self._jitter(name)
+            if now < self._next_report[name]:
+                continue
+            try:
+                report()
+            except Exception:
+                self.logger.exception("failed to send %s capacity report", name)
+                if self._next_report[name] <= now:
+                    # the report failed before reaching the directory, back off as well
+                    self._failures[name] = self._failures.get(name, 0) + 1
+                    self._schedule_report(name)
+
+    def _jitter(self, name):
+        """
+        offset of the first report, stable for a node
+        """
+        return random.Random('%s-%s' % (self._node_sal.name, name)).uniform(0, REPORT_INTERVAL)
+
     @timeout(300)
     def _total(self):
         """
@@ -33,9 +82,11 @@ class NodeCapacity(TemplateBase):
         """
         self.logger.info("register the total node capacity")
 
+        capacity = self._node_sal.capacity
+        report = capacity.total_report()
         self.state.delete('capacity', 'total')
         try:
-            self._node_sal.capacity.register()
+            self._send_report('total', report, partial(reuse_report, capacity, 'total_report', report, capacity.register))
             self.state.set('capacity', 'total', 'ok')
         except:
             self.state.set('capacity', 'total', 'error')
@@ -45,28 +96,233 @@ class NodeCapacity(TemplateBase):
     def _reserved(self):
         """
         update the reserved capacity of the node
+
+        the reserved capacity is kept up to date by the reservation_add and reservation_remove actions
+        called by the services when they are installed or uninstalled.
+        It is only reported when it changed more than the configured threshold since the last report.
         """
-        self.logger.info("update the reserved capacity of the node")
-        try:
+        if self._ledger is None or time.time() - self._last_reconcile > RECONCILE_INTERVAL:
+            self._reconcile()
+
+        units = resource_units(self._ledger)
+        if not self._units_changed(units):
+            # report the same units as last time so the report is skipped
+            # unless it is older than reportMaxAge
+            units = self._reported_units
+
+        def update_reserved():
             self._node_sal.capacity.update_reserved(
-                vms=self.api.services.find(template_name='vm', template_account='threefoldtech'),
-                vdisks=self.api.services.find(template_name='vdisk', template_account='threefoldtech'),
-                gateways=self.api.services.find(template_name='gateway', template_account='threefoldtech'),
+                vms=list(self._ledger['vm'].values()),
+                vdisks=list(self._ledger['vdisk'].values()),
+                gateways=list(self._ledger['gateway'].values()),
             )
+
+        self.logger.info("update the reserved capacity of the node")
+        try:
+            if self._send_report('reserved', units, update_reserved):
+                self._reported_units = units
             self.state.set('capacity', 'reserved', 'ok')
         except:
             self.state.set('capacity', 'reserved', 'error')
             raise
 
+    def _reconcile(self):
+        """
+        rebuild the reserved capacity ledger from all the services of the robot
+        """
+        self.logger.info("reconcile the reserved capacity ledger")
+        ledger = {}
+        for template_name in RESERVED_TEMPLATES:
+            services = self.api.services.find(template_name=template_name, template_account='threefoldtech')
+            ledger[template_name] = {service.guid: service for service in services}
+        self._ledger = ledger
+        self._last_reconcile = time.time()
+
+    def _units_changed(self, units):
+        """
+        check if the reserved resource units changed more than the configured threshold
+        since the last report
+        """
+        if self._reported_units is None:
+            return True
+        threshold = self.data['reportThreshold']
+        for key, value in units.items():
+            reported = self._reported_units.get(key, 0)
+            if abs(value - reported) > threshold * max(reported, 1):
+                return True
+        return False
+
+    def reservation_add(self, service_guid):
+        """
+        add a service to the reserved capacity ledger
+        :param service_guid: guid of a vm, vdisk or gateway service
+        """
+        if self._ledger is None:
+            # the ledger is going to be built from scratch anyway
+            return
+        service = self.api.services.guids.get(service_guid)
+        if service is None or service.template_uid.name not in RESERVED_TEMPLATES:
+            return
+        self._ledger[service.template_uid.name][service_guid] = service
+
+    def reservation_remove(self, service_guid):
+        """
+        remove a service from the reserved capacity ledger
+        :param service_guid: guid of a vm, vdisk or gateway service
+        """
+        if self._ledger is None:
+            return
+        for services in self._ledger.values():
+            services.pop(service_guid, None)
+
     @timeout(300)
     def _reality(self):
         """
         update the real used capacity of the node
         """
         self.logger.info("update the real used capacity of the node")
+        capacity = self._node_sal.capacity
+        report = capacity.reality_report()
         try:
-            self._node_sal.capacity.update_reality()
+            self._send_report('reality', report,
+                              partial(reuse_report, capacity, 'reality_report', report, capacity.update_reality))
             self.state.set('capacity', 'reality', 'ok')
         except:
             self.state.set('capacity', 'reality', 'error')
             raise
+
+    def _send_report(self, name, report, send):
+        """
+        send a report to the directory, unless the same report has already been sent less than
+        reportMaxAge seconds ago. Keep track of the directory calls and schedule the next report,
+        backing off exponentially on errors. The outcome is kept in the reports state category:
+        ok, skipped, warning if the call took more than SLOW_REPORT seconds, or error
+        :param name: name of the report
+        :param report: content of the report, used to detect changes
+        :param send: function sending the report to the directory
+        :return: True if the report has been sent, False if it was skipped
+        """
+        record = self._report_record(name)
+        stats = self._stats.setdefault(name, {
+            'calls': 0, 'errors': 0, 'skipped': 0, 'lastSent': 0, 'lastLatency': 0, 'totalLatency': 0})
+        now = time.time()
+        digest = report_digest(report)
+        if digest and digest == record['digest'] and now - record['lastSent'] < self.data['reportMaxAge']:
+            self.logger.info("%s capacity didn't change, skip report", name)
+            stats['skipped'] += 1
+            self.state.set('reports', name, 'skipped')
+            self._schedule_report(name)
+            return False
+
+        stats['calls'] += 1
+        start = time.time()
+        try:
+            send()
+        except:
+            stats['errors'] += 1
+            self.state.set('reports', name, 'error')
+            self._failures[name] = self._failures.get(name, 0) + 1
+            self._schedule_report(name)
+            raise
+        finally:
+            stats['lastLatency'] = time.time() - start
+            stats['totalLatency'] += stats['lastLatency']
+
+        record['digest'] = digest
+        record['lastSent'] = stats['lastSent'] = int(now)
+        self.state.set('reports', name, 'warning' if stats['lastLatency'] > SLOW_REPORT else 'ok')
+        self._failures[name] = 0
+        self._schedule_report(name)
+        return True
+
+    def _schedule_report(self, name):
+        failures = self._failures.get(name, 0)
+        if failures:
+            delay = min(RETRY_DELAY * 2 ** (failures - 1), MAX_BACKOFF)
+        else:
+            delay = REPORT_INTERVAL
+        # spread the reports of the nodes over time
+        self._next_report[name] = time.time() + random.uniform(delay * 0.9, delay * 1.1)
+
+    def _report_record(self, name):
+        """
+        digest and time of the last report sent, kept in data so unchanged reports are still skipped after a restart
+        """
+        for record in self.data['reports']:
+            if record['name'] == name:
+                return record
+        self.data['reports'].append({'name': name, 'digest': '', 'lastSent': 0})
+        return self.data['reports'][-1]
+
+    def report_stats(self):
+        """
+        return the statistics of the calls made to the capacity directory since the service started.
+        The outcome of the last call of each report is in the reports state category
+        :return: dict with the statistics per report
+        """
+        result = {}
+        for name, stats in self._stats.items():
+            result[name] = {
+                'calls': stats['calls'],
+                'errors': stats['errors'],
+                'skipped': stats['skipped'],
+                'lastSent': stats['lastSent'],
+                'lastLatency': stats['lastLatency'],
+                'avgLatency': stats['totalLatency'] / stats['calls'] if stats['calls'] else 0,
+            }
+        return result
+
+
+def resource_units(ledger):
+    """
+    Compute an estimate of the resource units reserved by the services of the ledger.
+    It is only used to decide when the reserved capacity is reported, the capacity SAL does the actual
+    computation from the same services. The disks of a vm are vdisk urls, their size is counted with the vdisks.
+    A gateway has no size of its own, it is counted as GATEWAY_CRU and GATEWAY_MRU.
+    A change the estimate misses is still reported after reportMaxAge
+    :param ledger: reserved capacity ledger
+    :return: dict with the cru, mru, hru and sru
+    """
+    units = {'cru': 0, 'mru': 0, 'hru': 0, 'sru': 0}
+    for vm in ledger['vm'].values():
+        units['cru'] += vm.data.get('cpu', 0)
+        units['mru'] += vm.data.get('memory', 0) / 1024
+    for vdisk in ledger['vdisk'].values():
+        key = 'sru' if vdisk.data.get('diskType') == 'ssd' else 'hru'
+        units[key] += vdisk.data.get('size', 0)
+    units['cru'] += len(ledger['gateway']) * GATEWAY_CRU
+    units['mru'] += len(ledger['gateway']) * GATEWAY_MRU
+    return units
+
+
+def reuse_report(capacity, builder, report, send):
+    """
+    Call a send method of the capacity SAL, making it use a report that was already built
+    instead of building it again
+    :param capacity: capacity SAL
+    :param builder: name of the method of the capacity SAL building the report
+    :param report: the report already built
+    :param send: method of the capacity SAL sending the report
+    """
+    setattr(capacity, builder, lambda: report)
+    try:
+        send()
+    finally:
+        delattr(capacity, builder)
+
+
+def report_digest(report):
+    """
+    Compute a digest of the resource units of a capacity report
+    :param report: dict with the units or report object of the capacity SAL
+    :return: hex digest, empty string if the report doesn't expose the units
+    """
+    if isinstance(report, dict):
+        units = report
+    else:
+        try:
+            units = {field.lower(): getattr(report, field) for field in REPORT_FIELDS}
+        except AttributeError:
+            return ''
+    content = json.dumps(units, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
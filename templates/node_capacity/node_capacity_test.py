@@ -0,0 +1,192 @@
+import os
+import time
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import pytest
+from JumpscaleZrobot.test.utils import ZrobotBaseTest
+from node_capacity import (GATEWAY_CRU, GATEWAY_MRU, REPORT_INTERVAL, RETRY_DELAY, SLOW_REPORT, NodeCapacity,
+                           report_digest, resource_units)
+
+
+def mock_service(guid, template_name, **data):
+    service = MagicMock(guid=guid, data=data)
+    service.template_uid.name = template_name
+    return service
+
+
+class TestNodeCapacityTemplate(ZrobotBaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        super().preTest(os.path.dirname(__file__), NodeCapacity)
+
+    def setUp(self):
+        patch('jumpscale.j.clients', MagicMock()).start()
+        self.vm = mock_service('vm', 'vm', cpu=2, memory=2048)
+        self.vdisk = mock_service('vdisk', 'vdisk', size=10, diskType='ssd')
+        self.gateway = mock_service('gateway', 'gateway')
+
+    def tearDown(self):
+        patch.stopall()
+
+    def _node_capacity(self):
+        capacity = NodeCapacity(name='_node_capacity')
+        capacity.api = MagicMock()
+        services = {'vm': [self.vm], 'vdisk': [self.vdisk], 'gateway': []}
+        capacity.api.services.find.side_effect = lambda template_name, template_account: services[template_name]
+        capacity.api.services.guids = {service.guid: service for service in (self.vm, self.vdisk, self.gateway)}
+        return capacity
+
+    def test_resource_units(self):
+        ledger = {
+            'vm': {'vm': self.vm},
+            'vdisk': {'vdisk': self.vdisk, 'hdd': mock_service('hdd', 'vdisk', size=100, diskType='hdd')},
+            'gateway': {'gateway': self.gateway},
+        }
+        assert resource_units(ledger) == {
+            'cru': 2 + GATEWAY_CRU,
+            'mru': 2 + GATEWAY_MRU,
+            'hru': 100,
+            'sru': 10,
+        }
+
+    def test_reservation_add_remove(self):
+        capacity = self._node_capacity()
+        capacity._reconcile()
+        assert resource_units(capacity._ledger)['sru'] == 10
+
+        capacity.reservation_add('gateway')
+        assert capacity._ledger['gateway'] == {'gateway': self.gateway}
+
+        capacity.reservation_remove('vdisk')
+        assert capacity._ledger['vdisk'] == {}
+        assert capacity._ledger['vm'] == {'vm': self.vm}
+
+        # unknown services and services that don't reserve capacity are ignored
+        capacity.api.services.guids['container'] = mock_service('container', 'container')
+        capacity.reservation_add('container')
+        capacity.reservation_add('unknown')
+        capacity.reservation_remove('unknown')
+        assert sum(len(services) for services in capacity._ledger.values()) == 2
+
+    def test_reservation_add_before_reconcile(self):
+        capacity = self._node_capacity()
+        capacity.reservation_add('vm')
+        capacity.reservation_remove('vm')
+        assert capacity._ledger is None
+
+    def test_units_changed(self):
+        capacity = self._node_capacity()
+        units = {'cru': 100, 'mru': 100, 'hru': 0, 'sru': 0}
+        assert capacity._units_changed(units)
+
+        capacity._reported_units = units
+        assert not capacity._units_changed(dict(units))
+        assert not capacity._units_changed(dict(units, cru=105))
+        assert capacity._units_changed(dict(units, cru=106))
+        assert capacity._units_changed(dict(units, mru=94))
+        # small values are compared to 1 unit
+        assert not capacity._units_changed(dict(units, hru=0.05))
+        assert capacity._units_changed(dict(units, hru=1))
+
+    def test_report_digest(self):
+        report = SimpleNamespace(CRU=4, MRU=16, HRU=1000, SRU=100, timestamp=time.time(), client=object())
+        same = SimpleNamespace(CRU=4, MRU=16, HRU=1000, SRU=100, timestamp=time.time() + 60, client=object())
+        assert report_digest(report)
+        assert report_digest(report) == report_digest(same)
+        assert report_digest(report) == report_digest({'cru': 4, 'mru': 16, 'hru': 1000, 'sru': 100})
+        assert report_digest(report) != report_digest(SimpleNamespace(CRU=4, MRU=32, HRU=1000, SRU=100))
+        assert report_digest(SimpleNamespace(CRU=4)) == ''
+
+    def test_send_report_skip_unchanged(self):
+        capacity = self._node_capacity()
+        send = MagicMock()
+        report = {'cru': 4, 'mru': 16, 'hru': 0, 'sru': 0}
+
+        assert capacity._send_report('total', report, send)
+        assert not capacity._send_report('total', dict(report), send)
+        assert send.call_count == 1
+        stats = capacity.report_stats()['total']
+        assert stats['calls'] == 1
+        assert stats['skipped'] == 1
+        capacity.state.check('reports', 'total', 'skipped')
+
+        # a changed report is sent right away
+        assert capacity._send_report('total', dict(report, cru=8), send)
+        assert send.call_count == 2
+
+        # an unchanged report is sent again once the last one is older than reportMaxAge
+        capacity._report_record('total')['lastSent'] -= capacity.data['reportMaxAge']
+        assert capacity._send_report('total', dict(report, cru=8), send)
+        assert send.call_count == 3
+        capacity.state.check('reports', 'total', 'ok')
+        assert capacity.data['reports'] == [
+            {'name': 'total', 'digest': report_digest(dict(report, cru=8)), 'lastSent': capacity.report_stats()['total']['lastSent']}]
+
+    def test_send_report_backoff(self):
+        capacity = self._node_capacity()
+        send = MagicMock(side_effect=RuntimeError('directory unavailable'))
+        report = {'cru': 4, 'mru': 16, 'hru': 0, 'sru': 0}
+
+        for failures in (1, 2, 3):
+            now = time.time()
+            with pytest.raises(RuntimeError):
+                capacity._send_report('total', report, send)
+            delay = RETRY_DELAY * 2 ** (failures - 1)
+            assert now + delay * 0.9 <= capacity._next_report['total'] <= time.time() + delay * 1.1
+
+        stats = capacity.report_stats()['total']
+        assert stats['calls'] == 3
+        assert stats['errors'] == 3
+        capacity.state.check('reports', 'total', 'error')
+
+        # a failed report is never considered as sent
+        send.side_effect = None
+        now = time.time()
+        assert capacity._send_report('total', report, send)
+        assert capacity._failures['total'] == 0
+        assert now + REPORT_INTERVAL * 0.9 <= capacity._next_report['total'] <= time.time() + REPORT_INTERVAL * 1.1
+
+    def test_report_schedule(self):
+        capacity = self._node_capacity()
+        capacity._jitter = MagicMock(return_value=60)
+        capacity._total = MagicMock()
+        capacity._reality = MagicMock()
+        capacity._reserved = MagicMock(side_effect=RuntimeError())
+
+        # the first reports are delayed by the jitter
+        capacity._report()
+        capacity._total.assert_not_called()
+
+        for name in capacity._next_report:
+            capacity._next_report[name] = time.time() - 1
+        capacity._report()
+        capacity._total.assert_called_once_with()
+        capacity._reality.assert_called_once_with()
+        # the failed report is retried after a backoff
+        assert capacity._failures['reserved'] == 1
+        assert capacity._next_report['reserved'] > time.time()
+
+    def test_send_report_slow(self):
+        capacity = self._node_capacity()
+        clock = [1000]
+        send = MagicMock(side_effect=lambda: clock.__setitem__(0, clock[0] + SLOW_REPORT + 1))
+        with patch('time.time', lambda: clock[0]):
+            capacity._send_report('total', {'cru': 4}, send)
+        capacity.state.check('reports', 'total', 'warning')
+
+    def test_total_reuses_report(self):
+        capacity = self._node_capacity()
+        capacity_sal = capacity._node_sal.capacity
+        report = SimpleNamespace(CRU=4, MRU=16, HRU=1000, SRU=100)
+        total_report = MagicMock(return_value=report)
+        capacity_sal.total_report = total_report
+        built = []
+        capacity_sal.register.side_effect = lambda: built.append(capacity_sal.total_report())
+
+        capacity._total()
+        # register got the report that was built for the digest, it was not built again
+        assert built == [report]
+        total_report.assert_called_once_with()
+        capacity.state.check('capacity', 'total', 'ok')
@@ -3,6 +3,7 @@ from zerorobot.template.base import TemplateBase
 
 
 NODE_CLIENT = 'local'
+MAX_PORT = 65535
 
 
 class NodePortManager(TemplateBase):
@@ -13,12 +14,23 @@ class NodePortManager(TemplateBase):
     def __init__(self, name, guid=None, data=None):
         super().__init__(name=name, guid=guid, data=data)
         self.node_sal = j.clients.zos.get(NODE_CLIENT)
-        self.recurring_action('_cleanup', 30)  # every 30 seconds
+        # bitmap and guid index of the reserved ports, see _ports_bitmap
+        self._bitmap = None
+        self._guid_ports = {}
+        # services release their ports when they get deleted, see release_service.
+        # the cleanup is only a fallback for services that didn't
+        self.recurring_action('_cleanup', 300)  # every 5 minutes
+
+    def update_data(self, data):
+        # the reservations can have been edited in any way
+        self._bitmap = None
 
     def validate(self):
         services = self.api.services.find(template_name='node_port_manager')
         if services and services[0].guid != self.guid:
             raise RuntimeError('Another node_port_manager service exists. Only one service per node is allowed')
+        if not 0 < self.data['minPort'] <= self.data['maxPort'] <= MAX_PORT:
+            raise ValueError('invalid port range %s-%s' % (self.data['minPort'], self.data['maxPort']))
 
     def _cleanup(self):
         """
@@ -30,37 +42,157 @@ class NodePortManager(TemplateBase):
         are released automatically
         """
         self.logger.info("port manager: start clean up reserved ports")
+        self._ports_bitmap  # make sure the guid index is up to date
         services_guids = self.api.services.guids.keys()
-        for item in list(self.data['ports']):
-            if item['serviceGuid'] not in services_guids:
-                self.logger.info("release port %s that was reserved by %s", item['port'], item['serviceGuid'])
-                self.data['ports'].remove(item)
+        orphans = [guid for guid in self._guid_ports if guid not in services_guids]
+        if not orphans:
+            return
+        for guid in orphans:
+            self.logger.info("release ports %s that were reserved by %s", self._guid_ports[guid], guid)
+        self._release_guids(orphans)
+        self.save()
 
-    def reserve(self, service_guid, n=1):
-        used_ports = [x['port'] for x in self.data['ports']]
-        selected_ports = []
+    def release_service(self, service_guid):
+        """
+        Release all the ports reserved by a service.
+        Services should call this from their delete callback
+        :param service_guid: guid of the service
+        """
+        self._ports_bitmap  # make sure the guid index is up to date
+        if service_guid not in self._guid_ports:
+            return
+        self._release_guids([service_guid])
+        self.save()
+
+    def _release_guids(self, guids):
+        """
+        Remove all reservations of the services with guid in guids in one pass over self.data['ports']
+        """
+        bitmap = self._ports_bitmap
+        guids = set(guids)
+        for guid in guids:
+            for port in self._guid_ports.pop(guid, []):
+                bitmap.clear(port)
+        self.data['ports'] = [item for item in self.data['ports'] if item['serviceGuid'] not in guids]
+
+    def reserve(self, service_guid, n=1, contiguous=False):
+        """
+        Reserve n ports for a service
+        :param service_guid: guid of the service reserving the ports
+        :param n: number of ports to reserve
+        :param contiguous: if True, the ports returned form a single block of consecutive ports
+        :return: list of reserved ports
+        """
+        bitmap = self._ports_bitmap
+        if contiguous:
+            selected_ports = self._reserve_block(bitmap, n)
+        else:
+            selected_ports = self._reserve(bitmap, n)
 
-        for _ in range(n):
-            port = self._reserve(exclude=used_ports)
-            used_ports.append(port)
-            selected_ports.append(port)
+        guid_ports = self._guid_ports.setdefault(service_guid, [])
+        for port in selected_ports:
+            bitmap.set(port)
+            guid_ports.append(port)
             self.data['ports'].append({'port': port, 'serviceGuid': service_guid})
 
         self.save()
         return selected_ports
 
     def release(self, service_guid, ports):
-        for item in list(self.data['ports']):
-            if item['port'] in ports:
-                if item['serviceGuid'] != service_guid:
-                    raise RuntimeError("only service that reserved a port can release it")
-                self.data['ports'].remove(item)
+        bitmap = self._ports_bitmap
+        ports = set(ports)
+        reserved = set(self._guid_ports.get(service_guid, []))
+        for port in ports - reserved:
+            if bitmap.is_set(port):
+                raise RuntimeError("only service that reserved a port can release it")
+
+        released = ports & reserved
+        if not released:
+            return
+
+        self.data['ports'] = [item for item in self.data['ports'] if item['port'] not in released]
+        for port in released:
+            bitmap.clear(port)
+        remaining = [port for port in self._guid_ports[service_guid] if port not in released]
+        if remaining:
+            self._guid_ports[service_guid] = remaining
+        else:
+            del self._guid_ports[service_guid]
         self.save()
 
-    def _reserve(self, exclude):
-        port = self.node_sal.freeports(1)[0]
-        while port in exclude:
-            # this will eventually raised if no port is found
-            port = self.node_sal.freeports(1)[0]
-        #  if we reached here, we found a free port
-        return port
+    def _reserve(self, bitmap, n):
+        """
+        Ask the node for n free ports, skipping the ones already reserved
+        """
+        selected_ports = []
+        while len(selected_ports) < n:
+            # this will eventually raise if no port is found
+            for port in self.node_sal.freeports(n - len(selected_ports)):
+                if not bitmap.is_set(port) and port not in selected_ports:
+                    selected_ports.append(port)
+        return selected_ports
+
+    def _reserve_block(self, bitmap, n):
+        """
+        Find the lowest block of n consecutive ports within minPort-maxPort that are not reserved
+        and that are not in use on the node. The ports in use are read from the node with a single call,
+        instead of asking the node for free ports it would hand out without them being reserved here
+        """
+        used = {item['port'] for item in self.node_sal.client.info.port()}
+        block = find_block(bitmap, used, self.data['minPort'], self.data['maxPort'], n)
+        if block is None:
+            raise RuntimeError('no block of %s free ports available in range %s-%s' % (
+                n, self.data['minPort'], self.data['maxPort']))
+        return block
+
+    @property
+    def _ports_bitmap(self):
+        """
+        Bitmap of the reserved ports and index of the reserved ports by service guid.
+        Both are kept in sync by reserve and release, and rebuilt from self.data['ports']
+        on their next use after update_data
+        """
+        if self._bitmap is None:
+            self._bitmap = PortBitmap()
+            self._guid_ports = {}
+            for item in self.data['ports']:
+                self._bitmap.set(item['port'])
+                self._guid_ports.setdefault(item['serviceGuid'], []).append(item['port'])
+        return self._bitmap
+
+
+class PortBitmap:
+    """
+    Compact set of ports, one bit per port
+    """
+
+    def __init__(self):
+        self._bits = bytearray((MAX_PORT + 1) // 8)
+
+    def set(self, port):
+        self._bits[port >> 3] |= 1 << (port & 7)
+
+    def clear(self, port):
+        self._bits[port >> 3] &= ~(1 << (port & 7)) & 0xff
+
+    def is_set(self, port):
+        return bool(self._bits[port >> 3] & (1 << (port & 7)))
+
+
+def find_block(bitmap, used, first, last, n):
+    """
+    Return the lowest block of n consecutive ports between first and last that are free
+    :param bitmap: PortBitmap of the reserved ports
+    :param used: set of the ports in use on the node
+    :param first: first port of the range
+    :param last: last port of the range
+    :param n: size of the block
+    :return: list of ports, None if there is no such block
+    """
+    start = first
+    for port in range(first, last + 1):
+        if bitmap.is_set(port) or port in used:
+            start = port + 1
+        elif port - start + 1 == n:
+            return list(range(start, port + 1))
+    return None
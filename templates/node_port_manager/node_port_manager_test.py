@@ -1,41 +1,163 @@
-pass
-# import os
-# from unittest.mock import MagicMock, patch
+import os
+from unittest.mock import MagicMock, patch
 
-# import pytest
-# from JumpscaleZrobot.test.utils import ZrobotBaseTest, mock_decorator
-# from node_port_manager import NODE_CLIENT, NodePortManager
-# from zerorobot.template.state import StateCheckError
+import pytest
+from JumpscaleZrobot.test.utils import ZrobotBaseTest
+from node_port_manager import MAX_PORT, NodePortManager, PortBitmap, find_block
 
-# import itertools
 
+class TestNodePortManagerTemplate(ZrobotBaseTest):
 
-# class TestNodePortManagerTemplate(ZrobotBaseTest):
+    @classmethod
+    def setUpClass(cls):
+        super().preTest(os.path.dirname(__file__), NodePortManager)
 
-#     @classmethod
-#     def setUpClass(cls):
-#         super().preTest(os.path.dirname(__file__), NodePortManager)
+    def setUp(self):
+        patch('jumpscale.j.clients', MagicMock()).start()
 
-#     def setUp(self):
-#         patch('jumpscale.j.clients', MagicMock()).start()
+    def tearDown(self):
+        patch.stopall()
 
-#     def tearDown(self):
-#         patch.stopall()
+    def _port_manager(self, ports=None, **data):
+        data['ports'] = ports or []
+        mgr = NodePortManager(name='_port_manager', data=data)
+        mgr.node_sal = MagicMock()
+        mgr.save = MagicMock()
+        return mgr
 
-#     def test_reserve(self):
-#         node_sal = MagicMock()
+    def test_bitmap_edges(self):
+        bitmap = PortBitmap()
+        for port in (0, 7, 8, MAX_PORT):
+            bitmap.set(port)
+        assert all(bitmap.is_set(port) for port in (0, 7, 8, MAX_PORT))
+        assert not any(bitmap.is_set(port) for port in (1, 6, 9, MAX_PORT - 1))
 
-#         def freeports(nrports=1):
-#             import itertools
-#             i = 0
+        bitmap.clear(7)
+        assert not bitmap.is_set(7)
+        assert bitmap.is_set(8)
+        bitmap.clear(MAX_PORT)
+        assert not bitmap.is_set(MAX_PORT)
 
-#             def f():
-#                 while True:
-#                     yield i
-#                     i += 1
-#             iter = f()
-#             return list(itertools.islice(iter, nrports))
+    def test_find_block(self):
+        bitmap = PortBitmap()
+        assert find_block(bitmap, set(), 1024, 2000, 3) == [1024, 1025, 1026]
+        assert find_block(bitmap, set(), 1030, 1030, 1) == [1030]
+        # block across a byte boundary of the bitmap
+        bitmap.set(5)
+        assert find_block(bitmap, set(), 0, 20, 4) == [6, 7, 8, 9]
+        # reserved ports and ports used on the node are skipped
+        bitmap.set(1025)
+        assert find_block(bitmap, {1028}, 1024, 2000, 3) == [1029, 1030, 1031]
+        # block at the end of the port range
+        assert find_block(bitmap, set(), MAX_PORT - 2, MAX_PORT, 3) == [MAX_PORT - 2, MAX_PORT - 1, MAX_PORT]
+        assert find_block(bitmap, {2001}, 2000, 2002, 2) is None
+        assert find_block(bitmap, set(), 2000, 2001, 3) is None
 
-#         node_sal.freeports = freeports
-#         # get_node = patch('jumpscale.j.clients.zos.get', MagicMock(return_value=node_sal)).start()
-#         mgr = NodePortManager(name="name")
+    def test_reserve(self):
+        mgr = self._port_manager(ports=[{'port': 2000, 'serviceGuid': 'other'}])
+        mgr.node_sal.freeports.side_effect = [[2000, 2001], [2002]]
+
+        assert mgr.reserve('guid', n=2) == [2001, 2002]
+        assert {'port': 2001, 'serviceGuid': 'guid'} in mgr.data['ports']
+        assert {'port': 2002, 'serviceGuid': 'guid'} in mgr.data['ports']
+        mgr.save.assert_called_once_with()
+
+    def test_reserve_contiguous(self):
+        mgr = self._port_manager(minPort=2000, maxPort=3000)
+        mgr.node_sal.client.info.port.return_value = [{'network': 'tcp', 'port': 2001}]
+
+        assert mgr.reserve('guid', n=3, contiguous=True) == [2002, 2003, 2004]
+        mgr.node_sal.client.info.port.assert_called_once_with()
+        mgr.node_sal.freeports.assert_not_called()
+        assert [item['port'] for item in mgr.data['ports']] == [2002, 2003, 2004]
+
+    def test_reserve_contiguous_skip_reserved(self):
+        mgr = self._port_manager(ports=[{'port': 2001, 'serviceGuid': 'other'}], minPort=2000, maxPort=3000)
+        mgr.node_sal.client.info.port.return_value = []
+
+        assert mgr.reserve('guid', n=2, contiguous=True) == [2002, 2003]
+        # the block just reserved is skipped by the next reservation
+        assert mgr.reserve('guid', n=2, contiguous=True) == [2004, 2005]
+
+    def test_reserve_contiguous_no_block(self):
+        mgr = self._port_manager(minPort=2000, maxPort=2003)
+        mgr.node_sal.client.info.port.return_value = [{'network': 'tcp', 'port': 2002}]
+
+        with pytest.raises(RuntimeError):
+            mgr.reserve('guid', n=3, contiguous=True)
+        assert mgr.data['ports'] == []
+
+    def test_release(self):
+        mgr = self._port_manager(ports=[
+            {'port': 2000, 'serviceGuid': 'guid'},
+            {'port': 2001, 'serviceGuid': 'guid'},
+            {'port': 2002, 'serviceGuid': 'other'},
+        ])
+
+        mgr.release('guid', [2000])
+        assert mgr.data['ports'] == [{'port': 2001, 'serviceGuid': 'guid'}, {'port': 2002, 'serviceGuid': 'other'}]
+        assert not mgr._ports_bitmap.is_set(2000)
+
+        # releasing a port that is not reserved is a no-op
+        mgr.release('guid', [2000, 3000])
+        assert len(mgr.data['ports']) == 2
+
+    def test_release_not_owner(self):
+        mgr = self._port_manager(ports=[{'port': 2000, 'serviceGuid': 'other'}])
+
+        with pytest.raises(RuntimeError):
+            mgr.release('guid', [2000])
+        assert mgr.data['ports'] == [{'port': 2000, 'serviceGuid': 'other'}]
+        assert mgr._ports_bitmap.is_set(2000)
+
+    def test_release_service(self):
+        mgr = self._port_manager(ports=[
+            {'port': 2000, 'serviceGuid': 'guid'},
+            {'port': 2001, 'serviceGuid': 'other'},
+            {'port': 2002, 'serviceGuid': 'guid'},
+        ])
+
+        mgr.release_service('guid')
+        assert mgr.data['ports'] == [{'port': 2001, 'serviceGuid': 'other'}]
+        assert not mgr._ports_bitmap.is_set(2000)
+        assert not mgr._ports_bitmap.is_set(2002)
+        mgr.save.assert_called_once_with()
+
+        # nothing reserved anymore, nothing to save
+        mgr.release_service('guid')
+        mgr.save.assert_called_once_with()
+
+    def test_cleanup(self):
+        mgr = self._port_manager(ports=[
+            {'port': 2000, 'serviceGuid': 'deleted'},
+            {'port': 2001, 'serviceGuid': 'guid'},
+            {'port': 2002, 'serviceGuid': 'deleted'},
+        ])
+        mgr.api = MagicMock()
+        mgr.api.services.guids = {'guid': MagicMock()}
+
+        mgr._cleanup()
+        assert mgr.data['ports'] == [{'port': 2001, 'serviceGuid': 'guid'}]
+        assert not mgr._ports_bitmap.is_set(2000)
+        mgr.save.assert_called_once_with()
+
+    def test_cleanup_no_orphans(self):
+        mgr = self._port_manager(ports=[{'port': 2001, 'serviceGuid': 'guid'}])
+        mgr.api = MagicMock()
+        mgr.api.services.guids = {'guid': MagicMock()}
+
+        mgr._cleanup()
+        assert len(mgr.data['ports']) == 1
+        mgr.save.assert_not_called()
+
+    def test_update_data(self):
+        mgr = self._port_manager(ports=[{'port': 2000, 'serviceGuid': 'guid'}])
+        assert mgr._ports_bitmap.is_set(2000)
+
+        # same number of reservations, different ports
+        mgr.data['ports'] = [{'port': 2001, 'serviceGuid': 'guid'}]
+        mgr.update_data(mgr.data)
+        assert not mgr._ports_bitmap.is_set(2000)
+        assert mgr._ports_bitmap.is_set(2001)
+        mgr.release_service('guid')
+        assert mgr.data['ports'] == []
@@ -1,10 +1,17 @@
 from jumpscale import j
 import copy
 import netaddr
+from gevent.pool import Pool
 from zerorobot.template.base import TemplateBase
 
 NODE_CLIENT = 'local'
 GATEWAY_TEMPLATE_UID = 'github.com/threefoldtech/0-templates/gateway/0.0.1'
+PARALLEL_ACTIONS = 10
+# gateway actions used to push portforwards and http proxies: batch, add, remove and the argument name of add
+GATEWAY_ACTIONS = {
+    'portforwards': ('apply_portforwards', 'add_portforward', 'remove_portforward', 'forward'),
+    'httpproxies': ('apply_http_proxies', 'add_http_proxy', 'remove_http_proxy', 'proxy'),
+}
 
 
 class PublicGateway(TemplateBase):
@@ -14,6 +21,8 @@ class PublicGateway(TemplateBase):
     def __init__(self, name, guid=None, data=None):
         super().__init__(name=name, guid=guid, data=data)
         self.add_delete_callback(self.uninstall)
+        # last info received from the gateway service
+        self._gwinfo = None
 
     def validate(self):
         services = self.api.services.find(template_uid=GATEWAY_TEMPLATE_UID, name='publicgw')
@@ -47,20 +56,76 @@ class PublicGateway(TemplateBase):
         return self.api.services.get(template_uid=GATEWAY_TEMPLATE_UID, name='publicgw')
 
     def install(self):
+        """
+        Push the portforwards and http proxies to the gateway.
+        Only the ones missing on the gateway are pushed, so calling install again
+        after a failure only retries the failed items
+        """
         self.logger.info('Install public gateway {}'.format(self.name))
+        gwinfo = self._gateway_info()
+        failed = []
+        for kind in GATEWAY_ACTIONS:
+            applied = {item['name'] for item in gwinfo[kind]}
+            pending = []
+            for item in self.data[kind]:
+                if self._prefix_name(item['name']) in applied:
+                    self.state.set(kind, item['name'], 'ok')
+                else:
+                    pending.append(item)
+            failed.extend(self._push(kind, pending))
+        if failed:
+            raise RuntimeError('Failed to apply {} on the gateway'.format(', '.join(failed)))
+
+    def _push(self, kind, items, remove=False):
+        """
+        Add or remove portforwards or http proxies on the gateway with a single batch call.
+        If the batch fails, the items are pushed one by one, PARALLEL_ACTIONS at a time, to find out
+        which ones fail. The result of each item is kept in the state under the kind
+        :param kind: portforwards or httpproxies
+        :param items: portforwards or http proxies
+        :param remove: remove the items instead of adding them
+        :return: names of the items that failed
+        """
+        if not items:
+            return []
+        batch_action, add_action, remove_action, arg = GATEWAY_ACTIONS[kind]
+        if remove:
+            gwitems = [self._prefix_name(item['name']) for item in items]
+        elif kind == 'portforwards':
+            gwitems = [self._gateway_forward(item) for item in items]
+        else:
+            gwitems = [self._gateway_proxy(item) for item in items]
+
         gw_service = self._gateway_service
-        portforwards = self.data.get('portforwards')
-        for portforward in portforwards:
-            fwd = copy.deepcopy(portforward)
-            fwd['srcnetwork'] = 'public'
-            fwd['name'] = self._prefix_name(portforward['name'])
-            gw_service.schedule_action('add_portforward', args={'forward': fwd}).wait(die=True)
-
-        proxies = self.data.get('httpproxies')
-        for proxy in proxies:
-            p = copy.deepcopy(proxy)
-            p['name'] = self._prefix_name(proxy['name'])
-            gw_service.schedule_action('add_http_proxy', args={'proxy': p}).wait(die=True)
+        failed = set()
+        try:
+            args = {'remove': gwitems} if remove else {'add': gwitems}
+            gw_service.schedule_action(batch_action, args=args).wait(die=True)
+        except Exception:
+            self.logger.exception('Failed to apply {} {} in batch, applying them one by one'.format(len(items), kind))
+
+            def push(gwitem):
+                if remove:
+                    gw_service.schedule_action(remove_action, args={'name': gwitem}).wait(die=True)
+                else:
+                    gw_service.schedule_action(add_action, args={arg: gwitem}).wait(die=True)
+
+            pool = Pool(PARALLEL_ACTIONS)
+            greenlets = [(item, pool.spawn(push, gwitem)) for item, gwitem in zip(items, gwitems)]
+            pool.join()
+            for item, greenlet in greenlets:
+                if greenlet.exception:
+                    self.logger.error('Failed to apply {} {}: {}'.format(kind, item['name'], greenlet.exception))
+                    failed.add(item['name'])
+
+        for item in items:
+            if item['name'] in failed:
+                self.state.set(kind, item['name'], 'error')
+            elif remove:
+                self.state.delete(kind, item['name'])
+            else:
+                self.state.set(kind, item['name'], 'ok')
+        return sorted(failed)
 
     def get_zt_member(self, identity):
         address = identity.split(':')[0]
@@ -73,15 +138,24 @@ class PublicGateway(TemplateBase):
     def add_portforward(self, forward):
         self.logger.info('Add portforward {}'.format(forward['name']))
         gw_service = self._gateway_service
-        fwd = copy.deepcopy(forward)
-        fwd['srcnetwork'] = 'public'
-        fwd['name'] = self._prefix_name(forward['name'])
+        fwd = self._gateway_forward(forward)
         gw_service.schedule_action('add_portforward', args={'forward': fwd}).wait(die=True)
         self.data['portforwards'].append(forward)
 
     def _prefix_name(self, name):
         return '{}_{}'.format(self.guid, name)
 
+    def _gateway_forward(self, forward):
+        fwd = copy.deepcopy(forward)
+        fwd['srcnetwork'] = 'public'
+        fwd['name'] = self._prefix_name(forward['name'])
+        return fwd
+
+    def _gateway_proxy(self, proxy):
+        gwproxy = copy.deepcopy(proxy)
+        gwproxy['name'] = self._prefix_name(proxy['name'])
+        return gwproxy
+
     def remove_portforward(self, name):
         self.logger.info('Remove portforward {}'.format(name))
         pname = self._prefix_name(name)
@@ -93,8 +167,7 @@ class PublicGateway(TemplateBase):
 
     def add_http_proxy(self, proxy):
         self.logger.info('Add http proxy {}'.format(proxy['name']))
-        gwproxy = copy.deepcopy(proxy)
-        gwproxy['name'] = self._prefix_name(proxy['name'])
+        gwproxy = self._gateway_proxy(proxy)
         self._gateway_service.schedule_action('add_http_proxy', args={'proxy': gwproxy}).wait(die=True)
         self.data['httpproxies'].append(proxy)
 
@@ -107,8 +180,57 @@ class PublicGateway(TemplateBase):
                 self.data['httpproxies'].remove(proxy)
                 return
 
+    def apply_changes(self, add_portforwards=None, remove_portforwards=None, add_httpproxies=None, remove_httpproxies=None):
+        """
+        Add and remove a batch of portforwards and http proxies with one call to the gateway per kind.
+        If the http proxies can't be applied, the portforwards are restored
+        :param add_portforwards: list of portforwards to add
+        :param remove_portforwards: list of names of the portforwards to remove, unknown names are ignored
+        :param add_httpproxies: list of http proxies to add
+        :param remove_httpproxies: list of names of the http proxies to remove, unknown names are ignored
+        """
+        add_portforwards = add_portforwards or []
+        add_httpproxies = add_httpproxies or []
+        remove_portforwards = set(remove_portforwards or [])
+        remove_httpproxies = set(remove_httpproxies or [])
+        removed_forwards = [fwd for fwd in self.data['portforwards'] if fwd['name'] in remove_portforwards]
+        removed_proxies = [proxy for proxy in self.data['httpproxies'] if proxy['name'] in remove_httpproxies]
+        self.logger.info('Apply changes: portforwards add {} remove {}, http proxies add {} remove {}'.format(
+            len(add_portforwards), len(removed_forwards), len(add_httpproxies), len(removed_proxies)))
+        gw_service = self._gateway_service
+
+        forwards_changed = bool(add_portforwards or removed_forwards)
+        if forwards_changed:
+            args = {
+                'add': [self._gateway_forward(fwd) for fwd in add_portforwards],
+                'remove': [self._prefix_name(fwd['name']) for fwd in removed_forwards],
+            }
+            gw_service.schedule_action('apply_portforwards', args=args).wait(die=True)
+
+        if add_httpproxies or removed_proxies:
+            args = {
+                'add': [self._gateway_proxy(proxy) for proxy in add_httpproxies],
+                'remove': [self._prefix_name(proxy['name']) for proxy in removed_proxies],
+            }
+            try:
+                gw_service.schedule_action('apply_http_proxies', args=args).wait(die=True)
+            except:
+                if forwards_changed:
+                    self.logger.error('Failed to apply http proxies, restoring portforwards')
+                    args = {
+                        'add': [self._gateway_forward(fwd) for fwd in removed_forwards],
+                        'remove': [self._prefix_name(fwd['name']) for fwd in add_portforwards],
+                    }
+                    gw_service.schedule_action('apply_portforwards', args=args).wait(die=True)
+                raise
+
+        self.data['portforwards'] = [fwd for fwd in self.data['portforwards']
+                                     if fwd['name'] not in remove_portforwards] + add_portforwards
+        self.data['httpproxies'] = [proxy for proxy in self.data['httpproxies']
+                                    if proxy['name'] not in remove_httpproxies] + add_httpproxies
+
     def info(self):
-        gwinfo = self._gateway_service.schedule_action('info').wait(die=True).result
+        gwinfo = self._gateway_info()
         publicip = ''
         zerotierId = ''
         for network in gwinfo['networks']:
@@ -125,16 +247,42 @@ class PublicGateway(TemplateBase):
         }
         return data
 
+    def _gateway_info(self):
+        """
+        Get the info of the gateway service, the gateway only returns its full info
+        when it changed since the last call
+        """
+        cached = self._gwinfo
+        if cached:
+            args = {'generation': cached['generation']}
+            gwinfo = self._gateway_service.schedule_action('info', args=args).wait(die=True).result
+        else:
+            gwinfo = self._gateway_service.schedule_action('info').wait(die=True).result
+        if cached and gwinfo.get('unchanged'):
+            return cached
+        if 'generation' in gwinfo:
+            self._gwinfo = gwinfo
+        return gwinfo
+
     def uninstall(self):
-        gw_service = self._gateway_service
+        """
+        Remove the portforwards and http proxies from the gateway.
+        Only the ones still present on the gateway are removed, so calling uninstall again
+        after a failure only retries the failed items
+        """
         self.logger.info('Uninstall publicservice {}'.format(self.name))
-        for portforward in self.data['portforwards']:
-            name = self._prefix_name(portforward['name'])
-            gw_service.schedule_action('remove_portforward', args={'name': name}).wait(die=True)
-
-        proxies = self.data.get('httpproxies')
-        for proxy in proxies:
-            name = self._prefix_name(proxy['name'])
-            gw_service.schedule_action('remove_http_proxy', args={'name': name}).wait(die=True)
+        gwinfo = self._gateway_info()
+        failed = []
+        for kind in GATEWAY_ACTIONS:
+            applied = {item['name'] for item in gwinfo[kind]}
+            pending = []
+            for item in self.data[kind]:
+                if self._prefix_name(item['name']) in applied:
+                    pending.append(item)
+                else:
+                    self.state.delete(kind, item['name'])
+            failed.extend(self._push(kind, pending, remove=True))
+        if failed:
+            raise RuntimeError('Failed to remove {} from the gateway'.format(', '.join(failed)))
 
 
@@ -31,7 +31,39 @@ class TestPublicGatewayTemplate(ZrobotBaseTest):
 
     def test_install(self):
         self.service.install()
-        assert self.gwservice.schedule_action.call_count == 2
+        self.gwservice.schedule_action.assert_any_call('apply_portforwards', args=AlwaysTrue())
+        self.gwservice.schedule_action.assert_any_call('apply_http_proxies', args=AlwaysTrue())
+        assert self.gwservice.schedule_action.call_count == 3
+        self.service.state.check('portforwards', 'ssh', 'ok')
+        self.service.state.check('httpproxies', 'httpproxy', 'ok')
+
+    def _schedule_action(self, gwinfo, failing):
+        def schedule_action(action, args=None):
+            task = MagicMock()
+            if action == 'info':
+                task.wait.return_value.result = gwinfo
+            elif action in failing:
+                task.wait.side_effect = RuntimeError()
+            return task
+        return schedule_action
+
+    def test_install_batch_failure(self):
+        gwinfo = {'portforwards': [], 'httpproxies': [], 'networks': []}
+        self.gwservice.schedule_action.side_effect = self._schedule_action(gwinfo, ['apply_portforwards', 'add_portforward'])
+        with pytest.raises(RuntimeError):
+            self.service.install()
+        self.gwservice.schedule_action.assert_any_call('add_portforward', args=AlwaysTrue())
+        self.service.state.check('portforwards', 'ssh', 'error')
+        self.service.state.check('httpproxies', 'httpproxy', 'ok')
+
+        # a retry only pushes the failed portforward
+        gwinfo['httpproxies'].append({'name': self.service._prefix_name('httpproxy')})
+        self.gwservice.schedule_action.reset_mock()
+        self.gwservice.schedule_action.side_effect = self._schedule_action(gwinfo, [])
+        self.service.install()
+        actions = [c[0][0] for c in self.gwservice.schedule_action.call_args_list]
+        assert actions == ['info', 'apply_portforwards']
+        self.service.state.check('portforwards', 'ssh', 'ok')
 
     def test_info(self):
         info = self.service.info()
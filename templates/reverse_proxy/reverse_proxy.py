@@ -1,6 +1,3 @@
-from jumpscale import j
-from JumpscaleLib.sal.webgateway.errors import \
-    ServiceNotFoundError as WgServiceNotFound
 from zerorobot.service_collection import ServiceNotFoundError
 from zerorobot.template.base import TemplateBase
 from zerorobot.template.decorator import retry
@@ -22,38 +19,32 @@ class ReverseProxy(TemplateBase):
             if not self.data[key]:
                 raise ValueError('Invalid value for {}'.format(key))
 
-    def _webgateway_sal(self):
-        web_gateway = self.api.services.get(template_uid=WEB_GATEWAY_TEMPLATE_UID, name=self.data['webGateway'])
-        web_gateway.state.check('status', 'running', 'ok')
-        return j.sal.webgateway.get(self.data['webGateway'])
+    def _web_gateway(self):
+        return self.api.services.get(template_uid=WEB_GATEWAY_TEMPLATE_UID, name=self.data['webGateway'])
+
+    def _register(self):
+        proxy = {'name': self.name, 'domain': self.data['domain'], 'servers': self.data['servers']}
+        task = self._web_gateway().schedule_action('register_proxies', args={'proxies': [proxy]})
+        result = task.wait(die=True).result[self.name]
+        if result != 'ok':
+            raise RuntimeError('Failed to register reverse proxy {}: {}'.format(self.name, result))
 
     @retry(Exception, tries=3, delay=1, backoff=2, logger=None)
     def install(self):
-        web_gateway = self._webgateway_sal()
-        try:
-            service = web_gateway.service_get(self.name)
-        except WgServiceNotFound:
-            service = web_gateway.service_create(self.name)
-        service.expose(self.data['domain'], self.data['servers'])
+        self._register()
         self.state.set('actions', 'install', 'ok')
 
     @retry(Exception, tries=3, delay=1, backoff=2, logger=None)
     def update_servers(self, servers):
         self.state.check('actions', 'install', 'ok')
         self.data['servers'] = servers
-        web_gateway = self._webgateway_sal()
-        service = web_gateway.service_get(self.name)
-        service.proxy.backend_set(servers)
-        service.deploy()
+        self._register()
 
     @retry(Exception, tries=3, delay=1, backoff=2, logger=None)
     def uninstall(self):
         try:
-            web_gateway = self._webgateway_sal()
-            service = web_gateway.service_get(self.name)
-            service.delete()
-        except (ServiceNotFoundError, WgServiceNotFound):
-            # Either web_gateway doesn't exist anymore or the reverse_proxy doesn't exist
-            # and in both cases nothing needs to be done
+            self._web_gateway().schedule_action('unregister_proxies', args={'names': [self.name]}).wait(die=True)
+        except ServiceNotFoundError:
+            # web_gateway doesn't exist anymore, nothing needs to be done
             pass
         self.state.delete('actions', 'install')
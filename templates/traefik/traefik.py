@@ -93,7 +93,25 @@ class Traefik(TemplateBase):
         self.state.delete('status', 'running')
 
     def update_endpoint(self, etcd_endpoint):
+        """
+        Point traefik to new etcd endpoints.
+        The etcd endpoints are part of the static configuration of traefik which it can't reload
+        while running, so the process is restarted, unless the endpoints didn't change
+        :param etcd_endpoint: comma separated list of etcd endpoints
+        :return: True if traefik was restarted
+        """
+        if etcd_endpoint == self.data['etcdEndpoint']:
+            return False
         self.data['etcdEndpoint'] = etcd_endpoint
         self.state.check('actions', 'start', 'ok')
-        self._traefik_sal.stop()
-        self._traefik_sal.start()
+        traefik_sal = self._traefik_sal
+        traefik_sal.stop()
+        traefik_sal.start()
+        return True
+
+    def is_running(self):
+        """
+        check the traefik process is running
+        :return: True if traefik is running
+        """
+        return self._traefik_sal.is_running()
@@ -4,6 +4,7 @@ from zerorobot.template.state import StateCheckError
 from zerorobot.service_collection import ServiceNotFoundError
 
 ZERODB_TEMPLATE_UID = 'github.com/threefoldtech/0-templates/zerodb/0.0.1'
+CAPACITY_TEMPLATE_UID = 'github.com/threefoldtech/0-templates/node_capacity/0.0.1'
 NODE_CLIENT = 'local'
 
 
@@ -15,7 +16,9 @@ class Vdisk(TemplateBase):
     def __init__(self, name=None, guid=None, data=None):
         super().__init__(name=name, guid=guid, data=data)
         self.add_delete_callback(self.uninstall)
-        self.recurring_action('_monitor', 10)
+        # status changes are pushed by the zerodb, see zerodb_status_update.
+        # the monitor is only a safety net
+        self.recurring_action('_monitor', 300)
         if not self.data.get('password'):
             self.data['password'] = j.data.idgenerator.generateXCharID(32)
 
@@ -45,10 +48,27 @@ class Vdisk(TemplateBase):
     def _monitor(self):
         self.state.check('actions', 'install', 'ok')
 
+        zerodb = self._zerodb
+        zerodb.schedule_action('subscribe', args={'guid': self.guid})
         try:
-            self._zerodb.state.check('status', 'running', 'ok')
-            self.state.set('status', 'running', 'ok')
+            zerodb.state.check('status', 'running', 'ok')
+            self.zerodb_status_update(True)
+        except StateCheckError:
+            self.zerodb_status_update(False)
+
+    def zerodb_status_update(self, running):
+        """
+        Called by the zerodb this vdisk lives on when its running status changes
+        :param running: boolean indicating if the zerodb is running
+        """
+        try:
+            self.state.check('actions', 'install', 'ok')
         except StateCheckError:
+            return
+
+        if running:
+            self.state.set('status', 'running', 'ok')
+        else:
             data = {
                     'attributes': {},
                     'resource': self.guid,
@@ -83,6 +103,7 @@ class Vdisk(TemplateBase):
         # use the method on the node service to create the zdb and the namespace.
         # this action hold the logic of the capacity planning for the zdb and namespaces
         self.data['zerodb'], self.data['nsName'] = node.schedule_action('create_zdb_namespace', kwargs).wait(die=True).result
+        self._zerodb.schedule_action('subscribe', args={'guid': self.guid})
 
         zerodb_data = self._zerodb.data.copy()
         zerodb_data['name'] = self._zerodb.name
@@ -95,6 +116,7 @@ class Vdisk(TemplateBase):
                                                      size=int(self.data['size']),
                                                      label=self.data['label'])
         disk.deploy()
+        self._update_reserved_capacity('reservation_add')
 
         self.state.set('actions', 'install', 'ok')
         self.state.set('status', 'running', 'ok')
@@ -105,13 +127,26 @@ class Vdisk(TemplateBase):
 
     def url(self):
         self.state.check('actions', 'install', 'ok')
-        return self._zerodb.schedule_action('namespace_url', args={'name': self.data['nsName']}).wait(die=True).result
+        return self._zerodb.cached_action('namespace_url', args={'name': self.data['nsName']})
 
     def private_url(self):
         self.state.check('actions', 'install', 'ok')
-        return self._zerodb.schedule_action('namespace_private_url', args={'name': self.data['nsName']}).wait(die=True).result
+        return self._zerodb.cached_action('namespace_private_url', args={'name': self.data['nsName']})
 
     def uninstall(self):
         self._zerodb.schedule_action('namespace_delete', args={'name': self.data['nsName']}).wait(die=True)
+        self._zerodb.schedule_action('unsubscribe', args={'guid': self.guid})
+        self._update_reserved_capacity('reservation_remove')
         self.state.delete('actions', 'install')
         self.state.delete('status', 'running')
+
+    def _update_reserved_capacity(self, action):
+        """
+        notify the node capacity service that this service reserves or releases capacity
+        :param action: reservation_add or reservation_remove
+        """
+        try:
+            capacity = self.api.services.get(template_uid=CAPACITY_TEMPLATE_UID, name='_node_capacity')
+        except ServiceNotFoundError:
+            return
+        capacity.schedule_action(action, args={'service_guid': self.guid})
@@ -89,7 +89,7 @@ class TestVdiskTemplate(ZrobotBaseTest):
             'public': False,
             'ns_size': int(vdisk.data['size']),
         }
-        node.schedule_action.assert_called_once_with('create_zdb_namespace', args)
+        node.schedule_action.assert_any_call('create_zdb_namespace', args)
         vdisk.state.check('actions', 'install', 'ok')
         assert vdisk.data['nsName'] == 'ns_name'
         assert vdisk.data['zerodb'] == 'instance'
@@ -116,7 +116,7 @@ class TestVdiskTemplate(ZrobotBaseTest):
         vdisk.state.set('actions', 'install', 'ok')
         vdisk.api = MagicMock()
         vdisk.uninstall()
-        vdisk._zerodb.schedule_action.assert_called_once_with('namespace_delete', args={'name': 'ns_name'})
+        vdisk._zerodb.schedule_action.assert_any_call('namespace_delete', args={'name': 'ns_name'})
 
     def test_url_without_install(self):
         with pytest.raises(StateCheckError, message='Executing info action without install should raise an error'):
@@ -128,10 +128,10 @@ class TestVdiskTemplate(ZrobotBaseTest):
         vdisk.data['nsName'] = 'ns_name'
         vdisk.state.set('actions', 'install', 'ok')
         vdisk.api = MagicMock()
-        vdisk._zerodb.schedule_action = MagicMock(return_value=task_mock('url'))
+        vdisk._zerodb.cached_action.return_value = 'url'
 
         assert vdisk.url() == 'url'
-        vdisk._zerodb.schedule_action.assert_called_once_with('namespace_url', args={'name': 'ns_name'})
+        vdisk._zerodb.cached_action.assert_called_once_with('namespace_url', args={'name': 'ns_name'})
 
     def test_private_url_without_install(self):
         with pytest.raises(StateCheckError, message='Executing info action without install should raise an error'):
@@ -143,7 +143,7 @@ class TestVdiskTemplate(ZrobotBaseTest):
         vdisk.data['nsName'] = 'ns_name'
         vdisk.state.set('actions', 'install', 'ok')
         vdisk.api = MagicMock()
-        vdisk._zerodb.schedule_action = MagicMock(return_value=task_mock('url'))
+        vdisk._zerodb.cached_action.return_value = 'url'
 
         assert vdisk.private_url() == 'url'
-        vdisk._zerodb.schedule_action.assert_called_once_with('namespace_private_url', args={'name': 'ns_name'})
+        vdisk._zerodb.cached_action.assert_called_once_with('namespace_private_url', args={'name': 'ns_name'})
@@ -10,6 +10,7 @@ from zerorobot.template.state import StateCheckError
 NODE_CLIENT = 'local'
 VDISK_TEMPLATE_UID = 'github.com/threefoldtech/0-templates/vdisk/0.0.1'
 PORT_MANAGER_TEMPLATE_UID = 'github.com/threefoldtech/0-templates/node_port_manager/0.0.1'
+CAPACITY_TEMPLATE_UID = 'github.com/threefoldtech/0-templates/node_capacity/0.0.1'
 
 
 class Vm(TemplateBase):
@@ -110,6 +111,7 @@ class Vm(TemplateBase):
         vm_sal.deploy()
         self.data['uuid'] = vm_sal.uuid
         self.data['ztIdentity'] = vm_sal.zt_identity
+        self._update_reserved_capacity('reservation_add')
 
         self.state.set('actions', 'install', 'ok')
         self.state.set('actions', 'start', 'ok')
@@ -123,6 +125,7 @@ class Vm(TemplateBase):
         self._vm_sal.destroy()
 
         self._release_ports()
+        self._update_reserved_capacity('reservation_remove')
 
         self.data['info'] = None  # force relaod if info action data
         self.state.delete('actions', 'install')
@@ -290,10 +293,20 @@ class Vm(TemplateBase):
 
     @retry(exceptions=ServiceNotFoundError, tries=3, delay=3, backoff=2)
     def _release_ports(self):
-        port_mgr = self.api.services.get(template_uid=PORT_MANAGER_TEMPLATE_UID, name='_port_manager')
-        ports = [x['source'] for x in self.data['ports']]
-        if not ports:
+        if not self.data['ports']:
             return
-        port_mgr.schedule_action("release", {"service_guid": self.guid, 'ports': ports})
+        port_mgr = self.api.services.get(template_uid=PORT_MANAGER_TEMPLATE_UID, name='_port_manager')
+        port_mgr.schedule_action("release_service", {"service_guid": self.guid})
         for port in self.data['ports']:
             port['source'] = None
+
+    def _update_reserved_capacity(self, action):
+        """
+        notify the node capacity service that this service reserves or releases capacity
+        :param action: reservation_add or reservation_remove
+        """
+        try:
+            capacity = self.api.services.get(template_uid=CAPACITY_TEMPLATE_UID, name='_node_capacity')
+        except ServiceNotFoundError:
+            return
+        capacity.schedule_action(action, args={'service_guid': self.guid})
@@ -1,10 +1,14 @@
 import json
+import time
 from copy import deepcopy
+from functools import partial
 
 from requests import HTTPError
 
 import gevent
+from etcd3.exceptions import ConnectionFailedError, ConnectionTimeoutError
 from jumpscale import j
+from JumpscaleLib.sal.webgateway.errors import ServiceNotFoundError as WgServiceNotFound
 from zerorobot.service_collection import ServiceNotFoundError
 from zerorobot.template.base import TemplateBase
 from zerorobot.template.state import StateCheckError
@@ -13,6 +17,17 @@ ETCD_CLUSTER_TEMPLATE_UID = 'github.com/threefoldtech/0-templates/etcd_cluster/0
 TRAEFIK_TEMPLATE_UID = 'github.com/threefoldtech/0-templates/traefik/0.0.1'
 ZT_TEMPLATE_UID = 'github.com/threefoldtech/0-templates/zerotier_client/0.0.1'
 COREDNS_TEMPLATE_UID = 'github.com/threefoldtech/0-templates/coredns/0.0.1'
+CHECK_TIMEOUT = 10  # deadline of each health check of the monitor
+CONNECTION_TIMEOUT = 30  # deadline of the connection info of the etcd cluster, longer than the deadline it gives each etcd
+UPDATE_TIMEOUT = 60  # deadline of each endpoint update pushed by the monitor
+ROLLING_DELAY = 5  # time given to a traefik to load its configuration before the next node is updated
+ETCD_RETRY_DELAY = 30  # an etcd that failed is only used again after this delay, unless all the others failed too
+INSTALL_TIMEOUT = 600  # deadline of the installation of traefik and coredns on one public node
+INSTALL_ATTEMPTS = 3  # number of times the installation is tried on a public node before giving up
+INSTALL_RETRY_DELAY = 10  # time between two installation attempts on the public nodes that failed
+# errors that mean an etcd can't be reached, as opposed to errors of a single item
+ETCD_CONNECTION_ERRORS = (ConnectionError, TimeoutError, ConnectionFailedError, ConnectionTimeoutError, gevent.Timeout)
+LIST_PROXIES_MIN = 20  # batches of at least this many proxies list the existing proxies instead of looking them up by name
 
 
 class WebGateway(TemplateBase):
@@ -28,6 +43,13 @@ class WebGateway(TemplateBase):
         self._etcds_name = 'etcds_%s' % self.guid
         self._coredns_name = "coredns_%s" % self.guid
         self._traefik_name = "traefik_%s" % self.guid
+        # (public node, traefik or coredns) that still need the latest etcd endpoints
+        self._endpoints_pending = set()
+        # webgateway sals connected to each etcd of the cluster, see _webgateway_pool
+        self._etcd_pool = []
+        self._etcd_pool_key = None
+        self._etcd_pool_index = 0
+        self._etcd_down = {}
         self.recurring_action('_monitor', 30)  # every 30 seconds
 
     def _monitor(self):
@@ -37,21 +59,98 @@ class WebGateway(TemplateBase):
         except StateCheckError:
             return
 
-        try:
-            self._etcd_cluster.state.check('status', 'running', 'ok')
-            for node_id in self.data['publicNodes']:
-                self._traefik(node_id).state.check('status', 'running', 'ok')
-                self._coredns(node_id).state.check('status', 'running', 'ok')
-            self.state.set('status', 'running', 'ok')
-        except StateCheckError:
-            self.state.set('status', 'running', 'error')
-
-        cluster_connection = self._etcd_cluster.schedule_action('connection_info').wait(die=True).result
-        if self.data['etcdConnectionInfo']['etcds'] != cluster_connection['etcds']:
+        # all the checks run at the same time, so an unreachable node only delays the monitor by CHECK_TIMEOUT
+        connection = gevent.spawn(gather, {
+            'connection': lambda: self._etcd_cluster.schedule_action('connection_info').wait(die=True).result,
+        }, CONNECTION_TIMEOUT)
+        checks = {'etcd_cluster': partial(self._check_running, self._etcd_cluster)}
+        for node_id in self.data['publicNodes']:
+            checks[(node_id, 'traefik')] = partial(self._check_running, self._traefik, node_id)
+            checks[(node_id, 'coredns')] = partial(self._check_running, self._coredns, node_id)
+        results = gather(checks, CHECK_TIMEOUT)
+        results.update(connection.get())
+
+        running = results['etcd_cluster'][1] is None
+        if not running:
+            self.logger.error('etcd cluster is not running: %s', results['etcd_cluster'][1])
+        for node_id in self.data['publicNodes']:
+            node_running = True
+            for kind in ('traefik', 'coredns'):
+                err = results[(node_id, kind)][1]
+                if err is not None:
+                    self.logger.error('%s on node %s is not running: %s', kind, node_id, err)
+                    node_running = False
+            self.state.set('nodes', node_id, 'ok' if node_running else 'error')
+            running = running and node_running
+        self.state.set('status', 'running', 'ok' if running else 'error')
+
+        cluster_connection, err = results['connection']
+        if err is not None:
+            self.logger.error('failed to get the etcd cluster connection info: %s', err)
+        elif cluster_connection.get('missing'):
+            # keep the endpoints of the etcds that didn't answer rather than dropping them
+            self.logger.warning('etcds %s of the etcd cluster did not answer, keep the current endpoints',
+                                ', '.join(cluster_connection['missing']))
+        elif self.data['etcdConnectionInfo']['etcds'] != cluster_connection['etcds']:
             self.data['etcdConnectionInfo']['etcds'] = cluster_connection['etcds']
-            for node_id in self.data['publicNodes']:
-                self._coredns(node_id).schedule_action('update_endpoint', args=self._coredns_endpoint()).wait(die=True)
-                self._traefik(node_id).schedule_action('update_endpoint', args=self._traefik_endpoint()).wait(die=True)
+            self._endpoints_pending = {(node_id, kind) for node_id in self.data['publicNodes']
+                                       for kind in ('traefik', 'coredns')}
+        if self._endpoints_pending:
+            self._push_endpoints()
+
+    def _check_running(self, get_service, *args):
+        get_service(*args).state.check('status', 'running', 'ok')
+
+    def _push_endpoints(self):
+        """
+        Push the etcd endpoints to the traefik and coredns of the public nodes that don't have them yet.
+        The coredns are all updated at the same time. Updating traefik restarts it, so the traefik are
+        updated one node at a time: the nodes that can't be updated are skipped, and the rollout stops
+        at the first traefik that isn't running after its restart.
+        The updates that are not done are retried on the next run of the monitor
+        """
+        coredns_args = {'etcd_endpoint': self._coredns_endpoint()}
+        traefik_args = {'etcd_endpoint': self._traefik_endpoint()}
+        updates = {}
+        for node_id, kind in self._endpoints_pending:
+            if kind == 'coredns':
+                updates[(node_id, kind)] = partial(self._update_endpoint, self._coredns, node_id, coredns_args)
+
+        pending = set()
+        for (node_id, kind), (_, err) in gather(updates, UPDATE_TIMEOUT).items():
+            if err is not None:
+                self.logger.error('failed to update the etcd endpoint of %s on node %s: %s', kind, node_id, err)
+                pending.add((node_id, kind))
+
+        traefik_nodes = [node_id for node_id in self.data['publicNodes']
+                         if (node_id, 'traefik') in self._endpoints_pending]
+        for i, node_id in enumerate(traefik_nodes):
+            try:
+                with gevent.Timeout(UPDATE_TIMEOUT):
+                    restarted = self._update_endpoint(self._traefik, node_id, traefik_args)
+            except (Exception, gevent.Timeout) as err:
+                self.logger.error('failed to update the etcd endpoint of traefik on node %s: %s', node_id, err)
+                pending.add((node_id, 'traefik'))
+                continue
+            if not restarted:
+                continue
+
+            gevent.sleep(ROLLING_DELAY)
+            try:
+                with gevent.Timeout(CHECK_TIMEOUT):
+                    running = self._traefik(node_id).schedule_action('is_running').wait(die=True).result
+            except (Exception, gevent.Timeout) as err:
+                self.logger.error('failed to check traefik on node %s: %s', node_id, err)
+                running = False
+            if not running:
+                self.logger.error('traefik on node %s is not running after updating its etcd endpoint, '
+                                  'stop the rollout', node_id)
+                pending.update((node, 'traefik') for node in traefik_nodes[i + 1:])
+                break
+        self._endpoints_pending = pending
+
+    def _update_endpoint(self, get_service, node_id, args):
+        return get_service(node_id).schedule_action('update_endpoint', args=args).wait(die=True).result
 
     def validate(self):
         for nic in self.data['nics']:
@@ -116,23 +215,90 @@ class WebGateway(TemplateBase):
         if not self.data['etcdConnectionInfo']['etcds']:
             raise RuntimeError('Failed to retrieve etcd cluster etcd connections')
 
-        self._install_traefik(self._traefik_endpoint())
-        self._install_coredns(self._coredns_endpoint())
-        self._set_public_ips(self.data['etcdConnectionInfo'])
+        self._install_public_nodes()
+        self._set_public_ips()
 
         self.state.set('actions', 'install', 'ok')
         self.state.set('actions', 'start', 'ok')
         self.state.set('status', 'running', 'ok')
 
-    def _set_public_ips(self, cluster_connection):
+    def _set_public_ips(self):
+        """
+        Configure the pooled webgateway sals of all the etcds of the cluster with the public ips
+        """
+        self._etcd_pool_key = None
+        self._webgateway_pool
+
+    @property
+    def _webgateway_pool(self):
+        """
+        Webgateway sals connected to each etcd of the cluster. They are kept between the actions
+        and only rebuilt when the etcds of the cluster or the public ips change
+        """
+        connection = self.data['etcdConnectionInfo']
+        key = ([(etcd['ip'], etcd['client_port']) for etcd in connection['etcds']], list(self.data['publicIps']))
+        if key != self._etcd_pool_key:
+            pool = []
+            for i, etcd in enumerate(connection['etcds']):
+                etcd_name = '{}_{}'.format(self._etcds_name, i)
+                j.clients.etcd.get(etcd_name, data={
+                    'host': etcd['ip'], 'port': etcd['client_port'], 'user': connection['user'], 'password_': connection['password']})
+                pool.append(j.sal.webgateway.get('{}_{}'.format(self.name, i), data={
+                    'etcd_instance': etcd_name, 'public_ips': self.data['publicIps']}))
+            self._etcd_pool = pool
+            self._etcd_pool_key = key
+            self._etcd_pool_index = 0
+            self._etcd_down = {}
+        return self._etcd_pool
+
+    def _pooled(self, items, func):
         """
-        Create the etcd client and webgateway sal instance and set the public ips
+        Call func(sal, item) for every item with the pooled webgateway sals.
+        Every call starts with the next etcd of the cluster. An etcd is abandoned at its first connection error:
+        all the items not done yet move to the next etcd, and it is skipped for ETCD_RETRY_DELAY seconds.
+        Any other error only concerns its item, which is tried again on the next etcd
+        :param items: dict of the items by name
+        :param func: function called with a webgateway sal and an item
+        :return: dict with the exception of each item that failed on all the etcds
         """
-        for etcd in cluster_connection['etcds']:
-            j.clients.etcd.get(self._etcds_name, data={
-                               'host': etcd['ip'], 'port': etcd['client_port'], 'user': cluster_connection['user'], 'password_': cluster_connection['password']})
-            break
-        j.sal.webgateway.get(self.name, data={'etcd_instance': self._etcds_name, 'public_ips': self.data['publicIps']})
+        self.state.check('actions', 'install', 'ok')
+        pool = self._webgateway_pool
+        if not pool:
+            raise RuntimeError('No etcd available for web gateway {}'.format(self.name))
+        start = self._etcd_pool_index
+        self._etcd_pool_index = (start + 1) % len(pool)
+        order = [(start + i) % len(pool) for i in range(len(pool))]
+        now = time.time()
+        # the etcds that failed recently are only used as a last resort
+        order.sort(key=lambda index: now - self._etcd_down.get(index, 0) < ETCD_RETRY_DELAY)
+
+        pending = dict(items)
+        errors = {}
+        for index in order:
+            done = []
+            try:
+                for name, item in list(pending.items()):
+                    try:
+                        func(pool[index], item)
+                    except ETCD_CONNECTION_ERRORS:
+                        raise
+                    except Exception as err:
+                        errors[name] = err
+                    else:
+                        done.append(name)
+            except ETCD_CONNECTION_ERRORS as err:
+                self.logger.warning('etcd %s of web gateway %s failed, trying the next one: %s', index, self.name, err)
+                self._etcd_down[index] = time.time()
+                # the items that were not done on this etcd get the error if no etcd is left
+                for name in pending:
+                    if name not in done:
+                        errors.setdefault(name, err)
+            for name in done:
+                errors.pop(name, None)
+                del pending[name]
+            if not pending:
+                break
+        return errors
 
     def _create_zt_clients(self, nics, node_url):
         result = deepcopy(nics)
@@ -166,37 +332,70 @@ class WebGateway(TemplateBase):
         etcd_cluster = self.api.services.find_or_create(ETCD_CLUSTER_TEMPLATE_UID, self._etcds_name, cluster_data)
         etcd_cluster.schedule_action('install').wait(die=True)
         cluster_connection = etcd_cluster.schedule_action('connection_info').wait(die=True).result
+        missing = cluster_connection.pop('missing', None)
+        if missing:
+            raise RuntimeError('Failed to get the connection info of etcds {}'.format(', '.join(missing)))
         return cluster_connection
 
-    def _install_traefik(self, traefik_endpoint):
-        self.logger.info('Installing traefik')
-        data = {
+    def _install_public_nodes(self):
+        """
+        Install traefik and coredns on all the public nodes concurrently.
+        The nodes that failed are retried on their own, the installation fails
+        if some nodes are still failing after INSTALL_ATTEMPTS attempts
+        """
+        traefik_endpoint = self._traefik_endpoint()
+        coredns_endpoint = self._coredns_endpoint()
+        pending = list(self.data['publicNodes'])
+        errors = {}
+        for attempt in range(INSTALL_ATTEMPTS):
+            if attempt:
+                self.logger.info('Retrying installation on public nodes %s', ', '.join(pending))
+                gevent.sleep(INSTALL_RETRY_DELAY)
+            calls = {node_id: partial(self._install_public_node, node_id, traefik_endpoint, coredns_endpoint)
+                     for node_id in pending}
+            results = gather(calls, INSTALL_TIMEOUT)
+            errors = {node_id: err for node_id, (_, err) in results.items() if err is not None}
+            for node_id, err in results.items():
+                if err is None:
+                    self.state.set('nodes', node_id, 'ok')
+                else:
+                    self.state.set('nodes', node_id, 'error')
+                    self.logger.error('Failed to install traefik and coredns on node %s: %s', node_id, err)
+            pending = [node_id for node_id in pending if node_id in errors]
+            if not pending:
+                return
+
+        raise RuntimeError('Failed to install traefik and coredns on nodes: {}'.format(
+            ', '.join('{} ({})'.format(node_id, errors[node_id]) for node_id in pending)))
+
+    def _install_public_node(self, node_id, traefik_endpoint, coredns_endpoint):
+        """
+        Install and start traefik and coredns on a public node
+        """
+        self.logger.info('Installing traefik and coredns on node %s', node_id)
+        nics = self._create_zt_clients(self.data['nics'], self._public_urls[node_id])
+        services = self._public_apis[node_id].services
+
+        traefik_data = {
             'etcdEndpoint': traefik_endpoint,
             'etcdPassword': self.data['etcdPassword'],
             'etcdWatch': True,
+            'nics': nics,
         }
-        for node_id in self.data['publicNodes']:
-            nics = self._create_zt_clients(self.data['nics'], self._public_urls[node_id])
-            data['nics'] = nics
+        traefik = services.find_or_create(TRAEFIK_TEMPLATE_UID, self._traefik_name, traefik_data)
+        traefik.schedule_action('install').wait(die=True)
+        traefik.schedule_action('start').wait(die=True)
 
-            traefik = self._public_apis[node_id].services.find_or_create(TRAEFIK_TEMPLATE_UID, self._traefik_name, data)
-            traefik.schedule_action('install').wait(die=True)
-            traefik.schedule_action('start').wait(die=True)
-
-    def _install_coredns(self, coredns_endpoint):
-        self.logger.info('Installing coredns')
-        data = {
+        coredns_data = {
             'etcdEndpoint': coredns_endpoint,
             'etcdPassword': self.data['etcdPassword'],
             'backplane': self.data['backplane'],
             'domain': self.data['domain'],
+            'nics': nics,
         }
-        for node_id in self.data['publicNodes']:
-            nics = self._create_zt_clients(self.data['nics'], self._public_urls[node_id])
-            data['nics'] = nics
-            coredns = self._public_apis[node_id].services.find_or_create(COREDNS_TEMPLATE_UID, self._coredns_name, data)
-            coredns.schedule_action('install').wait(die=True)
-            coredns.schedule_action('start').wait(die=True)
+        coredns = services.find_or_create(COREDNS_TEMPLATE_UID, self._coredns_name, coredns_data)
+        coredns.schedule_action('install').wait(die=True)
+        coredns.schedule_action('start').wait(die=True)
 
     def _public_nodes_action(self, action):
         if action not in ['start', 'stop']:
@@ -263,13 +462,100 @@ class WebGateway(TemplateBase):
 
     def public_ips_set(self, public_ips):
         self.data['publicIps'] = public_ips
-        self._set_public_ips(self.data['etcdConnectionInfo'])
+        self._set_public_ips()
+
+    def _proxy_lookup(self, count):
+        """
+        Function to find an existing reverse proxy with a webgateway sal.
+        Batches of less than LIST_PROXIES_MIN proxies look every proxy up by name, bigger batches
+        list all the existing proxies once per sal, which reads all of their keys
+        :param count: number of proxies of the batch
+        :return: function called with a webgateway sal and a proxy name, returns the proxy or None
+        """
+        if count < LIST_PROXIES_MIN:
+            def lookup(webgateway, name):
+                try:
+                    return webgateway.service_get(name)
+                except WgServiceNotFound:
+                    return None
+            return lookup
+
+        existing = {}
+
+        def lookup(webgateway, name):
+            if id(webgateway) not in existing:
+                existing[id(webgateway)] = {service.name: service for service in webgateway.services}
+            return existing[id(webgateway)].get(name)
+        return lookup
+
+    def register_proxies(self, proxies):
+        """
+        Register or update a batch of reverse proxies with the pooled webgateway sals.
+        The existing proxies are looked up with _proxy_lookup
+        :param proxies: list of dicts with the name, domain and servers of the reverse proxies
+        :return: dict with for each proxy name 'ok' or the error that prevented its registration
+        """
+        self.state.check('status', 'running', 'ok')
+        lookup = self._proxy_lookup(len(proxies))
+
+        def register(webgateway, proxy):
+            service = lookup(webgateway, proxy['name'])
+            if service is None:
+                service = webgateway.service_create(proxy['name'])
+            service.expose(proxy['domain'], proxy['servers'])
+
+        errors = self._pooled({proxy['name']: proxy for proxy in proxies}, register)
+        results = {}
+        for proxy in proxies:
+            err = errors.get(proxy['name'])
+            if err is not None:
+                self.logger.error('failed to register reverse proxy %s: %s', proxy['name'], err)
+            results[proxy['name']] = 'ok' if err is None else str(err)
+        return results
+
+    def unregister_proxies(self, names):
+        """
+        Remove a batch of reverse proxies, unknown names are ignored
+        :param names: names of the reverse proxies
+        """
+        self.state.check('status', 'running', 'ok')
+        lookup = self._proxy_lookup(len(names))
+
+        def unregister(webgateway, name):
+            service = lookup(webgateway, name)
+            if service is not None:
+                service.delete()
+
+        errors = self._pooled({name: name for name in names}, unregister)
+        if errors:
+            raise RuntimeError('Failed to remove reverse proxies {}'.format(', '.join(sorted(errors))))
 
     def list_domains(self):
-        self.state.check('actions', 'install', 'ok')
-        webgateway = j.sal.webgateway.get(self.name)
         domains = []
-        for service in webgateway.services:
-            for rule in service.proxy.frontend.rules:
-                domains.append(rule.value)
+
+        def collect(webgateway, _):
+            del domains[:]
+            for service in webgateway.services:
+                for rule in service.proxy.frontend.rules:
+                    domains.append(rule.value)
+
+        errors = self._pooled({'domains': None}, collect)
+        if errors:
+            raise errors['domains']
         return domains
+
+
+def gather(calls, timeout):
+    """
+    Run calls concurrently, each one with its own deadline
+    :param calls: dict of functions without arguments
+    :param timeout: deadline of each call in seconds
+    :return: dict with for each key of calls a tuple (result, exception), exception is None if the call succeeded
+    """
+    def run(call):
+        with gevent.Timeout(timeout):
+            return call()
+
+    greenlets = {key: gevent.spawn(run, call) for key, call in calls.items()}
+    gevent.joinall(list(greenlets.values()))
+    return {key: (greenlet.value, greenlet.exception) for key, greenlet in greenlets.items()}
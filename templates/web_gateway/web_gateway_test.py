@@ -0,0 +1,477 @@
+from unittest.mock import MagicMock, patch
+import os
+import pytest
+
+import web_gateway
+from web_gateway import WebGateway
+from zerorobot.template.state import StateCheckError
+
+from JumpscaleZrobot.test.utils import ZrobotBaseTest, task_mock
+
+
+class TestWebGatewayTemplate(ZrobotBaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        super().preTest(os.path.dirname(__file__), WebGateway)
+
+    def setUp(self):
+        self.etcds = [
+            {'ip': '10.0.0.1', 'client_port': '2379', 'client_url': 'http://10.0.0.1:2379'},
+            {'ip': '10.0.0.2', 'client_port': '2379', 'client_url': 'http://10.0.0.2:2379'},
+        ]
+        self.valid_data = {
+            'nics': [{'name': 'zt', 'type': 'zerotier', 'ztClient': 'zt', 'id': 'id'}],
+            'nrEtcds': 2,
+            'etcdPassword': 'password',
+            'farmerIyoOrg': 'farmer',
+            'publicNodes': ['node1', 'node2'],
+            'publicIps': ['1.1.1.1'],
+            'etcdConnectionInfo': {'user': 'root', 'password': 'password', 'etcds': list(self.etcds)},
+            'backplane': 'backplane',
+            'domain': 'domain',
+            'hostNetwork': False,
+        }
+        patch('jumpscale.j.clients', MagicMock()).start()
+        patch('jumpscale.j.sal', MagicMock()).start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def _monitored_gateway(self, connection=None):
+        """
+        web gateway with a running etcd cluster and traefik and coredns services on each public node
+        """
+        wg = WebGateway('wg', data=self.valid_data)
+        wg.state.set('actions', 'install', 'ok')
+        wg.state.set('actions', 'start', 'ok')
+        cluster = MagicMock()
+        if connection is None:
+            connection = {'user': 'root', 'password': 'password', 'etcds': list(self.etcds), 'missing': []}
+        cluster.schedule_action.return_value = task_mock(connection)
+        wg.api.services.get = MagicMock(return_value=cluster)
+        self.services = {}
+        for node_id in self.valid_data['publicNodes']:
+            self.services[(node_id, 'traefik')] = MagicMock()
+            self.services[(node_id, 'coredns')] = MagicMock()
+            wg._public_apis[node_id] = MagicMock()
+        wg._traefik = lambda node_id: self.services[(node_id, 'traefik')]
+        wg._coredns = lambda node_id: self.services[(node_id, 'coredns')]
+        wg._push_endpoints = MagicMock()
+        return wg, cluster
+
+    def test_monitor_running(self):
+        wg, _ = self._monitored_gateway()
+        wg._monitor()
+        wg.state.check('nodes', 'node1', 'ok')
+        wg.state.check('nodes', 'node2', 'ok')
+        wg.state.check('status', 'running', 'ok')
+        wg._push_endpoints.assert_not_called()
+
+    def test_monitor_node_down(self):
+        """
+        Test _monitor keeps the health of each public node in the nodes state
+        """
+        wg, _ = self._monitored_gateway()
+        self.services[('node2', 'coredns')].state.check.side_effect = StateCheckError('coredns is not running')
+        wg._monitor()
+        wg.state.check('nodes', 'node1', 'ok')
+        wg.state.check('nodes', 'node2', 'error')
+        wg.state.check('status', 'running', 'error')
+
+    def test_monitor_node_timeout(self):
+        """
+        Test a node that doesn't answer is marked as failed without holding the other checks
+        """
+        wg, _ = self._monitored_gateway()
+        self.services[('node1', 'traefik')].state.check.side_effect = lambda *args: web_gateway.gevent.sleep(1)
+        with patch.object(web_gateway, 'CHECK_TIMEOUT', 0.1):
+            wg._monitor()
+        wg.state.check('nodes', 'node1', 'error')
+        wg.state.check('nodes', 'node2', 'ok')
+        wg.state.check('status', 'running', 'error')
+
+    def test_monitor_cluster_down(self):
+        wg, cluster = self._monitored_gateway()
+        cluster.state.check.side_effect = StateCheckError('etcd cluster is not running')
+        wg._monitor()
+        wg.state.check('nodes', 'node1', 'ok')
+        wg.state.check('nodes', 'node2', 'ok')
+        wg.state.check('status', 'running', 'error')
+
+    def test_monitor_endpoints_changed(self):
+        """
+        Test _monitor pushes the new etcd endpoints to all the public nodes
+        """
+        etcds = self.etcds[:1] + [{'ip': '10.0.0.3', 'client_port': '2379', 'client_url': 'http://10.0.0.3:2379'}]
+        wg, _ = self._monitored_gateway({'user': 'root', 'password': 'password', 'etcds': etcds, 'missing': []})
+        wg._monitor()
+        assert wg.data['etcdConnectionInfo']['etcds'] == etcds
+        assert wg._endpoints_pending == {(node_id, kind) for node_id in ['node1', 'node2']
+                                         for kind in ['traefik', 'coredns']}
+        wg._push_endpoints.assert_called_once_with()
+
+    def test_monitor_etcd_missing(self):
+        """
+        Test _monitor keeps the etcd endpoints when some etcds of the cluster didn't answer
+        """
+        wg, _ = self._monitored_gateway({'user': 'root', 'password': 'password', 'etcds': self.etcds[:1], 'missing': ['etcd2']})
+        wg._monitor()
+        assert wg.data['etcdConnectionInfo']['etcds'] == self.etcds
+        wg._push_endpoints.assert_not_called()
+        wg.state.check('status', 'running', 'ok')
+
+    def test_monitor_not_started(self):
+        wg, cluster = self._monitored_gateway()
+        wg.state.delete('actions', 'start')
+        wg._monitor()
+        cluster.schedule_action.assert_not_called()
+
+    def _pushing_gateway(self, pending_nodes=('node1', 'node2', 'node3')):
+        """
+        web gateway whose traefik and coredns of pending_nodes still need the etcd endpoints.
+        The services of every node are kept in self.services
+        """
+        self.valid_data['publicNodes'] = list(pending_nodes)
+        wg, _ = self._monitored_gateway()
+        del wg._push_endpoints
+        wg._endpoints_pending = {(node_id, kind) for node_id in pending_nodes for kind in ('traefik', 'coredns')}
+        for (_, kind), service in self.services.items():
+            if kind == 'traefik':
+                service.schedule_action.side_effect = lambda action, args=None: task_mock(True)
+            else:
+                service.schedule_action.return_value = task_mock(None)
+        patch.object(web_gateway.gevent, 'sleep').start()
+        return wg
+
+    def _traefik_actions(self, node_id):
+        return [call[0][0] for call in self.services[(node_id, 'traefik')].schedule_action.call_args_list]
+
+    def test_push_endpoints(self):
+        wg = self._pushing_gateway()
+        wg._push_endpoints()
+        for node_id in ['node1', 'node2', 'node3']:
+            assert self._traefik_actions(node_id) == ['update_endpoint', 'is_running']
+            self.services[(node_id, 'coredns')].schedule_action.assert_called_once_with(
+                'update_endpoint', args={'etcd_endpoint': 'http://10.0.0.1:2379 http://10.0.0.2:2379'})
+        assert wg._endpoints_pending == set()
+
+    def test_push_endpoints_stops_rollout(self):
+        """
+        Test the traefik rollout stops at the first traefik that isn't running after its restart
+        """
+        wg = self._pushing_gateway()
+        self.services[('node2', 'traefik')].schedule_action.side_effect = \
+            lambda action, args=None: task_mock(action == 'update_endpoint')
+        wg._push_endpoints()
+        assert self._traefik_actions('node1') == ['update_endpoint', 'is_running']
+        assert self._traefik_actions('node2') == ['update_endpoint', 'is_running']
+        assert self._traefik_actions('node3') == []
+        assert wg._endpoints_pending == {('node3', 'traefik')}
+
+    def test_push_endpoints_check_failed(self):
+        """
+        Test a traefik that can't be checked after its restart also stops the rollout
+        """
+        wg = self._pushing_gateway()
+
+        def action(action, args=None):
+            if action == 'is_running':
+                raise RuntimeError('node1 is unreachable')
+            return task_mock(True)
+        self.services[('node1', 'traefik')].schedule_action.side_effect = action
+        wg._push_endpoints()
+        assert self._traefik_actions('node2') == []
+        assert wg._endpoints_pending == {('node2', 'traefik'), ('node3', 'traefik')}
+
+    def test_push_endpoints_skip_failed(self):
+        """
+        Test the nodes whose update fails are skipped and retried on the next run
+        """
+        wg = self._pushing_gateway()
+        self.services[('node1', 'traefik')].schedule_action.side_effect = RuntimeError('node1 is unreachable')
+        self.services[('node2', 'coredns')].schedule_action.side_effect = RuntimeError('node2 is unreachable')
+        wg._push_endpoints()
+        assert self._traefik_actions('node3') == ['update_endpoint', 'is_running']
+        assert wg._endpoints_pending == {('node1', 'traefik'), ('node2', 'coredns')}
+
+    def test_push_endpoints_not_restarted(self):
+        """
+        Test a traefik that already had the endpoints is not checked
+        """
+        wg = self._pushing_gateway(['node1'])
+        self.services[('node1', 'traefik')].schedule_action.side_effect = lambda action, args=None: task_mock(False)
+        wg._push_endpoints()
+        assert self._traefik_actions('node1') == ['update_endpoint']
+        web_gateway.gevent.sleep.assert_not_called()
+        assert wg._endpoints_pending == set()
+
+    def _installing_gateway(self, failures):
+        """
+        web gateway whose installation on a public node fails as many times as given in failures.
+        A failure given as 'timeout' makes the installation hang instead
+        """
+        wg = WebGateway('wg', data=self.valid_data)
+        self.attempts = {}
+
+        def install(node_id, traefik_endpoint, coredns_endpoint):
+            self.attempts[node_id] = self.attempts.get(node_id, 0) + 1
+            failure = failures.get(node_id, 0)
+            if failure == 'timeout':
+                web_gateway.gevent.sleep(1)
+            elif self.attempts[node_id] <= failure:
+                raise RuntimeError('installation failed on %s' % node_id)
+        wg._install_public_node = install
+        patch.object(web_gateway, 'INSTALL_RETRY_DELAY', 0).start()
+        return wg
+
+    def test_install_public_nodes(self):
+        wg = self._installing_gateway({})
+        wg._install_public_nodes()
+        assert self.attempts == {'node1': 1, 'node2': 1}
+        wg.state.check('nodes', 'node1', 'ok')
+        wg.state.check('nodes', 'node2', 'ok')
+
+    def test_install_public_nodes_retry(self):
+        """
+        Test only the nodes that failed are installed again
+        """
+        wg = self._installing_gateway({'node2': web_gateway.INSTALL_ATTEMPTS - 1})
+        wg._install_public_nodes()
+        assert self.attempts == {'node1': 1, 'node2': web_gateway.INSTALL_ATTEMPTS}
+        wg.state.check('nodes', 'node2', 'ok')
+
+    def test_install_public_nodes_failed(self):
+        wg = self._installing_gateway({'node2': web_gateway.INSTALL_ATTEMPTS})
+        with pytest.raises(RuntimeError, message='installation should fail after INSTALL_ATTEMPTS attempts'):
+            wg._install_public_nodes()
+        assert self.attempts == {'node1': 1, 'node2': web_gateway.INSTALL_ATTEMPTS}
+        wg.state.check('nodes', 'node1', 'ok')
+        wg.state.check('nodes', 'node2', 'error')
+
+    def test_install_public_nodes_timeout(self):
+        """
+        Test a node whose installation hangs is given up after INSTALL_TIMEOUT on every attempt
+        """
+        wg = self._installing_gateway({'node1': 'timeout'})
+        with patch.object(web_gateway, 'INSTALL_TIMEOUT', 0.1):
+            with pytest.raises(RuntimeError, message='installation should fail on a node that hangs'):
+                wg._install_public_nodes()
+        assert self.attempts == {'node1': web_gateway.INSTALL_ATTEMPTS, 'node2': 1}
+        wg.state.check('nodes', 'node1', 'error')
+        wg.state.check('nodes', 'node2', 'ok')
+
+    def _pooled_gateway(self):
+        """
+        running web gateway whose webgateway sals, one per etcd of the cluster, are kept in self.sals
+        """
+        wg = WebGateway('wg', data=self.valid_data)
+        wg.state.set('actions', 'install', 'ok')
+        wg.state.set('status', 'running', 'ok')
+        self.sals = [MagicMock(), MagicMock()]
+        web_gateway.j.sal.webgateway.get.side_effect = lambda name, data: self.sals[int(name.rsplit('_', 1)[1])]
+        return wg
+
+    def _proxy(self, name):
+        return {'name': name, 'domain': '%s.grid.tf' % name, 'servers': ['http://172.18.0.1:80']}
+
+    def _get_service(self, services, name):
+        if name not in services:
+            raise web_gateway.WgServiceNotFound(name)
+        return services[name]
+
+    def test_proxy_lookup_by_name(self):
+        wg = self._pooled_gateway()
+        sal = self.sals[0]
+        sal.service_get.side_effect = lambda name: self._get_service({'a': 'proxy_a'}, name)
+        lookup = wg._proxy_lookup(web_gateway.LIST_PROXIES_MIN - 1)
+        assert lookup(sal, 'a') == 'proxy_a'
+        assert lookup(sal, 'b') is None
+        assert sal.service_get.call_count == 2
+
+    def test_proxy_lookup_listed(self):
+        """
+        Test big batches list the existing proxies once for each sal
+        """
+        wg = self._pooled_gateway()
+        for sal in self.sals:
+            proxy = MagicMock()
+            proxy.name = 'a'
+            sal.services = [proxy]
+        lookup = wg._proxy_lookup(web_gateway.LIST_PROXIES_MIN)
+        assert lookup(self.sals[0], 'a') is self.sals[0].services[0]
+        assert lookup(self.sals[0], 'b') is None
+        assert lookup(self.sals[1], 'a') is self.sals[1].services[0]
+        self.sals[0].service_get.assert_not_called()
+
+    def test_register_proxies(self):
+        """
+        Test register_proxies creates the new proxies and updates the existing ones
+        """
+        wg = self._pooled_gateway()
+        existing = MagicMock()
+        self.sals[0].service_get.side_effect = lambda name: self._get_service({'a': existing}, name)
+        results = wg.register_proxies([self._proxy('a'), self._proxy('b')])
+        assert results == {'a': 'ok', 'b': 'ok'}
+        existing.expose.assert_called_once_with('a.grid.tf', ['http://172.18.0.1:80'])
+        self.sals[0].service_create.assert_called_once_with('b')
+        self.sals[0].service_create.return_value.expose.assert_called_once_with('b.grid.tf', ['http://172.18.0.1:80'])
+        self.sals[1].service_get.assert_not_called()
+
+    def test_register_proxies_error(self):
+        """
+        Test a proxy that can't be registered is reported without failing the others
+        """
+        wg = self._pooled_gateway()
+        for sal in self.sals:
+            sal.service_get.side_effect = lambda name: self._get_service({}, name)
+            sal.service_create.side_effect = lambda name: self._failing_proxy(name == 'b')
+        results = wg.register_proxies([self._proxy('a'), self._proxy('b')])
+        assert results['a'] == 'ok'
+        assert results['b'] == 'invalid domain'
+
+    def _failing_proxy(self, failing):
+        proxy = MagicMock()
+        if failing:
+            proxy.expose.side_effect = ValueError('invalid domain')
+        return proxy
+
+    def test_register_proxies_not_running(self):
+        wg = self._pooled_gateway()
+        wg.state.delete('status', 'running')
+        with pytest.raises(StateCheckError, message='register_proxies should fail if the web gateway is not running'):
+            wg.register_proxies([self._proxy('a')])
+
+    def test_unregister_proxies(self):
+        """
+        Test unregister_proxies deletes the existing proxies and ignores the unknown names
+        """
+        wg = self._pooled_gateway()
+        existing = MagicMock()
+        self.sals[0].service_get.side_effect = lambda name: self._get_service({'a': existing}, name)
+        wg.unregister_proxies(['a', 'b'])
+        existing.delete.assert_called_once_with()
+
+    def test_unregister_proxies_error(self):
+        wg = self._pooled_gateway()
+        for sal in self.sals:
+            sal.service_get.return_value.delete.side_effect = RuntimeError('failed to delete')
+        with pytest.raises(RuntimeError, message='unregister_proxies should fail if a proxy could not be deleted'):
+            wg.unregister_proxies(['a'])
+
+    def _recorder(self, calls, failures=None):
+        """
+        function for _pooled recording the (sal index, item) it is called with in calls,
+        failures maps a sal index to the error it raises
+        """
+        failures = failures or {}
+
+        def func(sal, item):
+            index = self.sals.index(sal)
+            calls.append((index, item))
+            if index in failures:
+                raise failures[index]
+        return func
+
+    def test_pooled_rotation(self):
+        """
+        Test every call starts with the next etcd of the cluster
+        """
+        wg = self._pooled_gateway()
+        calls = []
+        for _ in range(3):
+            assert wg._pooled({'a': 'a'}, self._recorder(calls)) == {}
+        assert calls == [(0, 'a'), (1, 'a'), (0, 'a')]
+
+    def test_pooled_failover(self):
+        """
+        Test the items move to the next etcd at a connection error
+        """
+        wg = self._pooled_gateway()
+        calls = []
+        errors = wg._pooled({'a': 'a', 'b': 'b'}, self._recorder(calls, {0: web_gateway.ConnectionFailedError()}))
+        assert errors == {}
+        assert calls[0][0] == 0
+        assert sorted(calls[1:]) == [(1, 'a'), (1, 'b')]
+
+    def test_pooled_timeout(self):
+        wg = self._pooled_gateway()
+        calls = []
+        errors = wg._pooled({'a': 'a'}, self._recorder(calls, {0: web_gateway.gevent.Timeout()}))
+        assert errors == {}
+        assert calls == [(0, 'a'), (1, 'a')]
+
+    def test_pooled_all_down(self):
+        """
+        Test the items get the connection error when all the etcds are down
+        """
+        wg = self._pooled_gateway()
+        calls = []
+        err = ConnectionError('etcd is down')
+        errors = wg._pooled({'a': 'a', 'b': 'b'}, self._recorder(calls, {0: err, 1: err}))
+        assert errors == {'a': err, 'b': err}
+        assert set(wg._etcd_down) == {0, 1}
+
+    def test_pooled_item_error(self):
+        """
+        Test an error of an item doesn't abandon the etcd for the other items
+        """
+        wg = self._pooled_gateway()
+        calls = []
+
+        def func(sal, item):
+            calls.append((self.sals.index(sal), item))
+            if item == 'b':
+                raise ValueError('invalid item')
+        errors = wg._pooled({'a': 'a', 'b': 'b', 'c': 'c'}, func)
+        assert set(errors) == {'b'}
+        assert isinstance(errors['b'], ValueError)
+        assert sorted(calls) == [(0, 'a'), (0, 'b'), (0, 'c'), (1, 'b')]
+        assert wg._etcd_down == {}
+
+    def test_pooled_down_window(self):
+        """
+        Test an etcd that failed is only used as a last resort for ETCD_RETRY_DELAY seconds
+        """
+        wg = self._pooled_gateway()
+        now = [1000]
+        patch.object(web_gateway.time, 'time', lambda: now[0]).start()
+        wg._webgateway_pool
+        wg._etcd_pool_index = 1
+        calls = []
+        wg._pooled({'a': 'a'}, self._recorder(calls, {1: ConnectionError('etcd is down')}))
+        wg._pooled({'a': 'a'}, self._recorder(calls))
+        wg._pooled({'a': 'a'}, self._recorder(calls))
+        assert calls == [(1, 'a'), (0, 'a'), (0, 'a'), (0, 'a')]
+
+        # the etcd is back in the rotation once the delay is over
+        del calls[:]
+        now[0] += web_gateway.ETCD_RETRY_DELAY
+        wg._pooled({'a': 'a'}, self._recorder(calls))
+        wg._pooled({'a': 'a'}, self._recorder(calls))
+        assert calls == [(0, 'a'), (1, 'a')]
+
+    def test_pooled_down_last_resort(self):
+        """
+        Test an etcd that failed recently is still used when the others fail
+        """
+        wg = self._pooled_gateway()
+        wg._webgateway_pool
+        wg._etcd_down[0] = web_gateway.time.time()
+        calls = []
+        errors = wg._pooled({'a': 'a'}, self._recorder(calls, {1: ConnectionError('etcd is down')}))
+        assert errors == {}
+        assert calls == [(1, 'a'), (0, 'a')]
+
+    def test_pooled_rebuilt(self):
+        """
+        Test the sals are kept between the calls and rebuilt when the etcds of the cluster change
+        """
+        wg = self._pooled_gateway()
+        wg._pooled({'a': 'a'}, lambda sal, item: None)
+        wg._pooled({'a': 'a'}, lambda sal, item: None)
+        assert web_gateway.j.sal.webgateway.get.call_count == 2
+        wg.data['etcdConnectionInfo']['etcds'] = self.etcds[:1]
+        wg._pooled({'a': 'a'}, lambda sal, item: None)
+        assert web_gateway.j.sal.webgateway.get.call_count == 3
+        assert len(wg._webgateway_pool) == 1
@@ -18,8 +18,23 @@ class Zerodb(TemplateBase):
         super().__init__(name=name, guid=guid, data=data)
         # hardcoded local instance, this service is only intended to be install by the node robot
         self._node_sal = j.clients.zos.get(NODE_CLIENT)
+        # index of the namespaces by name, see _namespace_index
+        self._namespaces = None
+        self._deploy_generation = 0
+        # bumped every time a namespace is added, changed or deleted
+        self._namespaces_generation = 0
+        # results of the actions called through cached_action, valid for _results_key
+        self._results = {}
+        self._results_key = None
+        self._subscribers = set()
+        self.add_delete_callback(self._release_port)
         self.recurring_action('_monitor', 10)  # every 10 seconds
 
+    def update_data(self, data):
+        # the namespaces can have been edited in any way
+        self._namespaces = None
+        self._namespaces_generation += 1
+
     @property
     def _zerodb_sal(self):
         data = self.data.copy()
@@ -30,6 +45,34 @@ class Zerodb(TemplateBase):
         zerodb_sal = self._zerodb_sal
         zerodb_sal.deploy()
         self.data['ztIdentity'] = zerodb_sal.zt_identity
+        self._deploy_generation += 1
+
+    @property
+    def deployment(self):
+        """
+        Identity of the current deployment of this zerodb.
+        It changes every time the zerodb is redeployed or its port changes, so
+        services depending on this zerodb can use it to invalidate cached connection details.
+        """
+        return (self.guid, self.data['nodePort'], self.data['ztIdentity'], self._deploy_generation)
+
+    def cached_action(self, action, args=None):
+        """
+        Execute action on this zerodb and cache its result.
+        The cached result is reused as long as the zerodb is not redeployed, keeps the same port
+        and its namespaces don't change. Used by the namespace and vdisk services to get
+        their connection details without scheduling an action every time
+        :param action: action name
+        :param args: action arguments
+        """
+        key = (self.deployment, self._namespaces_generation)
+        if key != self._results_key:
+            self._results = {}
+            self._results_key = key
+        call = (action, tuple(sorted((args or {}).items())))
+        if call not in self._results:
+            self._results[call] = self.schedule_action(action, args=args).wait(die=True).result
+        return self._results[call]
 
     def _monitor(self):
         self.logger.info('Monitor zerodb %s' % self.name)
@@ -43,13 +86,13 @@ class Zerodb(TemplateBase):
         node.state.check('disks', 'mounted', 'ok')
 
         if self._zerodb_sal.is_running():
-            self.state.set('status', 'running', 'ok')
+            self._set_running('ok')
             return
 
         try:
             self._deploy()
         except Exception as err:
-            self.state.set('status', 'running', 'error')
+            self._set_running('error')
             hostname = self._node_sal.client.info.os()['hostname']
             node_id = self._node_sal.name
             data = {
@@ -66,9 +109,9 @@ class Zerodb(TemplateBase):
             return
 
         if self._zerodb_sal.is_running():
-            self.state.set('status', 'running', 'ok')
+            self._set_running('ok')
         else:
-            self.state.set('status', 'running', 'error')
+            self._set_running('error')
 
     def install(self):
         self.logger.info('Installing zerodb %s' % self.name)
@@ -92,7 +135,7 @@ class Zerodb(TemplateBase):
         self._deploy()
         self.state.set('actions', 'install', 'ok')
         self.state.set('actions', 'start', 'ok')
-        self.state.set('status', 'running', 'ok')
+        self._set_running('ok')
 
     def start(self):
         """
@@ -102,7 +145,7 @@ class Zerodb(TemplateBase):
         self.state.check('actions', 'install', 'ok')
         self._deploy()
         self.state.set('actions', 'start', 'ok')
-        self.state.set('status', 'running', 'ok')
+        self._set_running('ok')
 
     def stop(self):
         """
@@ -112,7 +155,7 @@ class Zerodb(TemplateBase):
 
         self._zerodb_sal.stop()
         self.state.delete('actions', 'start')
-        self.state.delete('status', 'running')
+        self._set_running(None)
 
     def upgrade(self):
         """
@@ -187,12 +230,12 @@ class Zerodb(TemplateBase):
             raise ValueError('Namespace {} already exists'.format(name))
 
         namespace = {'name': name, 'size': size, 'password': password, 'public': public}
-        self.data['namespaces'].append(namespace)
+        self._namespace_add(namespace)
 
         try:
             self._zerodb_sal.deploy()
         except:
-            self.data['namespaces'].remove(namespace)
+            self._namespace_exists_update_delete(name, delete=True)
             self._zerodb_sal.deploy()
             raise
 
@@ -228,10 +271,56 @@ class Zerodb(TemplateBase):
         try:
             self._zerodb_sal.deploy()
         except:
-            self.data['namespaces'].append(namespace)
+            self._namespace_add(namespace)
             self._zerodb_sal.deploy()
             raise
 
+    def subscribe(self, guid):
+        """
+        Register a service to be notified when the running status of this zerodb changes.
+        The subscribed service needs to implement the `zerodb_status_update` action.
+        :param guid: guid of the subscribing service
+        """
+        self._subscribers.add(guid)
+
+    def unsubscribe(self, guid):
+        """
+        Stop notifying a service about status changes of this zerodb
+        :param guid: guid of the subscribed service
+        """
+        self._subscribers.discard(guid)
+
+    def _set_running(self, state):
+        """
+        Set the status/running state and notify the subscribers if the zerodb
+        went from running to not running or the other way around
+        :param state: new state, None to delete it
+        """
+        try:
+            self.state.check('status', 'running', 'ok')
+            was_running = True
+        except StateCheckError:
+            was_running = False
+
+        if state is None:
+            self.state.delete('status', 'running')
+        else:
+            self.state.set('status', 'running', state)
+
+        running = state == 'ok'
+        if running != was_running:
+            self._notify_subscribers(running)
+
+    def _notify_subscribers(self, running):
+        services = self.api.services.guids
+        for guid in list(self._subscribers):
+            service = services.get(guid)
+            if service is None:
+                # the service has been deleted without unsubscribing
+                self._subscribers.discard(guid)
+                continue
+            service.schedule_action('zerodb_status_update', args={'running': running})
+
     def connection_info(self):
         zdb_sal = self._zerodb_sal
         return {
@@ -255,15 +344,40 @@ class Zerodb(TemplateBase):
         if prop and prop not in ['size', 'password', 'public']:
             raise ValueError('Property must be size, password, or public')
 
-        for namespace in self.data['namespaces']:
-            if namespace['name'] == name:
-                ns = dict(namespace)
-                if prop:
-                    namespace[prop] = value
-                if delete:
-                    self.data['namespaces'].remove(namespace)
-                return ns
-        return False
+        index = self._namespace_index
+        namespace = index.get(name)
+        if namespace is None:
+            return False
+
+        ns = dict(namespace)
+        if prop:
+            namespace[prop] = value
+        if delete:
+            self.data['namespaces'].remove(namespace)
+            del index[name]
+        if prop or delete:
+            self._namespaces_generation += 1
+        return ns
+
+    def _namespace_add(self, namespace):
+        """
+        Append namespace to self.data['namespaces'] and keep the name index in sync
+        :param namespace: namespace dict
+        """
+        index = self._namespace_index
+        self.data['namespaces'].append(namespace)
+        index[namespace['name']] = self.data['namespaces'][-1]
+        self._namespaces_generation += 1
+
+    @property
+    def _namespace_index(self):
+        """
+        In-memory index of self.data['namespaces'] keyed by namespace name.
+        Kept in sync by the namespace helpers, and rebuilt on its next use after update_data
+        """
+        if self._namespaces is None:
+            self._namespaces = {namespace['name']: namespace for namespace in self.data['namespaces']}
+        return self._namespaces
 
     @retry(exceptions=ServiceNotFoundError, tries=3, delay=3, backoff=2)
     def _reserve_port(self):
@@ -271,6 +385,14 @@ class Zerodb(TemplateBase):
         self.data['nodePort'] = port_mgr.schedule_action(
             "reserve", {"service_guid": self.guid, 'n': 1}).wait(die=True).result[0]
 
+    @retry(exceptions=ServiceNotFoundError, tries=3, delay=3, backoff=2)
+    def _release_port(self):
+        if not self.data['nodePort']:
+            return
+        port_mgr = self.api.services.get(template_uid=PORT_MANAGER_TEMPLATE_UID, name='_port_manager')
+        port_mgr.schedule_action("release_service", {"service_guid": self.guid})
+        self.data['nodePort'] = 0
+
 
 def send_alert(alertas, alert):
     for alerta in alertas:
@@ -462,3 +462,83 @@ class TestZerodbTemplate(ZrobotBaseTest):
             zdb._monitor()
         with pytest.raises(StateCheckError, message='_monitor should not start zerodb is the start action has not been called'):
             zdb.state.check('status', 'running', 'ok')
+
+    def test_namespace_index(self):
+        """
+        Test _namespace_index is kept in sync with data['namespaces']
+        """
+        self.valid_data['namespaces'].append({'name': 'namespace', 'size': 20, 'public': True, 'password': ''})
+        zdb = Zerodb('zdb', data=self.valid_data)
+        assert list(zdb._namespace_index.keys()) == ['namespace']
+
+        zdb._namespace_add({'name': 'namespace2', 'size': 20, 'public': True, 'password': ''})
+        assert sorted(zdb._namespace_index.keys()) == ['namespace', 'namespace2']
+
+        zdb._namespace_exists_update_delete('namespace', delete=True)
+        assert list(zdb._namespace_index.keys()) == ['namespace2']
+        assert zdb.data['namespaces'] == [{'name': 'namespace2', 'size': 20, 'public': True, 'password': ''}]
+
+        zdb.data['namespaces'] = [{'name': 'namespace3', 'size': 20, 'public': True, 'password': ''}]
+        assert list(zdb._namespace_index.keys()) == ['namespace3']
+
+    def test_subscribers_notified_on_status_change(self):
+        """
+        Test subscribers get notified when the running status changes
+        """
+        zdb = Zerodb('zdb', data=self.valid_data)
+        subscriber = MagicMock()
+        zdb.api.services.guids = {'guid': subscriber}
+        zdb.subscribe('guid')
+
+        zdb._set_running('ok')
+        subscriber.schedule_action.assert_called_once_with('zerodb_status_update', args={'running': True})
+
+        # no transition, no notification
+        zdb._set_running('ok')
+        assert subscriber.schedule_action.call_count == 1
+
+        zdb._set_running('error')
+        subscriber.schedule_action.assert_called_with('zerodb_status_update', args={'running': False})
+
+        zdb.unsubscribe('guid')
+        zdb._set_running('ok')
+        assert subscriber.schedule_action.call_count == 2
+
+    def test_deleted_subscribers_dropped(self):
+        """
+        Test subscribers that don't exist anymore are removed
+        """
+        zdb = Zerodb('zdb', data=self.valid_data)
+        zdb.api.services.guids = {}
+        zdb.subscribe('guid')
+        zdb._set_running('ok')
+        assert zdb._subscribers == set()
+
+    def test_cached_action(self):
+        """
+        Test cached_action only schedules the action again when the zerodb or its namespaces change
+        """
+        self.valid_data['namespaces'].append({'name': 'namespace', 'size': 20, 'public': True, 'password': ''})
+        self.valid_data['nodePort'] = 9900
+        zdb = Zerodb('zdb', data=self.valid_data)
+        zdb.schedule_action = MagicMock(return_value=MagicMock(**{'wait.return_value.result': 'url'}))
+
+        assert zdb.cached_action('namespace_url', args={'name': 'namespace'}) == 'url'
+        assert zdb.cached_action('namespace_url', args={'name': 'namespace'}) == 'url'
+        assert zdb.schedule_action.call_count == 1
+        zdb.cached_action('namespace_private_url', args={'name': 'namespace'})
+        assert zdb.schedule_action.call_count == 2
+
+        # the password or the public flag of a namespace changed
+        zdb._namespace_exists_update_delete('namespace', 'public', False)
+        zdb.cached_action('namespace_url', args={'name': 'namespace'})
+        assert zdb.schedule_action.call_count == 3
+
+        # the zerodb moved to another port
+        zdb.data['nodePort'] = 9901
+        zdb.cached_action('namespace_url', args={'name': 'namespace'})
+        assert zdb.schedule_action.call_count == 4
+
+        zdb.update_data(zdb.data)
+        zdb.cached_action('namespace_url', args={'name': 'namespace'})
+        assert zdb.schedule_action.call_count == 5
@@ -19,6 +19,7 @@ class Zrobot(TemplateBase):
 
     def __init__(self, name, guid=None, data=None):
         super().__init__(name=name, guid=guid, data=data)
+        self.add_delete_callback(self._release_port)
         self.recurring_action('_monitor', 30)  # every 30 seconds
 
     def validate(self):
@@ -225,4 +226,5 @@ class Zrobot(TemplateBase):
         if not self.data['port']:
             return
         port_mgr = self.api.services.get(template_uid=PORT_MANAGER_TEMPLATE_UID, name='_port_manager')
-        port_mgr.schedule_action("release", {"service_guid": self.guid, 'ports': [self.data['port']]})
+        port_mgr.schedule_action("release_service", {"service_guid": self.guid})
+        self.data['port'] = 0
@@ -0,0 +1,298 @@
+"""
+Benchmark of the web gateway routing as the number of exposed domains grows.
+
+The web_gateway and reverse_proxy templates run unchanged with the real webgateway sal and etcd clients,
+against a running etcd cluster (a single local etcd is enough). Only the robot the reverse proxies
+schedule their actions on is replaced by a local stand-in, no node is needed.
+The etcd requests and keys are read from the /metrics endpoint of every etcd member.
+
+Measured for every size:
+- register: install the reverse proxies one by one, like independent reverse_proxy services
+- register_batch: register all the proxies with a single register_proxies call
+- update: change the backend servers of a proxy until every etcd member has applied the change
+- list_domains: list the exposed domains
+- unregister_batch: remove all the proxies of the size with a single unregister_proxies call
+
+Usage:
+    etcd --listen-client-urls http://127.0.0.1:2379 --advertise-client-urls http://127.0.0.1:2379 &
+    python tests/benchmarks/web_gateway_routing.py --etcd 127.0.0.1:2379 --sizes 10,100,1000 --output results.json
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import etcd3
+import requests
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'templates')
+for template in ('web_gateway', 'reverse_proxy'):
+    sys.path.insert(0, os.path.join(ROOT, template))
+
+from JumpscaleZrobot.test.utils import ZrobotBaseTest  # noqa: E402
+from reverse_proxy import ReverseProxy  # noqa: E402
+from web_gateway import WebGateway  # noqa: E402
+
+DEFAULT_SIZES = (10, 100, 1000)
+APPLY_TIMEOUT = 30  # deadline for all the etcd members to apply a change
+APPLY_POLL = 0.001  # time between two checks of the raft index of the etcd members
+METRICS_TIMEOUT = 10  # deadline of the requests to the /metrics endpoint of the etcd members
+# counters of the etcd members, the reads are served by one member while the writes are applied by all of them
+READ_COUNTERS = {'etcd_debugging_mvcc_range_total': 'range'}
+WRITE_COUNTERS = {
+    'etcd_debugging_mvcc_put_total': 'put',
+    'etcd_debugging_mvcc_delete_total': 'delete',
+    'etcd_debugging_mvcc_txn_total': 'txn',
+}
+KEYS_GAUGE = 'etcd_debugging_mvcc_keys_total'
+
+
+class EtcdMembers:
+    """
+    Members of the etcd cluster the benchmark runs against
+    """
+
+    def __init__(self, endpoints, user, password):
+        """
+        :param endpoints: list of host:port of the client urls of the members
+        """
+        self.endpoints = endpoints
+        self._clients = []
+        for endpoint in endpoints:
+            host, port = endpoint.rsplit(':', 1)
+            self._clients.append(etcd3.client(host=host, port=int(port), user=user or None, password=password or None))
+
+    def connection_info(self, user, password):
+        """
+        connection info of the cluster, as returned by the etcd_cluster template
+        """
+        etcds = []
+        for endpoint in self.endpoints:
+            host, port = endpoint.rsplit(':', 1)
+            etcds.append({'ip': host, 'client_port': port, 'client_url': 'http://{}'.format(endpoint)})
+        return {'user': user, 'password': password, 'etcds': etcds}
+
+    def raft_index(self):
+        return max(client.status().raft_index for client in self._clients)
+
+    def wait_applied(self, index, timeout):
+        """
+        wait until every member applied the raft log up to index
+        """
+        deadline = time.perf_counter() + timeout
+        pending = list(self._clients)
+        while pending:
+            pending = [client for client in pending if client.status().raft_index < index]
+            if pending and time.perf_counter() > deadline:
+                raise RuntimeError('{} etcd members did not apply the change in {}s'.format(len(pending), timeout))
+            if pending:
+                time.sleep(APPLY_POLL)
+
+    def metrics(self):
+        """
+        :return: (counters of the etcd requests, number of keys stored)
+        """
+        counters = Counter()
+        keys = 0
+        for endpoint in self.endpoints:
+            response = requests.get('http://{}/metrics'.format(endpoint), timeout=METRICS_TIMEOUT)
+            response.raise_for_status()
+            for line in response.text.splitlines():
+                name, _, value = line.partition(' ')
+                if name in READ_COUNTERS:
+                    counters[READ_COUNTERS[name]] += int(float(value))
+                elif name in WRITE_COUNTERS:
+                    counters[WRITE_COUNTERS[name]] = max(counters[WRITE_COUNTERS[name]], int(float(value)))
+                elif name == KEYS_GAUGE:
+                    keys = max(keys, int(float(value)))
+        return counters, keys
+
+
+class ServiceStub:
+    """
+    Service of the local robot stand-in, runs the actions of a template instance synchronously
+    """
+
+    def __init__(self, instance):
+        self._instance = instance
+
+    def schedule_action(self, action, args=None):
+        result = getattr(self._instance, action)(**(args or {}))
+        return SimpleNamespace(wait=lambda die=False, timeout=None: SimpleNamespace(result=result))
+
+
+def summary(latencies):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        'count': count,
+        'total': sum(latencies),
+        'mean': sum(latencies) / count,
+        'p50': latencies[count // 2],
+        'p95': latencies[min(count - 1, int(count * 0.95))],
+        'max': latencies[-1],
+    }
+
+
+class Bench:
+
+    def __init__(self, size, members, connection, public_ips, updates):
+        self.size = size
+        self.updates = updates
+        self.members = members
+        self.web_gateway = WebGateway(name='bench', data={
+            'nrEtcds': len(members.endpoints),
+            'farmerIyoOrg': 'farmer',
+            'publicNodes': [],
+            'publicIps': public_ips,
+            'domain': 'bench.grid.tf',
+        })
+        self.web_gateway.data['etcdConnectionInfo'] = connection
+        self.web_gateway.state.set('actions', 'install', 'ok')
+        self.web_gateway.state.set('status', 'running', 'ok')
+        self.web_gateway_service = ServiceStub(self.web_gateway)
+
+    def run(self):
+        return [
+            self._measure('register', self._register),
+            self._measure('register_batch', self._register_batch),
+            self._measure('update', self._update),
+            self._measure('list_domains', self._list_domains),
+            self._measure('unregister_batch', self._unregister_batch),
+        ]
+
+    def _measure(self, operation, func):
+        before, _ = self.members.metrics()
+        latencies = func()
+        after, keys = self.members.metrics()
+        counts = {name: after[name] - before[name] for name in after}
+        return {
+            'size': self.size,
+            'operation': operation,
+            'seconds': summary(latencies),
+            'etcd_requests': counts,
+            'etcd_requests_per_operation': {name: count / len(latencies) for name, count in counts.items()},
+            'etcd_keys_stored': keys,
+        }
+
+    def _proxies(self, prefix):
+        return [{
+            'name': '{}{}'.format(prefix, i),
+            'domain': '{}{}.bench.grid.tf'.format(prefix, i),
+            'servers': ['http://172.18.{}.{}:80'.format(i // 250, i % 250 + 1)],
+        } for i in range(self.size)]
+
+    def _register(self):
+        self.reverse_proxies = []
+        latencies = []
+        for proxy in self._proxies('rp'):
+            service = ReverseProxy(name=proxy['name'], data={
+                'webGateway': self.web_gateway.name,
+                'domain': proxy['domain'],
+                'servers': proxy['servers'],
+            })
+            service.api.services.get = MagicMock(return_value=self.web_gateway_service)
+            start = time.perf_counter()
+            service.install()
+            latencies.append(time.perf_counter() - start)
+            self.reverse_proxies.append(service)
+        return latencies
+
+    def _register_batch(self):
+        proxies = self._proxies('batch')
+        start = time.perf_counter()
+        results = self.web_gateway.register_proxies(proxies)
+        latency = time.perf_counter() - start
+        failed = [name for name, result in results.items() if result != 'ok']
+        if failed:
+            raise RuntimeError('failed to register {} proxies'.format(len(failed)))
+        return [latency]
+
+    def _update(self):
+        latencies = []
+        for service in random.sample(self.reverse_proxies, min(self.updates, len(self.reverse_proxies))):
+            server = 'http://172.19.{}.{}:8080'.format(random.randint(0, 255), random.randint(1, 254))
+            start = time.perf_counter()
+            service.update_servers([server])
+            self.members.wait_applied(self.members.raft_index(), APPLY_TIMEOUT)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    def _list_domains(self):
+        start = time.perf_counter()
+        domains = self.web_gateway.list_domains()
+        latency = time.perf_counter() - start
+        expected = {proxy['domain'] for proxy in self._proxies('rp') + self._proxies('batch')}
+        missing = expected - set(domains)
+        if missing:
+            raise RuntimeError('{} domains are not listed'.format(len(missing)))
+        return [latency]
+
+    def _unregister_batch(self):
+        names = [proxy['name'] for proxy in self._proxies('rp') + self._proxies('batch')]
+        start = time.perf_counter()
+        self.web_gateway.unregister_proxies(names)
+        return [time.perf_counter() - start]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--etcd', default='127.0.0.1:2379',
+                        help='comma separated host:port of the client urls of the etcd members')
+    parser.add_argument('--user', default='', help='etcd user, empty if the authentication is disabled')
+    parser.add_argument('--password', default='', help='password of the etcd user')
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+                        help='comma separated numbers of reverse proxies')
+    parser.add_argument('--public-ips', default='10.1.0.1,10.1.0.2,10.1.0.3',
+                        help='comma separated public ips of the web gateway')
+    parser.add_argument('--updates', type=int, default=20, help='number of backend changes measured per size')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file to write the JSON results to, stdout by default')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    ZrobotBaseTest.preTest(os.path.join(ROOT, 'web_gateway'), WebGateway)
+    ZrobotBaseTest.preTest(os.path.join(ROOT, 'reverse_proxy'), ReverseProxy)
+
+    members = EtcdMembers(args.etcd.split(','), args.user, args.password)
+    connection = members.connection_info(args.user, args.password)
+    public_ips = args.public_ips.split(',')
+
+    results = []
+    for size in (int(size) for size in args.sizes.split(',')):
+        bench = Bench(size, members, connection, public_ips, args.updates)
+        for result in bench.run():
+            results.append(result)
+            print('{size:>6} {operation:<16} {total:10.4f}s total {mean:10.6f}s mean {requests:8.1f} etcd requests/op'.format(
+                size=size, operation=result['operation'], total=result['seconds']['total'],
+                mean=result['seconds']['mean'], requests=sum(result['etcd_requests_per_operation'].values())),
+                file=sys.stderr)
+
+    report = {
+        'benchmark': 'web_gateway_routing',
+        'timestamp': int(time.time()),
+        'parameters': {
+            'etcd': args.etcd,
+            'sizes': args.sizes,
+            'public_ips': args.public_ips,
+            'updates': args.updates,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+    content = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(content)
+    else:
+        print(content)
+
+
+if __name__ == '__main__':
+    main()